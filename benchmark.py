@@ -0,0 +1,243 @@
+#!/usr/bin/python
+
+# Client-side micro-benchmarks of the data generators, stats and loader row builders. Nothing here talks to a
+# database, so the results only depend on the python side of movr and can be compared across commits:
+#
+#   python benchmark.py --output before.json
+#   python benchmark.py --output after.json --compare before.json
+
+import argparse, datetime, json, logging, os, platform, subprocess, sys, threading, time
+from sqlalchemy.dialects import postgresql
+from tabulate import tabulate
+from generators import MovRGenerator
+from movr_loader import format_copy_value, LOADER_CHUNK_SIZES, LOADER_TABLES
+from movr_pools import IdPool
+from movr_stats import MovRStats, LatencyHistogram
+import loadmovr
+
+BENCHMARK_VERSION = 1
+
+
+def get_id_pool(n):
+    return IdPool(MovRGenerator.generate_uuid_batch(n))
+
+# the user, vehicle and ride ids the rows of the later loader stages reference
+def get_id_pools():
+    return {"users": get_id_pool(1000), "vehicles": get_id_pool(1000), "rides": get_id_pool(1000)}
+
+def build_rows(table, n, id_pools):
+    city = "new york"
+    if table == "users":
+        return loadmovr.build_user_rows(n, city)
+    if table == "vehicles":
+        return loadmovr.build_vehicle_rows(n, city, id_pools["users"])
+    if table == "rides":
+        return loadmovr.build_ride_rows(n, city, id_pools["users"], id_pools["vehicles"])
+    if table == "vehicle_location_histories":
+        return loadmovr.build_vehicle_location_history_rows(n, city, id_pools["rides"])
+    return loadmovr.build_promo_code_rows(n)
+
+
+##############
+# BENCHMARKS
+# each takes the number of items to process and returns a function that processes them,
+# so setup stays out of the measurement
+##############
+
+def bench_generate_uuid(n):
+    return lambda: [MovRGenerator.generate_uuid() for _ in range(n)]
+
+def bench_generate_uuid_batch(n):
+    return lambda: MovRGenerator.generate_uuid_batch(n)
+
+def bench_generate_address(n):
+    return lambda: [MovRGenerator.generate_address() for _ in range(n)]
+
+def bench_generate_address_batch(n):
+    return lambda: MovRGenerator.generate_address_batch(n)
+
+def bench_generate_vehicle_metadata(n):
+    types = MovRGenerator.generate_random_vehicle_batch(n)
+    return lambda: [MovRGenerator.generate_vehicle_metadata(type) for type in types]
+
+def bench_generate_vehicle_metadata_batch(n):
+    types = MovRGenerator.generate_random_vehicle_batch(n)
+    return lambda: MovRGenerator.generate_vehicle_metadata_batch(types)
+
+def bench_get_vehicle_availability(n):
+    return lambda: [MovRGenerator.get_vehicle_availability() for _ in range(n)]
+
+# the action draw that starts every tick of the run loop, with the default operation mix
+def bench_operation_sampler(n):
+    sampler = loadmovr.get_operation_sampler(loadmovr.DEFAULT_READ_PERCENTAGE, 0)
+    return lambda: [sampler.sample() for _ in range(n)]
+
+# n measurements recorded evenly by num_threads threads into a single MovRStats
+def bench_stats_recording(n, num_threads):
+    def run():
+        stats = MovRStats()
+        per_thread = n // num_threads
+
+        def record():
+            for i in range(per_thread):
+                stats.add_latency_measurement("start ride", (i % 1000) / 10000.0)
+
+        threads = [threading.Thread(target=record) for _ in range(num_threads)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+    return run
+
+# percentiles of a histogram holding n measurements, as print_stats computes them
+def bench_percentiles(n, repetitions = 100):
+    histogram = LatencyHistogram()
+    for i in range(n):
+        histogram.record((i % 100000) / 100000.0)
+    return lambda: [histogram.get_percentiles([50, 90, 95, 99, 99.9, 100]) for _ in range(repetitions)]
+
+def bench_build_rows(table, n):
+    id_pools = get_id_pools()
+    return lambda: build_rows(table, n, id_pools)
+
+# turn loader rows into what each loader backend hands to the database, without sending it
+def bench_orm_objects(table, n):
+    model, columns = LOADER_TABLES[table]
+    rows = build_rows(table, n, get_id_pools())
+    return lambda: [model(**dict(zip(columns, row))) for row in rows]
+
+def bench_core_insert(table, n):
+    model, columns = LOADER_TABLES[table]
+    rows = build_rows(table, n, get_id_pools())
+    dialect = postgresql.dialect()
+    return lambda: (model.__table__.insert().compile(dialect=dialect), [dict(zip(columns, row)) for row in rows])
+
+def bench_copy_rows(table, n):
+    rows = build_rows(table, n, get_id_pools())
+    return lambda: "".join("\t".join(format_copy_value(value) for value in row) + "\n" for row in rows)
+
+
+# (name, unit, items per run, benchmark function) for every benchmark, scaled by the --scale multiplier
+def get_benchmarks(scale, num_threads):
+    def items(n):
+        return max(int(n * scale), 1)
+
+    benchmarks = [
+        ("generate_uuid", "uuids", items(20000), bench_generate_uuid),
+        ("generate_uuid_batch", "uuids", items(20000), bench_generate_uuid_batch),
+        ("generate_address", "addresses", items(20000), bench_generate_address),
+        ("generate_address_batch", "addresses", items(20000), bench_generate_address_batch),
+        ("generate_vehicle_metadata", "vehicles", items(20000), bench_generate_vehicle_metadata),
+        ("generate_vehicle_metadata_batch", "vehicles", items(20000), bench_generate_vehicle_metadata_batch),
+        ("get_vehicle_availability", "vehicles", items(20000), bench_get_vehicle_availability),
+        ("operation_sampler", "operations", items(20000), bench_operation_sampler),
+        ("stats_recording_1_thread", "measurements", items(200000), lambda n: bench_stats_recording(n, 1)),
+        ("stats_recording_%d_threads" % num_threads, "measurements", items(200000) // num_threads * num_threads,
+         lambda n: bench_stats_recording(n, num_threads)),
+        ("percentiles_100k_measurements", "percentile sets", 100,
+         lambda n: bench_percentiles(items(100000), n))
+    ]
+    for table in sorted(LOADER_CHUNK_SIZES):
+        n = LOADER_CHUNK_SIZES[table]
+        benchmarks.append(("build_%s_rows" % table, "rows", n, lambda n, table=table: bench_build_rows(table, n)))
+        benchmarks.append(("orm_%s_objects" % table, "rows", n, lambda n, table=table: bench_orm_objects(table, n)))
+        benchmarks.append(("core_%s_insert" % table, "rows", n, lambda n, table=table: bench_core_insert(table, n)))
+        benchmarks.append(("copy_%s_rows" % table, "rows", n, lambda n, table=table: bench_copy_rows(table, n)))
+    return benchmarks
+
+# run a benchmark repeats times and return the time of every run, in seconds
+def time_benchmark(benchmark, n, repeats):
+    run = benchmark(n)
+    run() # warm up (pools, caches, statement compilation)
+    timings = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        run()
+        timings.append(time.perf_counter() - start)
+    return timings
+
+def get_git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], cwd=os.path.dirname(os.path.abspath(__file__)),
+                              capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def run_benchmarks(scale, repeats, num_threads, name_filter = None):
+    results = []
+    for name, unit, n, benchmark in get_benchmarks(scale, num_threads):
+        if name_filter and name_filter not in name:
+            continue
+        logging.info("running %s...", name)
+        timings = time_benchmark(benchmark, n, repeats)
+        best = min(timings)
+        results.append({"name": name, "unit": unit, "items": n, "repeats": repeats,
+                        "best_seconds": best, "median_seconds": sorted(timings)[len(timings) // 2],
+                        "items_per_second": n / best if best > 0 else 0.0})
+
+    return {"version": BENCHMARK_VERSION,
+            "time": datetime.datetime.now().isoformat(),
+            "commit": get_git_commit(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "scale": scale,
+            "threads": num_threads,
+            "results": results}
+
+def print_results(report, baseline = None):
+    baseline_results = {result["name"]: result for result in baseline["results"]} if baseline else {}
+    header = ["benchmark", "items", "best(ms)", "median(ms)", "items/second"]
+    if baseline:
+        header += ["baseline items/second", "speedup"]
+
+    rows = []
+    for result in report["results"]:
+        row = [result["name"], result["items"], round(result["best_seconds"] * 1000, 3),
+               round(result["median_seconds"] * 1000, 3), int(result["items_per_second"])]
+        if baseline:
+            baseline_result = baseline_results.get(result["name"])
+            if baseline_result and baseline_result["items_per_second"]:
+                row += [int(baseline_result["items_per_second"]),
+                        round(result["items_per_second"] / baseline_result["items_per_second"], 2)]
+            else:
+                row += ["", ""]
+        rows.append(row)
+    print(tabulate(rows, header), "\n")
+
+def setup_parser():
+    parser = argparse.ArgumentParser(description='Client-side micro-benchmarks of the MovR load generator.')
+    parser.add_argument('--output', dest='output',
+                        help='Write the results to this JSON file.')
+    parser.add_argument('--compare', dest='compare',
+                        help='Compare the results with a JSON file written by an earlier --output.')
+    parser.add_argument('--repeats', dest='repeats', type=int, default=5,
+                        help='Times each benchmark is timed; the best and median times are reported. (default = 5)')
+    parser.add_argument('--scale', dest='scale', type=float, default=1.0,
+                        help='Multiplier for the number of items each benchmark processes. (default = 1)')
+    parser.add_argument('--num-threads', dest='num_threads', type=int, default=8,
+                        help='Threads recording stats concurrently in the multi-threaded stats benchmark. (default = 8)')
+    parser.add_argument('--filter', dest='name_filter',
+                        help='Only run the benchmarks whose name contains this string.')
+    return parser
+
+
+if __name__ == '__main__':
+    args = setup_parser().parse_args()
+    logging.basicConfig(level=logging.INFO, format='[%(levelname)s] %(message)s')
+
+    if args.repeats <= 0 or args.scale <= 0 or args.num_threads <= 0:
+        logging.error("Repeats, scale and number of threads must be greater than 0.")
+        sys.exit(1)
+
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+
+    report = run_benchmarks(args.scale, args.repeats, args.num_threads, args.name_filter)
+    print_results(report, baseline)
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+        logging.info("wrote results to %s", args.output)
@@ -1,39 +1,128 @@
-import uuid, random
+import uuid, random, os, datetime, threading, contextvars
+import numpy
+from faker import Faker
 #@todo: how to do this in the database?
 
 
+# Categorical distribution compiled with Vose's alias method: every draw takes one random number and O(1) time,
+# however many items there are. Items are equally likely unless weights are given.
+class AliasSampler:
+    def __init__(self, items, weights = None):
+        if not len(items):
+            raise ValueError("can't sample from no items")
+        n = len(items)
+        weights = [1.0] * n if weights is None else [float(weight) for weight in weights]
+        total = sum(weights)
+        if len(weights) != n or total <= 0 or min(weights) < 0:
+            raise ValueError("weights must be one non-negative number per item, with a positive sum")
+
+        self.items = list(items)
+        self.probabilities = [1.0] * n
+        self.aliases = list(range(n))
+        scaled = [weight * n / total for weight in weights]
+        small = [i for i, p in enumerate(scaled) if p < 1]
+        large = [i for i, p in enumerate(scaled) if p >= 1]
+        while small and large:
+            less, more = small.pop(), large.pop()
+            self.probabilities[less] = scaled[less]
+            self.aliases[less] = more
+            scaled[more] -= 1 - scaled[less]
+            (small if scaled[more] < 1 else large).append(more)
+        # whatever is left is 1 up to rounding, and keeps the defaults
+
+        self.item_array = numpy.array(self.items, dtype=object)
+        self.probability_array = numpy.array(self.probabilities)
+        self.alias_array = numpy.array(self.aliases)
+
+    # draw one item with rng (the random module or a random.Random)
+    def sample(self, rng = random):
+        u = rng.random() * len(self.items)
+        i = int(u)
+        return self.items[i] if u - i < self.probabilities[i] else self.items[self.aliases[i]]
+
+    # draw n items with numpy's random number generator
+    def sample_batch(self, n):
+        u = numpy.random.random(n) * len(self.items)
+        columns = u.astype(numpy.int64)
+        indices = numpy.where(u - columns < self.probability_array[columns], columns, self.alias_array[columns])
+        return self.item_array[indices].tolist()
+
+
 #@todo: we shouldnt repeat the word generator in the class methods
 class MovRGenerator:
+    # number of distinct fake strings (names, addresses, ...) generated with faker for the batch generators.
+    # Pools are built the first time they are used and then sampled with numpy, which is orders of magnitude faster
+    # than calling faker for every row.
+    POOL_SIZE = 5000
+    pools = {}
+    pools_mutex = threading.Lock()
+    # set with seed() to make the fake strings of the pools, and every single value generator, reproducible
+    pool_seed = None
+    # random.Random of the current thread or asyncio task once seed() has been called, None otherwise.
+    # Each tick of a worker draws from its own generator, seeded from the worker's.
+    worker_random = contextvars.ContextVar("worker_random", default=None)
+    tick_random = contextvars.ContextVar("tick_random", default=None)
+
+    vehicle_types = AliasSampler(['skateboard', 'bike', 'scooter'])
+    vehicle_availabilities = AliasSampler(["available", "in_use", "lost"], [.4, .55, .05])
+    colors = AliasSampler(['red', 'yellow', 'blue', 'green', 'black'])
+    bike_brands = AliasSampler(['Merida','Fuji'
+        'Cervelo', 'Pinarello',
+        'Santa Cruz', 'Kona', 'Schwinn'])
+    # samplers compiled by weighted_choice, by their items
+    weighted_choice_samplers = {}
+
+    # make the values generated by the current thread or asyncio task a deterministic function of seed and worker
+    @staticmethod
+    def seed(seed, worker):
+        MovRGenerator.pool_seed = seed
+        MovRGenerator.worker_random.set(random.Random("%s-%s" % (seed, worker)))
+        MovRGenerator.next_tick()
+
+    # start a new tick of a seeded worker, so the number of values one tick generates (which can depend on state
+    # shared with other workers) never shifts the values of the next one
+    @staticmethod
+    def next_tick():
+        rng = MovRGenerator.worker_random.get()
+        if rng is not None:
+            MovRGenerator.tick_random.set(random.Random(rng.getrandbits(64)))
+
+    # the random number generator single value generators draw from: the worker's own when seeded, the global one otherwise
+    @staticmethod
+    def get_random():
+        rng = MovRGenerator.tick_random.get()
+        return random if rng is None else rng
+
+    # ids are never seeded, so repeated runs against the same database don't collide
     @staticmethod
     def generate_uuid():
         return str(uuid.uuid4())
 
     @staticmethod
     def generate_revenue():
-        return random.uniform(1,100)
+        return MovRGenerator.get_random().uniform(1,100)
 
     @staticmethod
     def generate_random_vehicle():
-        return random.choice(['skateboard', 'bike', 'scooter'])
+        return MovRGenerator.vehicle_types.sample(MovRGenerator.get_random())
 
     @staticmethod
     def get_vehicle_availability():
-        return MovRGenerator.weighted_choice([("available", .4), ("in_use", .55), ("lost", .05)])
+        return MovRGenerator.vehicle_availabilities.sample(MovRGenerator.get_random())
 
     @staticmethod
     def generate_random_color():
-        return random.choice(['red', 'yellow', 'blue', 'green', 'black'])
+        return MovRGenerator.colors.sample(MovRGenerator.get_random())
 
     @staticmethod
     def generate_random_latlong():
-        return {'lat': random.uniform(-180, 180), 'long': random.uniform(-90, 90)}
+        rng = MovRGenerator.get_random()
+        return {'lat': rng.uniform(-180, 180), 'long': rng.uniform(-90, 90)}
 
 
     @staticmethod
     def gen_bike_brand():
-        return random.choice(['Merida','Fuji'
-        'Cervelo', 'Pinarello',
-        'Santa Cruz', 'Kona', 'Schwinn'])
+        return MovRGenerator.bike_brands.sample(MovRGenerator.get_random())
 
     @staticmethod
     def generate_vehicle_metadata(type):
@@ -46,10 +135,145 @@ class MovRGenerator:
     @staticmethod
     def weighted_choice(items):
         """items is a list of tuples in the form (item, weight)"""
-        weight_total = sum((item[1] for item in items))
-        n = random.uniform(0, weight_total)
-        for item, weight in items:
-            if n < weight:
-                return item
-            n = n - weight
-        return item
\ No newline at end of file
+        key = tuple(items)
+        sampler = MovRGenerator.weighted_choice_samplers.get(key)
+        if sampler is None:
+            sampler = MovRGenerator.weighted_choice_samplers[key] = \
+                AliasSampler([item for item, _ in items], [weight for _, weight in items])
+        return sampler.sample(MovRGenerator.get_random())
+
+    ##################
+    # BATCH GENERATORS
+    #################
+
+    @staticmethod
+    def get_pool(name, factory):
+        pool = MovRGenerator.pools.get(name)
+        if pool is None:
+            MovRGenerator.pools_mutex.acquire()
+            try:
+                pool = MovRGenerator.pools.get(name)
+                if pool is None:
+                    datagen = Faker()
+                    if MovRGenerator.pool_seed is not None:
+                        datagen.seed_instance("%s-%s" % (MovRGenerator.pool_seed, name))
+                    pool = numpy.array([factory(datagen) for _ in range(MovRGenerator.POOL_SIZE)], dtype=object)
+                    MovRGenerator.pools[name] = pool
+            finally:
+                MovRGenerator.pools_mutex.release()
+        return pool
+
+    @staticmethod
+    def sample_pool(name, factory, n):
+        pool = MovRGenerator.get_pool(name, factory)
+        return pool[numpy.random.randint(0, len(pool), n)].tolist()
+
+    # draw a single value from a pool with the worker's random number generator
+    @staticmethod
+    def sample_pool_value(name, factory):
+        pool = MovRGenerator.get_pool(name, factory)
+        return pool[MovRGenerator.get_random().randrange(len(pool))]
+
+    @staticmethod
+    def generate_name():
+        return MovRGenerator.sample_pool_value("name", lambda datagen: datagen.name())
+
+    @staticmethod
+    def generate_address():
+        return MovRGenerator.sample_pool_value("address", lambda datagen: datagen.address())
+
+    @staticmethod
+    def generate_credit_card_number():
+        return MovRGenerator.sample_pool_value("credit_card", lambda datagen: datagen.credit_card_number())
+
+    @staticmethod
+    def generate_paragraph():
+        return MovRGenerator.sample_pool_value("paragraph", lambda datagen: datagen.paragraph())
+
+    @staticmethod
+    def generate_promo_code():
+        words = MovRGenerator.sample_pool_value("promo_code_words", lambda datagen: "_".join(datagen.words(nb=3)))
+        return words + "_" + MovRGenerator.generate_uuid().replace("-", "")
+
+    @staticmethod
+    def generate_uuid_batch(n):
+        # set the version and variant bits of random bytes, the same way uuid.uuid4() does
+        raw = numpy.frombuffer(os.urandom(16 * n), dtype=numpy.uint8).reshape(n, 16).copy()
+        raw[:, 6] = (raw[:, 6] & 0x0f) | 0x40
+        raw[:, 8] = (raw[:, 8] & 0x3f) | 0x80
+        return MovRGenerator.format_uuid_bytes(raw.tobytes())
+
+    # format concatenated 16 byte uuids as a list of uuid strings
+    @staticmethod
+    def format_uuid_bytes(raw):
+        hexed = raw.hex()
+        uuids = []
+        for offset in range(0, len(hexed), 32):
+            h = hexed[offset:offset + 32]
+            uuids.append(h[0:8] + "-" + h[8:12] + "-" + h[12:16] + "-" + h[16:20] + "-" + h[20:32])
+        return uuids
+
+    @staticmethod
+    def generate_name_batch(n):
+        return MovRGenerator.sample_pool("name", lambda datagen: datagen.name(), n)
+
+    @staticmethod
+    def generate_address_batch(n):
+        return MovRGenerator.sample_pool("address", lambda datagen: datagen.address(), n)
+
+    @staticmethod
+    def generate_credit_card_number_batch(n):
+        return MovRGenerator.sample_pool("credit_card", lambda datagen: datagen.credit_card_number(), n)
+
+    @staticmethod
+    def generate_paragraph_batch(n):
+        return MovRGenerator.sample_pool("paragraph", lambda datagen: datagen.paragraph(), n)
+
+    # codes are three random words followed by a random suffix, so codes generated in the same batch never collide
+    @staticmethod
+    def generate_promo_code_batch(n):
+        words = MovRGenerator.sample_pool("promo_code_words", lambda datagen: "_".join(datagen.words(nb=3)), n)
+        return [w + "_" + u.replace("-", "") for w, u in zip(words, MovRGenerator.generate_uuid_batch(n))]
+
+    @staticmethod
+    def generate_revenue_batch(n):
+        return numpy.random.uniform(1, 100, n).tolist()
+
+    @staticmethod
+    def generate_random_vehicle_batch(n):
+        return MovRGenerator.vehicle_types.sample_batch(n)
+
+    @staticmethod
+    def get_vehicle_availability_batch(n):
+        return MovRGenerator.vehicle_availabilities.sample_batch(n)
+
+    @staticmethod
+    def generate_vehicle_metadata_batch(types):
+        n = len(types)
+        colors = MovRGenerator.colors.sample_batch(n)
+        brands = MovRGenerator.bike_brands.sample_batch(n)
+        metadata = []
+        for type, color, brand in zip(types, colors, brands):
+            metadata.append({'color': color, 'brand': brand} if type == 'bike' else {'color': color})
+        return metadata
+
+    # returns a list of latitudes and a list of longitudes
+    @staticmethod
+    def generate_random_latlong_batch(n):
+        return numpy.random.uniform(-180, 180, n).tolist(), numpy.random.uniform(-90, 90, n).tolist()
+
+    # start times within the last 30 days, and end times up to an hour after them
+    @staticmethod
+    def generate_ride_times_batch(n):
+        now = datetime.datetime.now()
+        start_offsets = numpy.random.randint(0, 31, n).tolist()
+        durations = numpy.random.randint(0, 61, n).tolist()
+        start_times = [now - datetime.timedelta(days=days) for days in start_offsets]
+        end_times = [start + datetime.timedelta(minutes=minutes) for start, minutes in zip(start_times, durations)]
+        return start_times, end_times
+
+    # expiration times up to 30 days from now
+    @staticmethod
+    def generate_expiration_time_batch(n):
+        now = datetime.datetime.now()
+        return [now + datetime.timedelta(days=days) for days in numpy.random.randint(0, 31, n).tolist()]
@@ -1,27 +1,43 @@
 #!/usr/bin/python
 
-from movr import MovR
-from generators import MovRGenerator
+from movr import MovR, ACTION_POOL_CHECKOUT, FOLLOWER_READ_STALENESS, pop_transaction_attempts, get_as_of_system_time, \
+    get_transaction_attempts
+from generators import MovRGenerator, AliasSampler
 import argparse
-import sys, os, time, datetime, random, math, signal, threading, re
+import sys, os, time, datetime, random, math, signal, threading, re, asyncio, queue, atexit
 import logging
-from faker import Faker
-from models import User, Vehicle, Ride, VehicleLocationHistory, PromoCode
-from cockroachdb.sqlalchemy import run_transaction
-from sqlalchemy.orm import sessionmaker
-from sqlalchemy import create_engine
+import numpy
 from urllib.parse import parse_qs, urlsplit, urlunsplit, urlencode
-from movr_stats import MovRStats
+from movr_stats import MovRStats, STATS_GROUPS, OTHER_REGION
+from movr_pools import IdPool, EntityPool
+from movr_memory import MemoryMovR, AsyncMemoryMovR, is_memory_url
+from movr_partition import DEFAULT_PARTITION_WORKERS, STATUS_FAILED, STATUS_DEPENDENCY_FAILED
+from movr_metrics import StatsOutputWriter, MetricsServer, STATS_OUTPUT_FORMATS
+from movr_trace import TraceWriter, TraceIdMap, read_trace, get_created_id, TRACE_TIMINGS, TRACE_TIMING_ORIGINAL
+from movr_loader import write_rows, write_checkpoint, ChunkSizer, LoaderPipeline, LoaderBatch, LOADER_BACKENDS, \
+    LOADER_BACKEND_ORM, LOADER_TABLES, DEFAULT_MIN_CHUNK_SIZE, DEFAULT_MAX_CHUNK_SIZE, LOAD_MODE_RESUME, LOAD_MODE_GROW, \
+    PROMO_CODE_CITY, create_checkpoint_table, get_checkpointed_rows, count_loaded_rows, read_loaded_ids
 from tabulate import tabulate
 
 
 RUNNING_THREADS = []
 TERMINATE_GRACEFULLY = False
 DEFAULT_READ_PERCENTAGE = .95
+DEFAULT_STATS_INTERVAL = 15
+
+# set up by main when the run command asks for --stats-output or --metrics-port
+stats_output = None
+metrics_server = None
+# picks the rows the loader writes per transaction; run_data_loader replaces it when chunk sizes are adaptive
+chunk_sizer = ChunkSizer()
+# set by main for --url memory://, where the throughput of a run is the most the client can generate
+MEMORY_BACKEND = False
 
 ACTION_ADD_VEHICLE = "add vehicle"
 ACTION_GET_VEHICLES = "get vehicles"
+ACTION_GET_STALE_VEHICLES = "get vehicles (stale)"
 ACTION_UPDATE_RIDE_LOC = "log ride location"
+ACTION_UPDATE_RIDE_LOCS = "log ride locations (batch)"
 ACTION_NEW_CODE = "new promo code"
 ACTION_APPLY_CODE = "apply promo code"
 ACTION_NEW_USER = "new user"
@@ -33,6 +49,8 @@ def signal_handler(sig, frame):
     grace_period = 15
     logging.info('Waiting at most %d seconds for threads to shutdown...', grace_period)
     TERMINATE_GRACEFULLY = True
+    if metrics_server:
+        metrics_server.stop()
 
     start = time.time()
     while threading.active_count() > 1:
@@ -43,6 +61,8 @@ def signal_handler(sig, frame):
             time.sleep(.1)
 
     logging.info("shutting down gracefully.")
+    stats.print_cumulative_stats()
+    print_client_throughput_ceiling(cumulative=True)
     sys.exit(0)
 
 
@@ -53,123 +73,318 @@ DEFAULT_PARTITION_MAP = {
     "eu_west": ["amsterdam", "paris", "rome"]
 }
 
-# Create a connection to the movr database and populate a set of cities with rides, vehicles, and users.
-def load_movr_data(conn_string, num_users, num_vehicles, num_rides, num_histories, num_promo_codes_per_thread, cities, echo_sql = False):
+# Use a shared MovR connection to populate a set of cities with rides, vehicles, and users. When resuming a load,
+# loaded_rows holds the rows each table already has per city (see movr_loader), so only the rest is generated, and
+# existing_ids the ids read back for the tables the rest references (see get_existing_id_pools).
+def load_movr_data(movr, num_users, num_vehicles, num_rides, num_histories, num_promo_codes_per_thread, cities,
+                   backend = LOADER_BACKEND_ORM, loaded_rows = {}, existing_ids = {}):
     if num_users <= 0 or num_rides <= 0 or num_vehicles <= 0:
         raise ValueError("The number of objects to generate must be > 0")
 
+    def get_ids(ids, city, table):
+        if table in existing_ids.get(city, {}):
+            ids.merge(existing_ids[city][table])
+        return ids
+
     start_time = time.time()
-    with MovR(conn_string, echo=echo_sql) as movr:
-        engine = create_engine(conn_string, convert_unicode=True, echo=echo_sql)
-        for city in cities:
-            if TERMINATE_GRACEFULLY:
-                logging.debug("terminating")
-                break
-
-            logging.info("Generating user data for %s...", city)
-            add_users(engine, num_users, city)
-            logging.info("Generating vehicle data for %s...", city)
-            add_vehicles(engine, num_vehicles, city)
-            logging.info("Generating ride data for %s...", city)
-            add_rides(engine, num_rides, city)
-            logging.info("Generating location history data for %s...", city)
-            add_vehicle_location_histories(engine, num_histories, city)
-            logging.info("populated %s in %f seconds",
-                  city, time.time() - start_time)
-
-        logging.info("Generating %s promo codes...", num_promo_codes_per_thread)
-        add_promo_codes(engine, num_promo_codes_per_thread)
+    for city in cities:
+        if TERMINATE_GRACEFULLY:
+            logging.debug("terminating")
+            break
+
+        def missing(table, num_rows):
+            return max(num_rows - loaded_rows.get((city, table), 0), 0)
+
+        # the ids generated for each stage are kept in memory and handed to the stages that reference them,
+        # so nothing is ever read back from the database (unless they were loaded by an earlier, interrupted load).
+        logging.info("Generating user data for %s...", city)
+        user_ids = get_ids(add_users(movr, missing("users", num_users), city, backend), city, "users")
+        logging.info("Generating vehicle data for %s...", city)
+        vehicle_ids = get_ids(add_vehicles(movr, missing("vehicles", num_vehicles), city, user_ids, backend),
+                              city, "vehicles")
+        logging.info("Generating ride data for %s...", city)
+        ride_ids = get_ids(add_rides(movr, missing("rides", num_rides), city, user_ids, vehicle_ids, backend),
+                           city, "rides")
+        logging.info("Generating location history data for %s...", city)
+        add_vehicle_location_histories(movr, missing("vehicle_location_histories", num_histories), city, ride_ids,
+                                       backend)
+        logging.info("populated %s in %f seconds",
+              city, time.time() - start_time)
+
+    logging.info("Generating %s promo codes...", num_promo_codes_per_thread)
+    add_promo_codes(movr, num_promo_codes_per_thread, backend)
 
     return
 
-# Generates evenly distributed load among the provided cities
-
-
-def simulate_movr_load(conn_string, cities, movr_objects, active_rides, read_percentage, echo_sql = False):
-
-    datagen = Faker()
-
-    with MovR(conn_string, echo=echo_sql) as movr:
-        while True:
-
-            if TERMINATE_GRACEFULLY:
-                logging.debug("Terminating thread.")
-                return
+# share of the writes each write action gets: a new promo code 3% of the time, and of the rest applying a code 10%,
+# a signup 30% of the rest after that, adding a vehicle 10% of the rest after that, and starting and ending rides half
+# of what's left each.
+WRITE_ACTION_WEIGHTS = [
+    (ACTION_NEW_CODE, .03),
+    (ACTION_APPLY_CODE, .97 * .1),
+    (ACTION_NEW_USER, .97 * .9 * .3),
+    (ACTION_ADD_VEHICLE, .97 * .9 * .7 * .1),
+    (ACTION_START_RIDE, .97 * .9 * .7 * .9 * .5),
+    (ACTION_END_RIDE, .97 * .9 * .7 * .9 * .5)
+]
+
+# samplers of the operation mix, by read and stale read percentage
+OPERATION_SAMPLERS = {}
+
+# the action a tick starts with, drawn from a single sampler compiled once for each operation mix
+def get_operation_sampler(read_percentage, stale_read_percentage):
+    key = (read_percentage, stale_read_percentage)
+    sampler = OPERATION_SAMPLERS.get(key)
+    if sampler is None:
+        weights = [(ACTION_GET_VEHICLES, read_percentage * (1 - stale_read_percentage)),
+                   (ACTION_GET_STALE_VEHICLES, read_percentage * stale_read_percentage)]
+        weights += [(action, (1 - read_percentage) * weight) for action, weight in WRITE_ACTION_WEIGHTS]
+        sampler = OPERATION_SAMPLERS[key] = AliasSampler([action for action, _ in weights],
+                                                         [weight for _, weight in weights])
+    return sampler
+
+# Decide what a simulated user does next. Returns the operations to issue, in order, as
+# (action, MovR method name, keyword arguments) tuples. Generates evenly distributed load among the provided cities.
+# stale_read_percentage of the home screen loads read vehicles AS OF SYSTEM TIME, from the nearest replica.
+def plan_operations(cities, entities, read_percentage, batch_location_updates = False, stale_read_percentage = 0):
+    MovRGenerator.next_tick()
+    rng = MovRGenerator.get_random()
+    operations = []
+    active_city = rng.choice(cities)
+    action = get_operation_sampler(read_percentage, stale_read_percentage).sample(rng)
+
+    if action == ACTION_GET_STALE_VEHICLES:
+        # simulate user loading screen, served by the nearest replica
+        operations.append((ACTION_GET_STALE_VEHICLES, "get_stale_vehicles", {"city": active_city, "limit": 25}))
+    elif action == ACTION_GET_VEHICLES:
+        # simulate user loading screen
+        operations.append((ACTION_GET_VEHICLES, "get_vehicles", {"city": active_city, "limit": 25}))
 
-            active_city = random.choice(cities)
+    else:
 
-            if random.random() < read_percentage:
-                # simulate user loading screen
-                start = time.time()
-                movr.get_vehicles(active_city,25)
-                stats.add_latency_measurement("get vehicles",time.time() - start )
+        #do write operations randomly
+        if action == ACTION_NEW_CODE:
+            # simulate a movr marketer creating a new promo code
+            operations.append((ACTION_NEW_CODE, "create_promo_code", {
+                "code": MovRGenerator.generate_promo_code(),
+                "description": MovRGenerator.generate_paragraph(),
+                "expiration_time": datetime.datetime.now() + datetime.timedelta(days=rng.randint(0, 30)),
+                "rules": {"type": "percent_discount", "value": "10%"}}))
+
+        elif action == ACTION_APPLY_CODE:
+            # simulate a user applying a promo code to her account
+            promo_code = entities.sample_promo_code(rng)
+            if promo_code is not None:
+                operations.append((ACTION_APPLY_CODE, "apply_promo_code", {
+                    "user_city": active_city,
+                    "user_id": entities.sample_user(active_city, rng),
+                    "promo_code": promo_code}))
+
+        elif action == ACTION_NEW_USER:
+            # simulate new signup
+            operations.append((ACTION_NEW_USER, "add_user", {
+                "city": active_city,
+                "name": MovRGenerator.generate_name(),
+                "address": MovRGenerator.generate_address(),
+                "credit_card_number": MovRGenerator.generate_credit_card_number()}))
+
+        elif action == ACTION_ADD_VEHICLE:
+            # simulate a user adding a new vehicle to the population
+            vehicle_type = MovRGenerator.generate_random_vehicle()
+            operations.append((ACTION_ADD_VEHICLE, "add_vehicle", {
+                "city": active_city,
+                "owner_id": entities.sample_user(active_city, rng),
+                "type": vehicle_type,
+                "vehicle_metadata": MovRGenerator.generate_vehicle_metadata(vehicle_type),
+                "status": MovRGenerator.get_vehicle_availability(),
+                "current_location": MovRGenerator.generate_address()}))
+
+        elif action == ACTION_START_RIDE:
+            # simulate a user starting a ride
+            operations.append((ACTION_START_RIDE, "start_ride", {
+                "city": active_city,
+                "rider_id": entities.sample_user(active_city, rng),
+                "vehicle_id": entities.sample_vehicle(active_city, rng)}))
 
-            else:
+        else:
+            ride_id = entities.pop_ride(active_city)
+            if ride_id is not None:
+                #simulate a ride ending
+                operations.append((ACTION_END_RIDE, "end_ride", {"city": active_city, "ride_id": ride_id}))
+
+        # every write tick, simulate the various vehicles updating their locations if they are being used for rides.
+        # Generated after the write is picked, since the number of active rides is shared by every thread.
+        locations = []
+        for ride_id in entities.get_rides(active_city, 10):
+            latlong = MovRGenerator.generate_random_latlong()
+            locations.append({'city': active_city, 'ride_id': ride_id, 'lat': latlong['lat'],
+                              'long': latlong['long']})
 
-                # every write tick, simulate the various vehicles updating their locations if they are being used for rides
-                for ride in active_rides[0:10]:
-
-                    latlong = MovRGenerator.generate_random_latlong()
-                    start = time.time()
-                    movr.update_ride_location(ride['city'], ride_id=ride['id'], lat=latlong['lat'],
-                                              long=latlong['long'])
-                    stats.add_latency_measurement(ACTION_UPDATE_RIDE_LOC, time.time() - start)
-
-
-                #do write operations randomly
-                if random.random() < .03:
-                    # simulate a movr marketer creating a new promo code
-                    start = time.time()
-                    promo_code = movr.create_promo_code(
-                        code="_".join(datagen.words(nb=3)) + "_" + str(time.time()),
-                        description=datagen.paragraph(),
-                        expiration_time=datetime.datetime.now() + datetime.timedelta(
-                            days=random.randint(0, 30)),
-                        rules={"type": "percent_discount", "value": "10%"})
-                    stats.add_latency_measurement(ACTION_NEW_CODE, time.time() - start)
-                    movr_objects["global"].get("promo_codes", []).append(promo_code)
-
-
-                elif random.random() < .1:
-                    # simulate a user applying a promo code to her account
-                    start = time.time()
-                    movr.apply_promo_code(active_city, random.choice(movr_objects["local"][active_city]["users"])['id'],
-                        random.choice(movr_objects["global"]["promo_codes"]))
-                    stats.add_latency_measurement(ACTION_APPLY_CODE, time.time() - start)
-                elif random.random() < .3:
-                    # simulate new signup
-                    start = time.time()
-                    new_user = movr.add_user(active_city, datagen.name(), datagen.address(), datagen.credit_card_number())
-                    stats.add_latency_measurement(ACTION_NEW_USER, time.time() - start)
-                    movr_objects["local"][active_city]["users"].append(new_user)
-
-                elif random.random() < .1:
-                    # simulate a user adding a new vehicle to the population
-                    start = time.time()
-                    new_vehicle = movr.add_vehicle(active_city,
-                                        owner_id = random.choice(movr_objects["local"][active_city]["users"])['id'],
-                                        type = MovRGenerator.generate_random_vehicle(),
-                                        vehicle_metadata = MovRGenerator.generate_vehicle_metadata(type),
-                                        status=MovRGenerator.get_vehicle_availability(),
-                                        current_location = datagen.address())
-                    stats.add_latency_measurement(ACTION_ADD_VEHICLE, time.time() - start)
-                    movr_objects["local"][active_city]["vehicles"].append(new_vehicle)
-
-                elif random.random() < .5:
-                    # simulate a user starting a ride
-                    start = time.time()
-                    ride = movr.start_ride(active_city, random.choice(movr_objects["local"][active_city]["users"])['id'],
-                                           random.choice(movr_objects["local"][active_city]["vehicles"])['id'])
-                    stats.add_latency_measurement(ACTION_START_RIDE, time.time() - start)
-                    active_rides.append(ride)
-
-                else:
-                    if len(active_rides):
-                        #simulate a ride ending
-                        ride = active_rides.pop()
-                        start = time.time()
-                        movr.end_ride(ride['city'], ride['id'])
-                        stats.add_latency_measurement(ACTION_END_RIDE, time.time() - start)
+        if batch_location_updates:
+            if len(locations):
+                operations.insert(0, (ACTION_UPDATE_RIDE_LOCS, "update_ride_locations", {"locations": locations}))
+        else:
+            operations[0:0] = [(ACTION_UPDATE_RIDE_LOC, "update_ride_location", location) for location in locations]
+
+    return operations
+
+# keep track of the objects created by an operation so later operations can use them
+def record_operation_result(action, result, entities):
+    if action == ACTION_NEW_CODE:
+        entities.add_promo_code(result)
+    elif action == ACTION_NEW_USER:
+        entities.add_user(result['city'], result['id'])
+    elif action == ACTION_ADD_VEHICLE:
+        entities.add_vehicle(result['city'], result['id'])
+    elif action == ACTION_START_RIDE:
+        entities.add_ride(result['city'], result['id'])
+
+# Fixed arrival schedule shared by every worker of an open-loop run: operation k is due at start + k / ops_per_second,
+# no matter how long earlier operations took. Workers that fall behind issue their overdue operations right away,
+# and their latency is still measured from the time the operation was due, so a slow cluster can't hide its queueing
+# delay by lowering the offered load (coordinated omission).
+class ArrivalSchedule:
+    def __init__(self, ops_per_second):
+        self.interval = 1.0 / ops_per_second
+        self.mutex = threading.Lock()
+        self.next_start = None
+
+    # claim the next slot of the schedule, returns the time.time() at which the operation should start
+    def next_start_time(self):
+        self.mutex.acquire()
+        try:
+            if self.next_start is None:
+                self.next_start = time.time()
+            start = self.next_start
+            self.next_start += self.interval
+            return start
+        finally:
+            self.mutex.release()
+
+# record the latency and transaction attempts of an operation issued at start (time.time()). For operations issued on a
+# schedule, latency is measured from intended_start and the time since start is recorded as service time.
+# city is the city the operation ran against, if any (see get_operation_city).
+def record_operation(action, start, intended_start = None, failed = False, city = None):
+    end = time.time()
+    if not failed:
+        if intended_start is None:
+            stats.add_latency_measurement(action, end - start, city=city)
+        else:
+            stats.add_latency_measurement(action, end - intended_start, end - start, city)
+    attempts = pop_transaction_attempts()
+    stats.add_transaction_attempts(action, attempts.transactions, attempts.attempts, attempts.retry_time, failed,
+                                   city)
+
+# the city the operation a MovR method is called with runs against, or None for promo codes, which aren't per city
+def get_operation_city(arguments):
+    if "city" in arguments:
+        return arguments["city"]
+    if "user_city" in arguments:
+        return arguments["user_city"]
+    if arguments.get("locations"):
+        return arguments["locations"][0]["city"]
+    return None
+
+# worker numbers the simulated user: with a seed, the operations it picks are a deterministic function of seed and worker.
+# Every issued operation is streamed to trace, if given.
+def simulate_movr_load(movr, cities, entities, read_percentage, batch_location_updates = False,
+                       schedule = None, worker = 0, seed = None, trace = None, stale_read_percentage = 0):
+
+    if seed is not None:
+        MovRGenerator.seed(seed, worker)
+
+    while True:
+
+        if TERMINATE_GRACEFULLY:
+            logging.debug("Terminating thread.")
+            return
+
+        for action, method, arguments in plan_operations(cities, entities, read_percentage, batch_location_updates,
+                                                         stale_read_percentage):
+            intended_start = None
+            if schedule is not None:
+                intended_start = schedule.next_start_time()
+                time.sleep(max(intended_start - time.time(), 0))
+            start = time.time()
+            try:
+                result = getattr(movr, method)(**arguments)
+            except Exception as e:
+                logging.warning("%s failed: %s", action, e)
+                record_operation(action, start, intended_start, True, get_operation_city(arguments))
+                continue
+            record_operation(action, start, intended_start, False, get_operation_city(arguments))
+            if trace:
+                trace.record(worker, start, action, method, arguments, result)
+            record_operation_result(action, result, entities)
+
+# asyncio version of simulate_movr_load, run as one task per simulated user
+async def simulate_movr_load_async(movr, cities, entities, read_percentage,
+                                   batch_location_updates = False, schedule = None, worker = 0, seed = None,
+                                   trace = None, stale_read_percentage = 0):
+
+    # every task runs in its own context, so this only seeds the random numbers of this simulated user
+    if seed is not None:
+        MovRGenerator.seed(seed, worker)
+    # and starts out with the transaction counters of the warm up, which must not be shared between tasks
+    pop_transaction_attempts()
+
+    while True:
+
+        if TERMINATE_GRACEFULLY:
+            return
+
+        for action, method, arguments in plan_operations(cities, entities, read_percentage, batch_location_updates,
+                                                         stale_read_percentage):
+            intended_start = None
+            if schedule is not None:
+                intended_start = schedule.next_start_time()
+                await asyncio.sleep(max(intended_start - time.time(), 0))
+            start = time.time()
+            try:
+                result = await getattr(movr, method)(**arguments)
+            except Exception as e:
+                logging.warning("%s failed: %s", action, e)
+                record_operation(action, start, intended_start, True, get_operation_city(arguments))
+                continue
+            record_operation(action, start, intended_start, False, get_operation_city(arguments))
+            if trace:
+                trace.record(worker, start, action, method, arguments, result)
+            record_operation_result(action, result, entities)
+
+# Replay the operations a thread is handed by run_trace_replay, until it is handed None. With a replay_start time,
+# every operation is issued at its original offset from the start of the recorded run and its latency is measured
+# from then; otherwise operations are issued back to back.
+def replay_trace_operations(movr, operations_queue, id_map, replay_start = None):
+
+    while not TERMINATE_GRACEFULLY:
+        try:
+            operation = operations_queue.get(timeout=.1)
+        except queue.Empty:
+            continue
+        if operation is None:
+            return
+
+        worker, offset, action, method, arguments, created_id = operation
+        new_id = None
+        try:
+            arguments = id_map.map_operation_arguments(method, arguments)
+            intended_start = None
+            if replay_start is not None:
+                intended_start = replay_start + offset
+                time.sleep(max(intended_start - time.time(), 0))
+            start = time.time()
+            try:
+                result = getattr(movr, method)(**arguments)
+            except Exception as e:
+                logging.warning("failed to replay %s: %s", action, e)
+                record_operation(action, start, intended_start, True, get_operation_city(arguments))
+                continue
+            record_operation(action, start, intended_start, False, get_operation_city(arguments))
+            if created_id is not None:
+                new_id = get_created_id(method, result)
+        finally:
+            if created_id is not None:
+                id_map.add(created_id, new_id)
 
 
 # creates a map of partions when given a list of pairs in the form <partition>:<city_id>.
@@ -239,7 +454,8 @@ def setup_parser():
     parser.add_argument('--app-name', dest='app_name', default='movr',
                         help='The name that can be used for filtering statements by client in the Admin UI.')
     parser.add_argument('--url', dest='conn_string', default='postgres://root@localhost:26257/movr?sslmode=disable',
-                        help="connection string to movr database. Default is 'postgres://root@localhost:26257/movr?sslmode=disable'")
+                        help="connection string to movr database. Default is 'postgres://root@localhost:26257/movr?sslmode=disable'. "
+                             "Use 'memory://' to run against an in-memory stand-in and measure the client-side throughput ceiling.")
 
     parser.add_argument('--echo-sql', dest='echo_sql', action='store_true',
                         help='set this if you want to print all executed SQL statements')
@@ -262,6 +478,35 @@ def setup_parser():
                              help='this will  load random data for each of the cities specified. Use this flag multiple times to add multiple cities.')
     load_parser.add_argument('--skip-init', dest='skip_reload_tables', action='store_true',
                              help='Keep existing tables and data when loading Movr tables')
+    load_parser.add_argument('--loader-backend', dest='loader_backend', choices=LOADER_BACKENDS, default=LOADER_BACKEND_ORM,
+                             help='How generated rows are written: ORM bulk saves (orm), SQLAlchemy Core executemany INSERTs (core) '
+                                  'or COPY FROM STDIN (copy). (default = orm)')
+    load_parser.add_argument('--workers', dest='workers', type=int, default=1,
+                             help='Generate and load data with this many processes instead of threads. Cities, and chunks of large cities, '
+                                  'are split across the processes and each process opens its own connection. (default = 1, use --num-threads threads)')
+    load_parser.add_argument('--pipeline', dest='pipeline', action='store_true',
+                             help='Stream rows from generator threads to writer threads through a bounded queue, so generating rows overlaps with writing them, '
+                                  'instead of generating and writing each chunk in turn in one thread per city.')
+    load_parser.add_argument('--generator-threads', dest='generator_threads', type=int, default=1,
+                             help='With --pipeline, the number of threads generating rows. Each generates the rows of one city at a time. (default = 1)')
+    load_parser.add_argument('--writer-threads', dest='writer_threads', type=int, default=4,
+                             help='With --pipeline, the number of threads writing rows, each with its own connection. (default = 4)')
+    load_parser.add_argument('--pipeline-queue-size', dest='pipeline_queue_size', type=int, default=8,
+                             help='With --pipeline, the most chunks of rows queued for the writers. Generators wait for the writers when it is full. (default = 8)')
+    load_parser.add_argument('--fixed-chunk-sizes', dest='adaptive_chunks', action='store_false',
+                             help='Write every table in chunks of the same, built-in number of rows, instead of tuning the rows per transaction of '
+                                  'each table to its commit latency, retries and row size.')
+    load_parser.add_argument('--min-chunk-size', dest='min_chunk_size', type=int, default=DEFAULT_MIN_CHUNK_SIZE,
+                             help='Fewest rows written in a single transaction when chunk sizes are tuned. (default = %d)' % DEFAULT_MIN_CHUNK_SIZE)
+    load_parser.add_argument('--max-chunk-size', dest='max_chunk_size', type=int, default=DEFAULT_MAX_CHUNK_SIZE,
+                             help='Most rows written in a single transaction when chunk sizes are tuned. (default = %d)' % DEFAULT_MAX_CHUNK_SIZE)
+    load_mode_group = load_parser.add_mutually_exclusive_group()
+    load_mode_group.add_argument('--resume', dest='load_mode', action='store_const', const=LOAD_MODE_RESUME,
+                                 help='Finish an interrupted load: keep the existing tables and only load the rows that the checkpoints '
+                                      'recorded with every chunk say are missing from the requested sizes. Run with the same sizes and cities as the interrupted load.')
+    load_mode_group.add_argument('--grow', dest='load_mode', action='store_const', const=LOAD_MODE_GROW,
+                                 help='Grow an existing dataset to the requested sizes: keep the existing tables, count the rows each city already has '
+                                      '(however they got there) and only load the difference.')
 
     ####################
     # PARTITION COMMANDS
@@ -275,6 +520,9 @@ def setup_parser():
                                   'Example: us_west:us-west1. Use this flag multiple times to add multiple zones.')
     load_parser.add_argument('--preview-queries', dest='preview_queries', action='store_true',
                              help='If this flag is set, movr will print the commands to partition the data, but will not actually run them.')
+    load_parser.add_argument('--partition-workers', dest='partition_workers', type=int, default=DEFAULT_PARTITION_WORKERS,
+                             help='Maximum number of partitioning statements to run at the same time. Statements that depend on each other '
+                                  '(a table\'s partitions before its zone configs) still run in order. (default = %d)' % DEFAULT_PARTITION_WORKERS)
 
     ###############
     # RUN COMMANDS
@@ -286,6 +534,60 @@ def setup_parser():
     run_parser.add_argument('--read-only-percentage', dest='read_percentage', type=float,
                             help='Value between 0-1 indicating how many simulated read-only home screen loads to perform as a percentage of overall activities',
                             default=.95)
+    run_parser.add_argument('--fast-path', dest='fast_path', action='store_true',
+                            help='Issue start ride, end ride and apply promo code as single round-trip statements (joined queries, '
+                                 'INSERT ... ON CONFLICT DO NOTHING and UPDATE ... RETURNING) instead of read-then-write ORM transactions.')
+    run_parser.add_argument('--concurrency', dest='concurrency', type=int, default=0,
+                            help='Simulate this many concurrent users with asyncio in a single process, instead of running one '
+                                 'thread per --num-threads. Requires asyncpg.')
+    run_parser.add_argument('--batch-location-updates', dest='batch_location_updates', action='store_true',
+                            help='Write the ride location updates of each write tick with a single multi-row INSERT instead of one transaction per ride.')
+    run_parser.add_argument('--stale-read-percentage', dest='stale_read_percentage', type=float, default=0,
+                            help='Value between 0-1 indicating how many of the home screen loads read vehicles AS OF SYSTEM TIME --read-staleness '
+                                 'ago, so they can be served by the nearest replica. They are reported separately as "%s". (default = 0)'
+                                 % ACTION_GET_STALE_VEHICLES)
+    run_parser.add_argument('--read-staleness', dest='read_staleness', default=FOLLOWER_READ_STALENESS,
+                            help="How far in the past stale reads read: '%s' for follower_read_timestamp(), or a duration like 10s. "
+                                 "(default = %s)" % (FOLLOWER_READ_STALENESS, FOLLOWER_READ_STALENESS))
+    run_parser.add_argument('--promo-code-cache-size', dest='promo_code_cache_size', type=int, default=0,
+                            help='Cache up to this many promo codes in memory for the promo code lookups of start ride and apply promo code. '
+                                 'Only the ORM transactions look codes up, so this has no effect with --fast-path or --concurrency. (default = 0, no cache)')
+    run_parser.add_argument('--promo-code-cache-ttl', dest='promo_code_cache_ttl', type=float, default=60,
+                            help='How many seconds a cached promo code is used before it is read again. (default = 60)')
+    run_parser.add_argument('--stats-interval', dest='stats_interval', type=float, default=DEFAULT_STATS_INTERVAL,
+                            help='Seconds between stats reports. (default = %d)' % DEFAULT_STATS_INTERVAL)
+    run_parser.add_argument('--stats-output', dest='stats_output',
+                            help='Also write every stats report to this file, one record per action. Written as CSV if the file name ends in .csv, and as JSON lines otherwise.')
+    run_parser.add_argument('--stats-output-format', dest='stats_output_format', choices=STATS_OUTPUT_FORMATS,
+                            help='Format of --stats-output, regardless of its file name.')
+    run_parser.add_argument('--metrics-port', dest='metrics_port', type=int, default=0,
+                            help='Serve the cumulative stats of the run in the OpenMetrics format on http://<metrics host>:<port>/metrics. (default = 0, no server)')
+    run_parser.add_argument('--metrics-host', dest='metrics_host', default='localhost',
+                            help='Address the metrics server listens on. (default = localhost)')
+    run_parser.add_argument('--stats-by', dest='stats_group', choices=STATS_GROUPS,
+                            help='Also report the stats of every action per city, or per region, in the stats reports, the --stats-output file '
+                                 'and on the metrics endpoint. Use region to check the locality of a partitioned database.')
+    run_parser.add_argument('--region-city-pair', dest='region_city_pair', action='append',
+                            help='Pairs in the form <region>:<city_id> of the regions --stats-by region rolls cities up into, as for the partition command. '
+                                 'Cities in no region are reported as "%s". (default = the default partitioning)' % OTHER_REGION)
+    run_parser.add_argument('--entity-pool-size', dest='entity_pool_size', type=int, default=EntityPool.DEFAULT_CAPACITY,
+                            help='How many users, vehicles and active rides per city, and promo codes, to keep in memory to pick from. '
+                                 'Objects created during the run replace the oldest ones. (default = %d)' % EntityPool.DEFAULT_CAPACITY)
+    run_parser.add_argument('--seed', dest='seed', type=int,
+                            help='Seed the random choices of every thread (or simulated user with --concurrency), so each of them picks '
+                                 'the same sequence of operations and arguments on every run.')
+    run_parser.add_argument('--record-trace', dest='record_trace',
+                            help='Stream every issued operation and its arguments to this gzipped trace file.')
+    run_parser.add_argument('--replay-trace', dest='replay_trace',
+                            help='Instead of generating load, re-issue the operations of a trace written by --record-trace, '
+                                 'spread over --num-threads threads.')
+    run_parser.add_argument('--replay-timing', dest='replay_timing', choices=TRACE_TIMINGS, default=TRACE_TIMING_ORIGINAL,
+                            help='Replay a trace at its original timing (original) or as fast as possible (fast). (default = original)')
+    run_parser.add_argument('--target-ops-per-sec', dest='target_ops_per_sec', type=float, default=0,
+                            help='Issue operations on a fixed schedule of this many operations per second across all threads (open loop), '
+                                 'instead of starting the next operation as soon as the last one finishes. Latencies are measured from '
+                                 'the time an operation was scheduled to start, with the time it actually took reported as service time. '
+                                 '(default = 0, closed loop)')
 
     return parser
 
@@ -293,132 +595,377 @@ def setup_parser():
 # BULK DATA LOADING
 ##############
 
-def add_rides(engine, num_rides, city):
-    chunk_size = 800
-    datagen = Faker()
-
-    def add_rides_helper(sess, chunk, n):
-        users = sess.query(User).filter_by(city=city).all()
-        vehicles = sess.query(Vehicle).filter_by(city=city).all()
-
-        rides = []
-        for i in range(chunk, min(chunk + chunk_size, num_rides)):
-            start_time = datetime.datetime.now() - datetime.timedelta(days=random.randint(0, 30))
-            rides.append(Ride(id=MovRGenerator.generate_uuid(),
-                              city=city,
-                              vehicle_city=city,
-                              rider_id=random.choice(users).id,
-                              vehicle_id=random.choice(vehicles).id,
-                              start_time=start_time,
-                              start_address=datagen.address(),
-                              end_address=datagen.address(),
-                              revenue=MovRGenerator.generate_revenue(),
-                              end_time=start_time + datetime.timedelta(minutes=random.randint(0, 60))))
-        sess.bulk_save_objects(rides)
-
-    for chunk in range(0, num_rides, chunk_size):
-        run_transaction(sessionmaker(bind=engine),
-                        lambda s: add_rides_helper(s, chunk, min(chunk + chunk_size, num_rides)))
-
-
-def add_promo_codes(engine, num_codes):
-    chunk_size = 800
-    datagen = Faker()
-
-    def add_codes_helper(sess, chunk, n):
-        codes = []
-        for i in range(chunk, min(chunk + chunk_size, num_codes)):
-            code = "_".join(datagen.words(nb=3)) + "_" + str(time.time())
-            codes.append(PromoCode(code = code,
-                                   description = datagen.paragraph(),
-                                   expiration_time = datetime.datetime.now() + datetime.timedelta(days=random.randint(0,30)),
-                                   rules = {"type": "percent_discount", "value": "10%"}))
-        sess.bulk_save_objects(codes)
-
-    for chunk in range(0, num_codes, chunk_size):
-        run_transaction(sessionmaker(bind=engine),
-                        lambda s: add_codes_helper(s, chunk, min(chunk + chunk_size, num_codes)))
-
-
-
-def add_vehicle_location_histories(engine, num_histories, city):
-    chunk_size = 5000
-
-    def add_vehicle_location_histories_helper(sess, chunk, n):
-        rides = sess.query(Ride).filter_by(city=city).all()
-
-        histories = []
-        for i in range(chunk, min(chunk + chunk_size, num_histories)):
-            latlong = MovRGenerator.generate_random_latlong()
-            histories.append(VehicleLocationHistory(
-                city=city,
-                ride_id=random.choice(rides).id,
-                lat=latlong["lat"],
-                long=latlong["long"]))
-
-        sess.bulk_save_objects(histories)
-
-    for chunk in range(0, num_histories, chunk_size):
-        run_transaction(sessionmaker(bind=engine),
-                        lambda s: add_vehicle_location_histories_helper(s, chunk, min(chunk + chunk_size, num_histories)))
-
-def add_users(engine, num_users, city):
-    chunk_size = 1000
-    datagen = Faker()
-
-    def add_users_helper(sess, chunk, n):
-        users = []
-        for i in range(chunk, n):
-            users.append(User(id=MovRGenerator.generate_uuid(),
-                              city=city,
-                              name=datagen.name(),
-                              address=datagen.address(),
-                              credit_card=datagen.credit_card_number()))
-        sess.bulk_save_objects(users)
-
-    for chunk in range(0, num_users, chunk_size):
-        run_transaction(sessionmaker(bind=engine),
-                        lambda s: add_users_helper(s, chunk, min(chunk + chunk_size, num_users)))
-
-def add_vehicles(engine, num_vehicles, city):
-    chunk_size = 1000
-    datagen = Faker()
-
-    def add_vehicles_helper(sess, chunk, n):
-        owners = sess.query(User).filter_by(city=city).all()
-        vehicles = []
-        for i in range(chunk, n):
-            vehicle_type = MovRGenerator.generate_random_vehicle()
-            vehicles.append(Vehicle(id=MovRGenerator.generate_uuid(),
-                                    type=vehicle_type,
-                                    city=city,
-                                    current_location=datagen.address(),
-                                    owner_id=(random.choice(owners)).id,
-                                    status=MovRGenerator.get_vehicle_availability(),
-                                    ext=MovRGenerator.generate_vehicle_metadata(vehicle_type)))
-        sess.bulk_save_objects(vehicles)
-
-    for chunk in range(0, num_vehicles, chunk_size):
-        run_transaction(sessionmaker(bind=engine),
-                        lambda s: add_vehicles_helper(s, chunk, min(chunk + chunk_size, num_vehicles)))
+##############
+# LOADER ROW BUILDERS
+# each returns count rows of a table as tuples in the order of its *_COLUMNS list
+##############
+
+def build_ride_rows(count, city, user_ids, vehicle_ids):
+    start_times, end_times = MovRGenerator.generate_ride_times_batch(count)
+    return list(zip(MovRGenerator.generate_uuid_batch(count),
+                    [city] * count,
+                    [city] * count,
+                    user_ids.sample_batch(count),
+                    vehicle_ids.sample_batch(count),
+                    MovRGenerator.generate_address_batch(count),
+                    MovRGenerator.generate_address_batch(count),
+                    start_times,
+                    end_times,
+                    MovRGenerator.generate_revenue_batch(count)))
+
+def build_promo_code_rows(count):
+    return list(zip(MovRGenerator.generate_promo_code_batch(count),
+                    MovRGenerator.generate_paragraph_batch(count),
+                    [datetime.datetime.now()] * count,
+                    MovRGenerator.generate_expiration_time_batch(count),
+                    [{"type": "percent_discount", "value": "10%"}] * count))
+
+# timestamps are part of the primary key, so every point gets its own, counting back a microsecond at a time from
+# start_time (now by default). Callers building several chunks of a city give each chunk its own range.
+def build_vehicle_location_history_rows(count, city, ride_ids, start_time = None):
+    lats, longs = MovRGenerator.generate_random_latlong_batch(count)
+    start_time = start_time or datetime.datetime.now()
+    return list(zip([city] * count,
+                    ride_ids.sample_batch(count),
+                    [start_time - datetime.timedelta(microseconds=i) for i in range(count)],
+                    lats,
+                    longs))
+
+def build_user_rows(count, city):
+    return list(zip(MovRGenerator.generate_uuid_batch(count),
+                    [city] * count,
+                    MovRGenerator.generate_name_batch(count),
+                    MovRGenerator.generate_address_batch(count),
+                    MovRGenerator.generate_credit_card_number_batch(count)))
+
+def build_vehicle_rows(count, city, owner_ids):
+    vehicle_types = MovRGenerator.generate_random_vehicle_batch(count)
+    return list(zip(MovRGenerator.generate_uuid_batch(count),
+                    [city] * count,
+                    vehicle_types,
+                    owner_ids.sample_batch(count),
+                    [datetime.datetime.now()] * count,
+                    MovRGenerator.get_vehicle_availability_batch(count),
+                    MovRGenerator.generate_address_batch(count),
+                    MovRGenerator.generate_vehicle_metadata_batch(vehicle_types)))
+
+
+# the tables whose ids are referenced by the rows of other tables
+LOADER_CITY_ID_TABLES = ["users", "vehicles", "rides"]
+
+# write a chunk of rows of a table for city, along with their checkpoint, in a single transaction, and let the chunk
+# sizer know how long it took
+def write_loader_chunk(movr, city, table, rows, backend):
+    model, columns = LOADER_TABLES[table]
+
+    def helper(sess):
+        write_rows(sess, model, columns, rows, backend)
+        write_checkpoint(sess, city, table, len(rows))
+
+    attempts = get_transaction_attempts()
+    attempts_before = attempts.attempts
+    start = time.time()
+    movr.run_transaction(helper)
+    chunk_sizer.record(table, rows, time.time() - start, attempts.attempts - attempts_before)
+
+# build and write the rows of a table in chunks sized by the chunk sizer. build(count) returns count rows.
+# Returns an IdPool with the ids of the new rows.
+def add_rows(movr, table, city, num_rows, build, backend):
+    ids = IdPool()
+    loaded = 0
+    while loaded < num_rows:
+        rows = build(min(chunk_sizer.get_chunk_size(table), num_rows - loaded))
+        write_loader_chunk(movr, city, table, rows, backend)
+        if table in LOADER_CITY_ID_TABLES:
+            ids.extend(row[0] for row in rows)
+        loaded += len(rows)
+    return ids
+
+# returns an IdPool with the ids of the new rides
+def add_rides(movr, num_rides, city, user_ids, vehicle_ids, backend = LOADER_BACKEND_ORM):
+    return add_rows(movr, "rides", city, num_rides,
+                    lambda count: build_ride_rows(count, city, user_ids, vehicle_ids), backend)
+
+def add_promo_codes(movr, num_codes, backend = LOADER_BACKEND_ORM):
+    add_rows(movr, "promo_codes", PROMO_CODE_CITY, num_codes, build_promo_code_rows, backend)
+
+# the timestamps of the new points count back from start_time (now by default), without overlapping between chunks
+def add_vehicle_location_histories(movr, num_histories, city, ride_ids, backend = LOADER_BACKEND_ORM, start_time = None):
+    start_time = start_time or datetime.datetime.now()
+    built = [0]
+
+    def build(count):
+        rows = build_vehicle_location_history_rows(count, city, ride_ids,
+                                                   start_time - datetime.timedelta(microseconds=built[0]))
+        built[0] += count
+        return rows
+
+    add_rows(movr, "vehicle_location_histories", city, num_histories, build, backend)
+
+# returns an IdPool with the ids of the new users
+def add_users(movr, num_users, city, backend = LOADER_BACKEND_ORM):
+    return add_rows(movr, "users", city, num_users, lambda count: build_user_rows(count, city), backend)
+
+# returns an IdPool with the ids of the new vehicles
+def add_vehicles(movr, num_vehicles, city, owner_ids, backend = LOADER_BACKEND_ORM):
+    return add_rows(movr, "vehicles", city, num_vehicles,
+                    lambda count: build_vehicle_rows(count, city, owner_ids), backend)
+
+##############
+# PROCESS POOL DATA LOADING
+##############
+
+# most rows a single process pool task generates, so large cities are split across processes
+ROWS_PER_LOADER_TASK = 50000
+
+# each loader table, along with the tables whose ids it needs
+LOADER_STAGES = [
+    ("users", []),
+    ("vehicles", ["users"]),
+    ("rides", ["users", "vehicles"]),
+    ("vehicle_location_histories", ["rides"])
+]
+
+# the MovR instance (and engine) owned by the current loader process
+LOADER_PROCESS_MOVR = None
+
+def request_termination(sig, frame):
+    global TERMINATE_GRACEFULLY
+    logging.info("finishing the running tasks before shutting down...")
+    TERMINATE_GRACEFULLY = True
+
+def init_loader_process(conn_string, echo_sql, adaptive_chunks, min_chunk_size, max_chunk_size):
+    global LOADER_PROCESS_MOVR, chunk_sizer
+    # the parent process handles ctrl + c and stops handing out tasks
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    # forked processes inherit the parent's random state
+    random.seed()
+    numpy.random.seed()
+    LOADER_PROCESS_MOVR = get_movr(conn_string, echo=echo_sql, pool_size=1, max_overflow=1)
+    # every process tunes its own chunk sizes
+    chunk_sizer = ChunkSizer(adaptive_chunks, min_chunk_size, max_chunk_size)
+
+# load rows of one table for a city in a loader process. Returns the ids of the new rows, if other tables need them.
+# The timestamps of location histories count back from start_time.
+def load_table_task(table, city, count, backend, id_pools, start_time = None):
+    start = time.time()
+    movr = LOADER_PROCESS_MOVR
+    ids = None
+    if table == "users":
+        ids = add_users(movr, count, city, backend)
+    elif table == "vehicles":
+        ids = add_vehicles(movr, count, city, id_pools["users"], backend)
+    elif table == "rides":
+        ids = add_rides(movr, count, city, id_pools["users"], id_pools["vehicles"], backend)
+    elif table == "vehicle_location_histories":
+        add_vehicle_location_histories(movr, count, city, id_pools["rides"], backend, start_time)
+    elif table == "promo_codes":
+        add_promo_codes(movr, count, backend)
+    else:
+        raise ValueError("unknown table '%s'" % table)
+    return ids, time.time() - start
+
+def split_rows(count, rows_per_task):
+    return [min(rows_per_task, count - offset) for offset in range(0, count, rows_per_task)]
+
+# split count rows of a table for one city into (rows, start time) tasks. The tasks run concurrently, so each
+# counts its location history timestamps back from its own point, one microsecond per row of the tasks before it,
+# to keep their (city, ride_id, timestamp) keys apart.
+def split_loader_tasks(count, rows_per_task, start_time):
+    tasks = []
+    offset = 0
+    for task_count in split_rows(count, rows_per_task):
+        tasks.append((task_count, start_time - datetime.timedelta(microseconds=offset)))
+        offset += task_count
+    return tasks
+
+# Load every city with a pool of processes, so row generation isn't serialized on the GIL. Each table of each city
+# is split into tasks of at most ROWS_PER_LOADER_TASK rows, and a table is started for a city as soon as the tables it
+# references are loaded for that city. loaded_rows and existing_ids are as for load_movr_data.
+def run_process_data_loader(conn_string, cities, rows_per_city, num_promo_codes, num_workers, echo_sql, backend,
+                            loaded_rows = {}, existing_ids = {}):
+    from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+
+    signal.signal(signal.SIGINT, request_termination)
+
+    def missing(table, city, num_rows):
+        return max(num_rows - loaded_rows.get((city, table), 0), 0)
+
+    totals = {}
+    for table, _ in LOADER_STAGES:
+        totals[table] = sum(missing(table, city, rows_per_city[table]) for city in cities)
+    totals["promo_codes"] = missing("promo_codes", PROMO_CODE_CITY, num_promo_codes)
+    loaded = {table: 0 for table in totals}
+    task_seconds = {table: 0.0 for table in totals}
+
+    id_pools = {city: dict(existing_ids.get(city, {})) for city in cities}
+    loaded_tables = {city: set() for city in cities}
+    remaining_tasks = {}
+    pending = {}
+
+    with ProcessPoolExecutor(max_workers=num_workers, initializer=init_loader_process,
+                             initargs=(conn_string, echo_sql, chunk_sizer.adaptive, chunk_sizer.min_size,
+                                       chunk_sizer.max_size)) as executor:
+
+        def submit_table(table, city, count):
+            tasks = split_loader_tasks(count, ROWS_PER_LOADER_TASK, datetime.datetime.now())
+            remaining_tasks[(table, city)] = len(tasks)
+            if not tasks:
+                # already loaded
+                if city is not None:
+                    finish_table(table, city)
+                return
+            dependencies = {dep: id_pools[city][dep] for dep in dict(LOADER_STAGES).get(table, [])}
+            for task_count, start_time in tasks:
+                future = executor.submit(load_table_task, table, city, task_count, backend, dependencies, start_time)
+                pending[future] = (table, city, task_count)
+
+        # start every table of this city whose references are now loaded
+        def finish_table(table, city):
+            loaded_tables[city].add(table)
+            for next_table, deps in LOADER_STAGES:
+                if (next_table, city) not in remaining_tasks and all(dep in loaded_tables[city] for dep in deps):
+                    submit_table(next_table, city, missing(next_table, city, rows_per_city[next_table]))
+
+            if all(t in loaded_tables[city] for t, _ in LOADER_STAGES):
+                # no other table references these ids anymore
+                id_pools[city] = {}
+
+        for city in cities:
+            submit_table("users", city, missing("users", city, rows_per_city["users"]))
+        submit_table("promo_codes", None, totals["promo_codes"])
+
+        while len(pending):
+            done, _ = wait(list(pending), timeout=1, return_when=FIRST_COMPLETED)
+
+            if TERMINATE_GRACEFULLY:
+                for future in pending:
+                    future.cancel()
+
+            for future in done:
+                table, city, count = pending.pop(future)
+                if future.cancelled():
+                    continue
+                ids, duration = future.result()
+
+                loaded[table] += count
+                task_seconds[table] += duration
+                logging.info("loaded %d of %d %s (%s)", loaded[table], totals[table], table, city or "all cities")
+
+                if city is None:
+                    continue
+                if ids is not None:
+                    id_pools[city].setdefault(table, IdPool()).merge(ids)
+                remaining_tasks[(table, city)] -= 1
+                if remaining_tasks[(table, city)] or TERMINATE_GRACEFULLY:
+                    continue
+                finish_table(table, city)
+
+    rows = []
+    for table in sorted(totals):
+        rows.append([table, loaded[table], round(task_seconds[table], 2),
+                     round(loaded[table] / task_seconds[table], 2) if task_seconds[table] else 0])
+    print(tabulate(rows, ["table", "rows", "process time(s)", "rows/second per process"]), "\n")
+
+##############
+# PIPELINED DATA LOADING
+##############
+
+# yield LoaderBatches with the rows missing from a city, in the order of LOADER_STAGES, or with the promo codes
+# missing for the task PROMO_CODE_CITY
+def generate_loader_batches(city, rows_to_load, existing_ids):
+    tables = LOADER_STAGES if city != PROMO_CODE_CITY else [("promo_codes", [])]
+
+    id_pools = {table: IdPool() for table in LOADER_CITY_ID_TABLES}
+    for table in existing_ids.get(city, {}):
+        id_pools[table].merge(existing_ids[city][table])
+
+    start_time = datetime.datetime.now()
+    for table, deps in tables:
+        loaded = 0
+        while loaded < rows_to_load[(city, table)]:
+            count = min(chunk_sizer.get_chunk_size(table), rows_to_load[(city, table)] - loaded)
+            if table == "users":
+                rows = build_user_rows(count, city)
+            elif table == "vehicles":
+                rows = build_vehicle_rows(count, city, id_pools["users"])
+            elif table == "rides":
+                rows = build_ride_rows(count, city, id_pools["users"], id_pools["vehicles"])
+            elif table == "vehicle_location_histories":
+                rows = build_vehicle_location_history_rows(count, city, id_pools["rides"],
+                                                           start_time - datetime.timedelta(microseconds=loaded))
+            else:
+                rows = build_promo_code_rows(count)
+            if table in LOADER_CITY_ID_TABLES:
+                id_pools[table].extend(row[0] for row in rows)
+            loaded += count
+            yield LoaderBatch((city, table), rows, [(city, dep) for dep in deps])
+
+# Load every city through a LoaderPipeline: num_generators threads build the rows while num_writers threads write
+# them with connections from the pool of movr, so generating a chunk overlaps with writing the ones before it.
+# loaded_rows and existing_ids are as for load_movr_data.
+def run_pipeline_data_loader(movr, cities, rows_per_city, num_promo_codes, num_generators, num_writers, queue_size,
+                             backend, loaded_rows = {}, existing_ids = {}):
+    rows_to_load = {}
+    for city in cities:
+        for table, _ in LOADER_STAGES:
+            rows_to_load[(city, table)] = max(rows_per_city[table] - loaded_rows.get((city, table), 0), 0)
+    rows_to_load[(PROMO_CODE_CITY, "promo_codes")] = \
+        max(num_promo_codes - loaded_rows.get((PROMO_CODE_CITY, "promo_codes"), 0), 0)
+
+    logging.info("loading with %d generator and %d writer threads, with up to %d chunks of rows queued between them",
+                 num_generators, num_writers, queue_size)
+    pipeline = LoaderPipeline(lambda city: generate_loader_batches(city, rows_to_load, existing_ids),
+                              lambda batch: write_loader_chunk(movr, batch.key[0], batch.key[1], batch.rows, backend),
+                              rows_to_load, num_generators, num_writers, queue_size, lambda: TERMINATE_GRACEFULLY)
+    try:
+        pipeline.run(cities + [PROMO_CODE_CITY])
+    finally:
+        print_pipeline_stats(pipeline)
+
+# rows/second is over the whole load; rows/busy second is per thread, while it wasn't waiting on the other stage
+def print_pipeline_stats(pipeline):
+    rows = []
+    for stage in pipeline.get_stage_stats():
+        rows.append([stage["stage"], stage["threads"], stage["batches"], stage["rows"],
+                     round(stage["busy time"], 2), round(stage["blocked time"], 2),
+                     round(stage["rows per second"], 2), round(stage["rows per busy second"], 2)])
+    print(tabulate(rows, ["stage", "threads", "chunks", "rows", "busy time(s)", "blocked time(s)", "rows/second",
+                          "rows/busy second"]), "\n")
+    logging.info("at most %d chunks were queued between the stages", pipeline.max_queued_batches)
+
+# ids of the loaded rows of every table that the rows still missing from a city reference, by city and table
+def get_existing_id_pools(movr, cities, rows_per_city, loaded_rows):
+    existing_ids = {}
+    for city in cities:
+        for table, deps in LOADER_STAGES:
+            if rows_per_city[table] <= loaded_rows.get((city, table), 0):
+                continue
+            for dep in deps:
+                if loaded_rows.get((city, dep), 0) and dep not in existing_ids.get(city, {}):
+                    existing_ids.setdefault(city, {})[dep] = IdPool(read_loaded_ids(movr, dep, city))
+    return existing_ids
 
 def run_data_loader(conn_string, cities, num_users, num_rides, num_vehicles, num_histories, num_promo_codes, num_threads,
-                    skip_reload_tables, echo_sql):
+                    skip_reload_tables, echo_sql, backend = LOADER_BACKEND_ORM, num_workers = 1, load_mode = None,
+                    pipeline = False, num_generators = 1, num_writers = 4, queue_size = 8, adaptive_chunks = False,
+                    min_chunk_size = DEFAULT_MIN_CHUNK_SIZE, max_chunk_size = DEFAULT_MAX_CHUNK_SIZE):
+    global chunk_sizer
     if num_users <= 0 or num_rides <= 0 or num_vehicles <= 0:
         raise ValueError("The number of objects to generate must be > 0")
 
     start_time = time.time()
+    chunk_sizer = ChunkSizer(adaptive_chunks, min_chunk_size, max_chunk_size)
 
-
-
-    with MovR(conn_string, init_tables=(not skip_reload_tables), echo=echo_sql) as movr:
-
-        logging.info("loading cities %s", cities)
-        logging.info("loading movr data with ~%d users, ~%d vehicles, ~%d rides, ~%d histories, and ~%d promo codes",
-                     num_users, num_vehicles, num_rides, num_histories, num_promo_codes)
+    logging.info("loading cities %s", cities)
+    logging.info("loading movr data with ~%d users, ~%d vehicles, ~%d rides, ~%d histories, and ~%d promo codes",
+                 num_users, num_vehicles, num_rides, num_histories, num_promo_codes)
 
     usable_threads = min(num_threads, len(cities))  # don't create more than 1 thread per city
-    if usable_threads < num_threads:
+    if pipeline:
+        # the writers are the threads that need a connection
+        usable_threads = num_writers
+    elif usable_threads < num_threads:
         logging.info("Only using %d of %d requested threads, since we only create at most one thread per city",
                      usable_threads, num_threads)
 
@@ -427,67 +974,339 @@ def run_data_loader(conn_string, cities, num_users, num_rides, num_vehicles, num
     num_rides_per_city = int(math.ceil((float(num_rides) / len(cities))))
     num_vehicles_per_city = int(math.ceil((float(num_vehicles) / len(cities))))
     num_histories_per_city = int(math.ceil((float(num_histories) / len(cities))))
-
-    num_promo_codes_per_thread = int(math.ceil((float(num_promo_codes) / usable_threads)))
+    rows_per_city = {"users": num_users_per_city, "vehicles": num_vehicles_per_city, "rides": num_rides_per_city,
+                     "vehicle_location_histories": num_histories_per_city}
 
     RUNNING_THREADS = []
 
 
     original_city_count = len(cities)
-    for i in range(usable_threads):
-        if len(cities) > 0:
-            t = threading.Thread(target=load_movr_data, args=(conn_string, num_users_per_city, num_vehicles_per_city,
-                                                              num_rides_per_city, num_histories_per_city, num_promo_codes_per_thread,
-                                                              cities[:cities_per_thread],
-                                                              echo_sql))
-            cities = cities[cities_per_thread:]
-            t.start()
-            RUNNING_THREADS.append(t)
-
-    while threading.active_count() > 1:  # keep main thread alive so we can catch ctrl + c
-        time.sleep(0.1)
+    # all loader threads share one engine, with a pool connection for each of them
+    with get_movr(conn_string, init_tables=(not skip_reload_tables and not load_mode), echo=echo_sql,
+              pool_size=usable_threads, max_overflow=usable_threads) as movr:
+        loaded_rows = {}
+        existing_ids = {}
+        if not is_memory_url(conn_string):
+            create_checkpoint_table(movr)
+        if load_mode == LOAD_MODE_RESUME:
+            loaded_rows = get_checkpointed_rows(movr)
+            if not loaded_rows:
+                logging.info("no load checkpoints found, loading everything")
+        elif load_mode == LOAD_MODE_GROW:
+            loaded_rows = count_loaded_rows(movr)
+        if loaded_rows:
+            print_loaded_rows(cities, rows_per_city, num_promo_codes, loaded_rows)
+            existing_ids = get_existing_id_pools(movr, cities, rows_per_city, loaded_rows)
+
+        num_promo_codes_to_load = max(num_promo_codes - loaded_rows.get((PROMO_CODE_CITY, "promo_codes"), 0), 0)
+        num_promo_codes_per_thread = int(math.ceil((float(num_promo_codes_to_load) / usable_threads)))
+        num_rows = num_promo_codes_to_load
+        for city in cities:
+            for table in rows_per_city:
+                num_rows += max(rows_per_city[table] - loaded_rows.get((city, table), 0), 0)
+
+        if pipeline:
+            run_pipeline_data_loader(movr, cities, rows_per_city, num_promo_codes, num_generators, num_writers,
+                                     queue_size, backend, loaded_rows, existing_ids)
+        elif num_workers > 1:
+            # every loader process opens its own engine
+            run_process_data_loader(conn_string, cities, rows_per_city, num_promo_codes, num_workers, echo_sql, backend,
+                                    loaded_rows, existing_ids)
+        else:
+            for i in range(usable_threads):
+                if len(cities) > 0:
+                    t = threading.Thread(target=load_movr_data, args=(movr, num_users_per_city, num_vehicles_per_city,
+                                                                      num_rides_per_city, num_histories_per_city, num_promo_codes_per_thread,
+                                                                      cities[:cities_per_thread], backend, loaded_rows,
+                                                                      existing_ids))
+                    cities = cities[cities_per_thread:]
+                    t.start()
+                    RUNNING_THREADS.append(t)
+
+            while threading.active_count() > 1:  # keep main thread alive so we can catch ctrl + c
+                time.sleep(0.1)
 
     duration = time.time() - start_time
 
-    logging.info("populated %s cities in %f seconds", original_city_count, duration)
+    print_chunk_sizes()
+    logging.info("populated %s cities in %f seconds (%.1f rows/second)", original_city_count, duration,
+                 num_rows / duration)
+    if is_memory_url(conn_string):
+        logging.info("with the in-memory backend, %.1f rows/second is the client-side throughput ceiling of the loader",
+                     num_rows / duration)
+
+# the chunk size the loader ended up with for every table, when chunk sizes are adaptive
+def print_chunk_sizes():
+    rows = []
+    chunk_stats = chunk_sizer.get_stats()
+    for table in sorted(chunk_stats):
+        table_stats = chunk_stats[table]
+        rows.append([table, table_stats["chunk size"], table_stats["chunks"], round(table_stats["ms per row"], 3),
+                     int(table_stats["bytes per row"]), round(table_stats["retry rate"] * 100, 2)])
+    if rows:
+        print(tabulate(rows, ["table", "chunk size", "chunks", "commit ms/row", "bytes/row", "retried(%)"]), "\n")
+
+# the rows each table of each city already has, and how many are missing from the requested sizes
+def print_loaded_rows(cities, rows_per_city, num_promo_codes, loaded_rows):
+    rows = []
+    for city in cities:
+        for table in rows_per_city:
+            loaded = loaded_rows.get((city, table), 0)
+            rows.append([city, table, loaded, max(rows_per_city[table] - loaded, 0)])
+    loaded = loaded_rows.get((PROMO_CODE_CITY, "promo_codes"), 0)
+    rows.append(["", "promo_codes", loaded, max(num_promo_codes - loaded, 0)])
+    print(tabulate(rows, ["city", "table", "loaded rows", "rows to load"]), "\n")
+
+# add the users, vehicles and active rides of a city read from the database to the entity pool
+def add_warm_up_entities(entities, city, users, vehicles, active_rides):
+    for user in users:
+        entities.add_user(city, user['id'])
+    for vehicle in vehicles:
+        entities.add_vehicle(city, vehicle['id'])
+    for ride in active_rides:
+        entities.add_ride(city, ride['id'])
 
 # generate fake load for objects within the provided city list
-def run_load_generator(conn_string, read_percentage, city_list, echo_sql, num_threads):
+def run_load_generator(conn_string, read_percentage, city_list, echo_sql, num_threads, fast_path = False,
+                       batch_location_updates = False, target_ops_per_sec = 0, seed = None, trace_path = None,
+                       entity_pool_size = EntityPool.DEFAULT_CAPACITY, stale_read_percentage = 0,
+                       read_staleness = FOLLOWER_READ_STALENESS, promo_code_cache_size = 0, promo_code_cache_ttl = 60,
+                       stats_interval = DEFAULT_STATS_INTERVAL):
     if read_percentage < 0 or read_percentage > 1:
         raise ValueError("read percentage must be between 0 and 1")
+    if stale_read_percentage < 0 or stale_read_percentage > 1:
+        raise ValueError("stale read percentage must be between 0 and 1")
+    if target_ops_per_sec < 0:
+        raise ValueError("target ops per second must not be negative")
 
 
     logging.info("simulating movr load for cities %s", city_list)
 
-    movr_objects = { "local": {}, "global": {}}
+    entities = EntityPool(city_list, entity_pool_size)
 
     logging.info("warming up....")
-    with MovR(conn_string, echo=echo_sql) as movr:
-        active_rides = []
+    # every load generating thread shares one engine, with a pool connection for each of them
+    with get_movr(conn_string, echo=echo_sql, pool_size=num_threads, max_overflow=num_threads, stats=stats,
+                  fast_path=fast_path, read_staleness=read_staleness, promo_code_cache_size=promo_code_cache_size,
+                  promo_code_cache_ttl=promo_code_cache_ttl) as movr:
+        if is_memory_url(conn_string):
+            populate_memory_movr(movr, city_list)
+
         for city in city_list:
-            movr_objects["local"][city] = {"users": movr.get_users(city), "vehicles": movr.get_vehicles(city)}
-            if len(list(movr_objects["local"][city]["vehicles"])) == 0 or len(list(movr_objects["local"][city]["users"])) == 0:
+            users = movr.get_users(city, limit=entity_pool_size)
+            vehicles = movr.get_vehicles(city, limit=entity_pool_size)
+            if len(vehicles) == 0 or len(users) == 0:
                 logging.error("must have users and vehicles for city '%s' in the movr database to generate load. try running with the 'load' command.", city)
                 sys.exit(1)
 
-            active_rides.extend(movr.get_active_rides(city))
-        movr_objects["global"]["promo_codes"] = movr.get_promo_codes()
-
-    RUNNING_THREADS = []
-    for i in range(num_threads):
-        t = threading.Thread(target=simulate_movr_load, args=(conn_string, city_list, movr_objects,
-                                                    active_rides, read_percentage, echo_sql ))
-        t.start()
-        RUNNING_THREADS.append(t)
+            add_warm_up_entities(entities, city, users, vehicles, movr.get_active_rides(city, limit=entity_pool_size))
+        entities.promo_codes.extend(movr.get_promo_codes(limit=entity_pool_size))
+        if metrics_server and movr.promo_code_cache:
+            metrics_server.add_cache("promo codes", movr.promo_code_cache)
+
+        schedule = ArrivalSchedule(target_ops_per_sec) if target_ops_per_sec else None
+        if schedule:
+            logging.info("issuing %s operations per second across %d threads", target_ops_per_sec, num_threads)
+
+        trace = None
+        if trace_path:
+            trace = TraceWriter(trace_path, {"cities": city_list, "read_percentage": read_percentage, "seed": seed,
+                                             "workers": num_threads})
+            atexit.register(trace.close)
+
+        RUNNING_THREADS = []
+        for i in range(num_threads):
+            t = threading.Thread(target=simulate_movr_load, args=(movr, city_list, entities, read_percentage,
+                                                                  batch_location_updates, schedule, i, seed, trace,
+                                                                  stale_read_percentage))
+            t.start()
+            RUNNING_THREADS.append(t)
 
-    while True: #keep main thread alive to catch exit signals
-        time.sleep(15)
+        while True: #keep main thread alive to catch exit signals
+            time.sleep(stats_interval)
+
+            report_stats(get_run_actions(batch_location_updates, stale_read_percentage > 0) + [ACTION_POOL_CHECKOUT],
+                         movr)
+
+# the movr backend for conn_string: MemoryMovR for memory:// urls, MovR otherwise
+def get_movr(conn_string, **kwargs):
+    if is_memory_url(conn_string):
+        return MemoryMovR(conn_string, **kwargs)
+    return MovR(conn_string, **kwargs)
+
+# the in-memory backend starts out empty, so runs against it first load it with the defaults of the load command
+def populate_memory_movr(movr, cities):
+    logging.info("populating the in-memory backend...")
+    load_movr_data(movr, 50 * len(cities), 10 * len(cities), 500 * len(cities), 1000 * len(cities), 1000, cities)
+
+# with the in-memory backend, every operation per second is one the client could generate without a database
+def print_client_throughput_ceiling(cumulative = False):
+    if MEMORY_BACKEND:
+        print("client-side throughput ceiling (%s): %.1f ops/second\n" %
+              ("whole run" if cumulative else "last window", stats.get_ops_per_second(cumulative)))
+
+# print the stats of the window that just ended, write them to --stats-output, and start a new window
+def report_stats(action_list, movr = None):
+    stats.print_stats(action_list=action_list)
+    print_client_throughput_ceiling()
+    if movr:
+        print_promo_code_cache_stats(movr)
+    if stats_output:
+        stats_output.write(stats.get_window_records(action_list))
+    stats.new_window()
+
+# print the counters of the promo code cache of a MovR instance, if it has one
+def print_promo_code_cache_stats(movr):
+    if movr.promo_code_cache:
+        cache_stats = movr.promo_code_cache.get_stats()
+        print(tabulate([["promo codes", cache_stats["size"], cache_stats["hits"], cache_stats["misses"],
+                         round(cache_stats["hit rate"] * 100, 2), cache_stats["evictions"]]],
+                       ["cache", "size", "hits", "misses", "hit rate(%)", "evictions"]), "\n")
+
+# one line per partitioning statement: what it changed, whether it had to run and how long it took
+def print_partition_results(results):
+    rows = []
+    for result in results:
+        rows.append([result.statement.group, result.statement.key, result.status, round(result.seconds, 3),
+                     result.error.splitlines()[0] if result.error else ""])
+    print(tabulate(rows, ["group", "statement", "status", "time(s)", "error"]), "\n")
+
+# re-issue the operations of a trace recorded with --record-trace
+def run_trace_replay(conn_string, trace_path, timing, echo_sql, num_threads, fast_path = False,
+                     stats_interval = DEFAULT_STATS_INTERVAL):
+    header, operations = read_trace(trace_path)
+    logging.info("replaying trace %s of cities %s with %d threads", trace_path, header["cities"], num_threads)
+
+    id_map = TraceIdMap()
+    operation_queues = [queue.Queue(maxsize=1000) for _ in range(num_threads)]
+    # the actions of the operations dispatched so far, which are the ones reported: which of them a trace holds
+    # depends on the options it was recorded with (--batch-location-updates, --stale-read-percentage)
+    trace_actions = set()
+
+    # the operations of each recorded worker are replayed in order by the same thread
+    def dispatch_operations():
+        try:
+            for operation in operations:
+                if TERMINATE_GRACEFULLY:
+                    return
+                trace_actions.add(operation[2])
+                if operation[5] is not None:
+                    id_map.expect(operation[5])
+                operation_queue = operation_queues[operation[0] % num_threads]
+                while not TERMINATE_GRACEFULLY:
+                    try:
+                        operation_queue.put(operation, timeout=.1)
+                        break
+                    except queue.Full:
+                        pass
+        finally:
+            # on termination, the replay threads stop on their own
+            if not TERMINATE_GRACEFULLY:
+                for operation_queue in operation_queues:
+                    operation_queue.put(None)
+
+    with get_movr(conn_string, echo=echo_sql, pool_size=num_threads, max_overflow=num_threads, stats=stats,
+                  fast_path=fast_path) as movr:
+        replay_start = time.time() if timing == TRACE_TIMING_ORIGINAL else None
+
+        RUNNING_THREADS = [threading.Thread(target=dispatch_operations)]
+        for operation_queue in operation_queues:
+            RUNNING_THREADS.append(threading.Thread(target=replay_trace_operations,
+                                                    args=(movr, operation_queue, id_map, replay_start)))
+        for t in RUNNING_THREADS:
+            t.start()
 
-        stats.print_stats(action_list=[ACTION_ADD_VEHICLE, ACTION_GET_VEHICLES, ACTION_UPDATE_RIDE_LOC,
-                           ACTION_NEW_CODE, ACTION_APPLY_CODE, ACTION_NEW_USER,
-                           ACTION_START_RIDE, ACTION_END_RIDE])
+        last_report = time.time()
+        while any(t.is_alive() for t in RUNNING_THREADS):
+            time.sleep(.1)
+            if time.time() - last_report >= stats_interval:
+                report_stats(sorted(trace_actions) + [ACTION_POOL_CHECKOUT])
+                last_report = time.time()
+
+    logging.info("finished replaying %s.", trace_path)
+    stats.print_cumulative_stats()
+    print_client_throughput_ceiling(cumulative=True)
+
+# generate fake load with thousands of simulated users in a single process, using asyncio instead of threads
+def run_async_load_generator(conn_string, read_percentage, city_list, echo_sql, concurrency,
+                             batch_location_updates = False, target_ops_per_sec = 0, seed = None, trace_path = None,
+                             entity_pool_size = EntityPool.DEFAULT_CAPACITY, stale_read_percentage = 0,
+                             read_staleness = FOLLOWER_READ_STALENESS, stats_interval = DEFAULT_STATS_INTERVAL):
+    if read_percentage < 0 or read_percentage > 1:
+        raise ValueError("read percentage must be between 0 and 1")
+    if stale_read_percentage < 0 or stale_read_percentage > 1:
+        raise ValueError("stale read percentage must be between 0 and 1")
+    if target_ops_per_sec < 0:
+        raise ValueError("target ops per second must not be negative")
 
-        stats.new_window()
+    if is_memory_url(conn_string):
+        async_movr_class = AsyncMemoryMovR
+    else:
+        # only needed (along with asyncpg) for asyncio mode
+        from movr_async import AsyncMovR
+        async_movr_class = AsyncMovR
+
+    async def run():
+        logging.info("simulating movr load for cities %s with %d concurrent users", city_list, concurrency)
+
+        entities = EntityPool(city_list, entity_pool_size)
+
+        logging.info("warming up....")
+        async with async_movr_class(conn_string, echo=echo_sql, pool_size=concurrency, max_overflow=0,
+                                    read_staleness=read_staleness) as movr:
+            if is_memory_url(conn_string):
+                populate_memory_movr(movr.movr, city_list)
+
+            for city in city_list:
+                users = await movr.get_users(city, limit=entity_pool_size)
+                vehicles = await movr.get_vehicles(city, limit=entity_pool_size)
+                if len(vehicles) == 0 or len(users) == 0:
+                    logging.error("must have users and vehicles for city '%s' in the movr database to generate load. try running with the 'load' command.", city)
+                    sys.exit(1)
+
+                add_warm_up_entities(entities, city, users, vehicles,
+                                     await movr.get_active_rides(city, limit=entity_pool_size))
+            entities.promo_codes.extend(await movr.get_promo_codes(limit=entity_pool_size))
+
+            loop = asyncio.get_running_loop()
+            loop.add_signal_handler(signal.SIGINT, request_termination, signal.SIGINT, None)
+
+            schedule = ArrivalSchedule(target_ops_per_sec) if target_ops_per_sec else None
+            trace = None
+            if trace_path:
+                trace = TraceWriter(trace_path, {"cities": city_list, "read_percentage": read_percentage, "seed": seed,
+                                                 "workers": concurrency})
+            tasks = [asyncio.ensure_future(simulate_movr_load_async(movr, city_list, entities, read_percentage,
+                                                                    batch_location_updates, schedule, i, seed,
+                                                                    trace, stale_read_percentage))
+                     for i in range(concurrency)]
+
+            while not TERMINATE_GRACEFULLY and not all(task.done() for task in tasks):
+                await asyncio.wait(tasks, timeout=stats_interval)
+
+                # report from another thread so reporting never stalls the simulated users
+                await loop.run_in_executor(None, report_stats,
+                                           get_run_actions(batch_location_updates, stale_read_percentage > 0))
+
+            await asyncio.gather(*tasks)
+            if trace:
+                trace.close()
+
+        logging.info("shutting down gracefully.")
+        stats.print_cumulative_stats()
+        print_client_throughput_ceiling(cumulative=True)
+
+    asyncio.run(run())
+
+# the actions reported while generating load
+def get_run_actions(batch_location_updates = False, stale_reads = False):
+    actions = [ACTION_ADD_VEHICLE, ACTION_GET_VEHICLES,
+               ACTION_UPDATE_RIDE_LOCS if batch_location_updates else ACTION_UPDATE_RIDE_LOC,
+               ACTION_NEW_CODE, ACTION_APPLY_CODE, ACTION_NEW_USER,
+               ACTION_START_RIDE, ACTION_END_RIDE]
+    if stale_reads:
+        actions.append(ACTION_GET_STALE_VEHICLES)
+    return actions
 
 
 if __name__ == '__main__':
@@ -499,7 +1318,18 @@ if __name__ == '__main__':
 
     args = setup_parser().parse_args()
 
-    if not re.search('.*26257/(.*)\?', args.conn_string):
+    if is_memory_url(args.conn_string):
+        MEMORY_BACKEND = True
+        if args.subparser_name == 'partition':
+            logging.error("The in-memory backend can't be partitioned.")
+            sys.exit(1)
+        if args.subparser_name == 'run' and args.replay_trace:
+            logging.error("Traces can only be replayed against a database with the rows they were recorded against.")
+            sys.exit(1)
+        if args.subparser_name == 'load' and args.load_mode:
+            logging.error("The in-memory backend starts out empty, so there is no load to resume or grow.")
+            sys.exit(1)
+    elif not re.search('.*26257/(.*)\?', args.conn_string):
         logging.error("The connection string needs to point to a database. Example: postgres://root@localhost:26257/mymovrdatabase?sslmode=disable")
         sys.exit(1)
 
@@ -507,6 +1337,48 @@ if __name__ == '__main__':
         logging.error("Number of threads must be greater than 0.")
         sys.exit(1)
 
+    if args.subparser_name == 'partition' and args.partition_workers <= 0:
+        logging.error("Number of partition workers must be greater than 0.")
+        sys.exit(1)
+
+    if args.subparser_name == 'load' and args.workers <= 0:
+        logging.error("Number of workers must be greater than 0.")
+        sys.exit(1)
+
+    if args.subparser_name == 'load' and (args.min_chunk_size <= 0 or args.max_chunk_size < args.min_chunk_size):
+        logging.error("Chunk sizes must be greater than 0, with the minimum at most the maximum.")
+        sys.exit(1)
+
+    if args.subparser_name == 'load' and args.pipeline:
+        if args.workers > 1:
+            logging.error("The pipeline loads with threads; it can't be combined with --workers.")
+            sys.exit(1)
+        if args.generator_threads <= 0 or args.writer_threads <= 0 or args.pipeline_queue_size <= 0:
+            logging.error("Pipeline threads and queue size must be greater than 0.")
+            sys.exit(1)
+
+    if args.subparser_name == 'run' and args.entity_pool_size <= 0:
+        logging.error("Entity pool size must be greater than 0.")
+        sys.exit(1)
+
+    if args.subparser_name == 'run' and args.promo_code_cache_size < 0:
+        logging.error("Promo code cache size must not be negative.")
+        sys.exit(1)
+
+    if args.subparser_name == 'run' and args.stats_interval <= 0:
+        logging.error("Stats interval must be greater than 0.")
+        sys.exit(1)
+
+    if args.subparser_name == 'run' and args.stats_group:
+        stats = MovRStats(args.stats_group, extract_region_city_pairs_from_cli(args.region_city_pair))
+
+    if args.subparser_name == 'run':
+        try:
+            get_as_of_system_time(args.read_staleness)
+        except ValueError as e:
+            logging.error(e)
+            sys.exit(1)
+
     if args.log_level not in ['debug', 'info', 'warning', 'error']:
         logging.error("Invalid log level: %s", args.log_level)
         sys.exit(1)
@@ -530,9 +1402,19 @@ if __name__ == '__main__':
     conn_string = set_query_parameter(conn_string, "application_name", args.app_name)
 
 
+    if args.subparser_name == 'run' and args.stats_output:
+        stats_output = StatsOutputWriter(args.stats_output, args.stats_output_format)
+        atexit.register(stats_output.close)
+
+    if args.subparser_name == 'run' and args.metrics_port:
+        metrics_server = MetricsServer(stats, args.metrics_host, args.metrics_port)
+        metrics_server.start()
+
     if args.subparser_name=='load':
         run_data_loader(conn_string, get_cities(args.city), args.num_users, args.num_rides, args.num_vehicles, args.num_histories, args.num_promo_codes, args.num_threads,
-                        args.skip_reload_tables, args.echo_sql)
+                        args.skip_reload_tables, args.echo_sql, args.loader_backend, args.workers, args.load_mode,
+                        args.pipeline, args.generator_threads, args.writer_threads, args.pipeline_queue_size,
+                        args.adaptive_chunks, args.min_chunk_size, args.max_chunk_size)
     elif args.subparser_name=="partition":
         # population partitions
         partition_city_map = extract_region_city_pairs_from_cli(args.region_city_pair)
@@ -557,7 +1439,9 @@ if __name__ == '__main__':
 
 
 
-        with MovR(conn_string, init_tables=False, echo=args.echo_sql) as movr:
+        # every partitioning worker holds a connection for as long as its statement runs
+        with MovR(conn_string, init_tables=False, echo=args.echo_sql, pool_size=args.partition_workers,
+                  max_overflow=args.partition_workers) as movr:
             if args.preview_queries:
                 queries = movr.get_geo_partitioning_queries(partition_city_map, partition_zone_map)
                 print("queries to geo-partition the database")
@@ -587,11 +1471,29 @@ if __name__ == '__main__':
 
             else:
                 print("partitioning tables...")
-                movr.add_geo_partitioning(partition_city_map, partition_zone_map)
+                results = movr.add_geo_partitioning(partition_city_map, partition_zone_map, args.partition_workers)
+                print_partition_results(results)
+                failed = [result for result in results if result.status in (STATUS_FAILED, STATUS_DEPENDENCY_FAILED)]
+                if failed:
+                    logging.error("%d of %d partitioning statements were not applied. Statements that were applied "
+                                  "are skipped when partitioning again.", len(failed), len(results))
+                    sys.exit(1)
                 print("done.")
 
+    elif args.subparser_name == "run" and args.replay_trace:
+        run_trace_replay(conn_string, args.replay_trace, args.replay_timing, args.echo_sql, args.num_threads,
+                         args.fast_path, args.stats_interval)
+    elif args.subparser_name == "run" and args.concurrency > 0:
+        run_async_load_generator(conn_string, args.read_percentage, get_cities(args.city), args.echo_sql,
+                                 args.concurrency, args.batch_location_updates, args.target_ops_per_sec, args.seed,
+                                 args.record_trace, args.entity_pool_size, args.stale_read_percentage,
+                                 args.read_staleness, args.stats_interval)
     elif args.subparser_name == "run":
-        run_load_generator(conn_string, args.read_percentage, get_cities(args.city), args.echo_sql, args.num_threads)
+        run_load_generator(conn_string, args.read_percentage, get_cities(args.city), args.echo_sql, args.num_threads,
+                           args.fast_path, args.batch_location_updates, args.target_ops_per_sec, args.seed,
+                           args.record_trace, args.entity_pool_size, args.stale_read_percentage,
+                           args.read_staleness, args.promo_code_cache_size, args.promo_code_cache_ttl,
+                           args.stats_interval)
     else:
         run_load_generator(conn_string, DEFAULT_READ_PERCENTAGE, get_cities(None), args.echo_sql, args.num_threads)
 
@@ -111,3 +111,19 @@ class UserPromoCode(Base):
     def __repr__(self):
         return "<UserPromoCode(city='%s', user_id='%s', code='%s', timestamp='%s')>" % \
                (self.user_city, self.user_id, self.code, self.timestamp)
+
+
+# One chunk of rows written by the bulk loader, committed in the same transaction as the rows themselves, so the
+# rows a table has been loaded with for a city survive an interrupted load. Promo codes aren't per city and are
+# recorded with an empty city.
+class LoadCheckpoint(Base):
+    __tablename__ = 'load_checkpoints'
+    city = Column(String)
+    table_name = Column(String)
+    id = Column(UUID, default=MovRGenerator.generate_uuid)
+    rows = Column(Integer)
+    creation_time = Column(DateTime, default=datetime.datetime.now)
+    PrimaryKeyConstraint(city, table_name, id)
+
+    def __repr__(self):
+        return "<LoadCheckpoint(city='%s', table_name='%s', rows='%s')>" % (self.city, self.table_name, self.rows)
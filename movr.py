@@ -1,11 +1,138 @@
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, cast, literal, select, text
+from sqlalchemy.dialects.postgresql import UUID, insert
 from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import QueuePool
 from models import Base, User, Vehicle, Ride, VehicleLocationHistory, PromoCode, UserPromoCode
 
 from cockroachdb.sqlalchemy import run_transaction
 from generators import MovRGenerator
-
-import datetime, logging
+from movr_cache import TTLCache
+from movr_partition import PartitionStatement, execute_partition_statements, DEFAULT_PARTITION_WORKERS
+
+import contextvars, datetime, logging, re, time
+from collections import namedtuple
+
+ACTION_POOL_CHECKOUT = "pool checkout"
+
+# Transactions run by one thread (or asyncio task) since the last pop_transaction_attempts(): how many, how many
+# times their callbacks were attempted, and how long was spent on attempts that had to be retried.
+class TransactionAttempts:
+    def __init__(self):
+        self.transactions = 0
+        self.attempts = 0
+        self.retry_time = 0.0
+
+    def get_retries(self):
+        return self.attempts - self.transactions
+
+current_transaction_attempts = contextvars.ContextVar("current_transaction_attempts", default=None)
+
+def get_transaction_attempts():
+    attempts = current_transaction_attempts.get()
+    if attempts is None:
+        attempts = TransactionAttempts()
+        current_transaction_attempts.set(attempts)
+    return attempts
+
+# return the attempts of the current thread (or asyncio task) and start counting from zero
+def pop_transaction_attempts():
+    attempts = current_transaction_attempts.get()
+    current_transaction_attempts.set(None)
+    return attempts if attempts is not None else TransactionAttempts()
+
+# QueuePool that reports how long each checkout waited for a connection (including connecting, if the pool
+# had to open a new one).
+class TimedQueuePool(QueuePool):
+    checkout_wait_callback = None
+
+    def _do_get(self):
+        start = time.time()
+        try:
+            return super(TimedQueuePool, self)._do_get()
+        finally:
+            if self.checkout_wait_callback:
+                self.checkout_wait_callback(time.time() - start)
+
+    def recreate(self):
+        pool = super(TimedQueuePool, self).recreate()
+        pool.checkout_wait_callback = self.checkout_wait_callback
+        return pool
+
+##################
+# SINGLE ROUND-TRIP STATEMENTS
+# used by the fast path of MovR and by AsyncMovR
+#################
+
+# start a ride in one statement: mark the vehicle in use, count a use of every valid promo code on the rider's
+# account, and insert the ride starting at the vehicle's location
+START_RIDE_STATEMENT = text("""
+    WITH vehicle AS (
+        UPDATE vehicles SET status = 'in_use'
+        WHERE city = :city AND id = :vehicle_id
+        RETURNING current_location),
+    used_promo_codes AS (
+        UPDATE user_promo_codes SET usage_count = user_promo_codes.usage_count + 1 FROM promo_codes
+        WHERE user_promo_codes.city = :city AND user_promo_codes.user_id = :rider_id
+            AND user_promo_codes.code = promo_codes.code AND promo_codes.expiration_time > :now
+        RETURNING user_promo_codes.code)
+    INSERT INTO rides (city, vehicle_city, id, rider_id, vehicle_id, start_address, start_time)
+    VALUES (:city, :city, :ride_id, :rider_id, :vehicle_id, (SELECT current_location FROM vehicle), :now)""")
+
+def get_start_ride_parameters(city, rider_id, vehicle_id):
+    return {'city': city, 'rider_id': rider_id, 'vehicle_id': vehicle_id, 'ride_id': MovRGenerator.generate_uuid(),
+            'now': datetime.datetime.now()}
+
+# finish a ride and free its vehicle in one statement
+END_RIDE_STATEMENT = text("""
+    WITH ride AS (
+        UPDATE rides SET end_address = (SELECT current_location FROM vehicles
+                                        WHERE vehicles.city = rides.vehicle_city AND vehicles.id = rides.vehicle_id),
+                         revenue = :revenue, end_time = :end_time
+        WHERE city = :city AND id = :ride_id
+        RETURNING vehicle_city, vehicle_id)
+    UPDATE vehicles SET status = 'available' FROM ride
+    WHERE vehicles.city = ride.vehicle_city AND vehicles.id = ride.vehicle_id""")
+
+def get_end_ride_parameters(city, ride_id):
+    return {'city': city, 'ride_id': ride_id, 'revenue': MovRGenerator.generate_revenue(),
+            'end_time': datetime.datetime.now()}
+
+# apply a code only if it exists and hasn't already been applied
+def get_apply_promo_code_statement(user_city, user_id, code):
+    user_promo_codes = UserPromoCode.__table__
+    promo_codes = PromoCode.__table__
+    return insert(user_promo_codes).\
+        from_select([user_promo_codes.c.city, user_promo_codes.c.user_id, user_promo_codes.c.code],
+                    select([literal(user_city), cast(literal(user_id), UUID), promo_codes.c.code]).
+                        where(promo_codes.c.code == code)).\
+        on_conflict_do_nothing()
+
+def get_insert_locations_statement(locations):
+    return VehicleLocationHistory.__table__.insert().values(
+        [{'city': l['city'], 'ride_id': l['ride_id'], 'lat': l['lat'], 'long': l['long']} for l in locations])
+
+##################
+# STALE READS
+#################
+
+# read at the newest timestamp every replica is guaranteed to be able to serve, so reads never leave the nearest one
+FOLLOWER_READ_STALENESS = "follower"
+
+# the AS OF SYSTEM TIME expression for a staleness of either FOLLOWER_READ_STALENESS or a duration like 10s or 500ms
+def get_as_of_system_time(staleness):
+    if staleness == FOLLOWER_READ_STALENESS:
+        return "follower_read_timestamp()"
+    if not re.match(r"^[0-9]+(\.[0-9]+)?(us|ms|s|m|h)$", staleness):
+        raise ValueError("read staleness must be '%s' or a duration like 10s, got '%s'" %
+                         (FOLLOWER_READ_STALENESS, staleness))
+    return "'-%s'" % staleness
+
+def get_stale_vehicles_statement(staleness):
+    return text("SELECT city, id FROM vehicles AS OF SYSTEM TIME %s WHERE city = :city LIMIT :limit" %
+                get_as_of_system_time(staleness))
+
+# the columns of a promo code MovR needs, detached from any session so they can be cached
+PromoCodeInfo = namedtuple("PromoCodeInfo", ["code", "expiration_time"])
 
 class MovR:
 
@@ -13,12 +140,28 @@ class MovR:
         return self
 
     def __exit__(self, exc_type, exc_value, traceback):
-        self.session.close()
-
-    def __init__(self, conn_string, init_tables = False, echo = False):
-
-
-        self.engine = create_engine(conn_string, convert_unicode=True, echo=echo)
+        self.engine.dispose()
+
+    # A MovR instance is safe to share between threads: every call checks a connection out of the pool and uses a
+    # new session from the shared session factory. Size the pool to the number of threads that will share it.
+    # With fast_path set, start_ride, end_ride and apply_promo_code are issued as joined, single round-trip statements
+    # instead of the read-then-write ORM versions. read_staleness is how far in the past get_stale_vehicles reads.
+    # With a promo_code_cache_size, the promo codes looked up by start_ride and apply_promo_code are cached for
+    # promo_code_cache_ttl seconds. Codes created through this instance are invalidated right away.
+    def __init__(self, conn_string, init_tables = False, echo = False, pool_size = 5, max_overflow = 5, stats = None,
+                 fast_path = False, read_staleness = FOLLOWER_READ_STALENESS, promo_code_cache_size = 0,
+                 promo_code_cache_ttl = 60):
+
+
+        self.engine = create_engine(conn_string, convert_unicode=True, echo=echo, poolclass=TimedQueuePool,
+                                    pool_size=pool_size, max_overflow=max_overflow)
+        if stats:
+            self.engine.pool.checkout_wait_callback = \
+                lambda wait: stats.add_latency_measurement(ACTION_POOL_CHECKOUT, wait)
+        self.session_factory = sessionmaker(bind=self.engine)
+        self.fast_path = fast_path
+        self.stale_vehicles_statement = get_stale_vehicles_statement(read_staleness)
+        self.promo_code_cache = TTLCache(promo_code_cache_size, promo_code_cache_ttl) if promo_code_cache_size else None
 
 
         if init_tables:
@@ -27,7 +170,34 @@ class MovR:
             Base.metadata.create_all(bind=self.engine)
             logging.debug("tables dropped and created")
 
-        self.session = sessionmaker(bind=self.engine)()
+    # run callback(session) in a transaction with cockroachdb's retry loop, counting its attempts. The time from the
+    # start of the first attempt until the start of the last one is the time lost to retries.
+    def run_transaction(self, callback):
+        attempts = get_transaction_attempts()
+        attempts.transactions += 1
+        attempt_starts = []
+
+        def attempt(session):
+            attempts.attempts += 1
+            attempt_starts.append(time.time())
+            return callback(session)
+
+        try:
+            return run_transaction(self.session_factory, attempt)
+        finally:
+            if attempt_starts:
+                attempts.retry_time += attempt_starts[-1] - attempt_starts[0]
+
+    # look up a promo code (as a PromoCodeInfo), or None if there is no such code. Served from the promo code cache
+    # if it is enabled, and read with session otherwise.
+    def get_promo_code_info(self, session, code):
+        def load_promo_code_info(code):
+            promo_code = session.query(PromoCode).filter_by(code=code).one_or_none()
+            return PromoCodeInfo(promo_code.code, promo_code.expiration_time) if promo_code else None
+
+        if self.promo_code_cache:
+            return self.promo_code_cache.get(code, load_promo_code_info)
+        return load_promo_code_info(code)
 
     ##################
     # MAIN MOVR API
@@ -43,7 +213,7 @@ class MovR:
 
             # determine which codes are valid
             for upc in upcs:
-                promo_code = session.query(PromoCode).filter_by(code = upc.code).first()
+                promo_code = self.get_promo_code_info(session, upc.code)
                 if promo_code and promo_code.expiration_time > datetime.datetime.now():
                     upc.usage_count+=1;
                     #@todo: do something with the code
@@ -55,8 +225,13 @@ class MovR:
             v.status = "in_use"
             return {'city': r.city, 'id': r.id}
 
-        return run_transaction(sessionmaker(bind=self.engine),
-                               lambda session: start_ride_helper(session, city, rider_id, vehicle_id))
+        def start_ride_fast_helper(session, city, rider_id, vehicle_id):
+            parameters = get_start_ride_parameters(city, rider_id, vehicle_id)
+            session.execute(START_RIDE_STATEMENT, parameters)
+            return {'city': city, 'id': parameters['ride_id']}
+
+        helper = start_ride_fast_helper if self.fast_path else start_ride_helper
+        return self.run_transaction(lambda session: helper(session, city, rider_id, vehicle_id))
 
     def end_ride(self, city, ride_id):
         def end_ride_helper(session, city, ride_id):
@@ -67,15 +242,27 @@ class MovR:
             ride.end_time = datetime.datetime.now()
             v.status = "available"
 
-        run_transaction(sessionmaker(bind=self.engine), lambda session: end_ride_helper(session, city, ride_id))
+        def end_ride_fast_helper(session, city, ride_id):
+            session.execute(END_RIDE_STATEMENT, get_end_ride_parameters(city, ride_id))
+
+        helper = end_ride_fast_helper if self.fast_path else end_ride_helper
+        self.run_transaction(lambda session: helper(session, city, ride_id))
 
     def update_ride_location(self, city, ride_id, lat, long):
         def update_ride_location_helper(session, city, ride_id, lat, long):
             h = VehicleLocationHistory(city = city, ride_id = ride_id, lat = lat, long = long)
             session.add(h)
 
-        run_transaction(sessionmaker(bind=self.engine),
-                        lambda session: update_ride_location_helper(session, city, ride_id, lat, long))
+        self.run_transaction(lambda session: update_ride_location_helper(session, city, ride_id, lat, long))
+
+    # write many location points with a single multi-row INSERT.
+    # locations is a list of dicts in the form {'city': ..., 'ride_id': ..., 'lat': ..., 'long': ...}
+    def update_ride_locations(self, locations):
+        def update_ride_locations_helper(session, locations):
+            session.execute(get_insert_locations_statement(locations))
+
+        if len(locations):
+            self.run_transaction(lambda session: update_ride_locations_helper(session, locations))
 
     def add_user(self, city, name, address, credit_card_number):
         def add_user_helper(session, city, name, address, credit_card_number):
@@ -83,8 +270,7 @@ class MovR:
                      address=address, credit_card=credit_card_number)
             session.add(u)
             return {'city': u.city, 'id': u.id}
-        return run_transaction(sessionmaker(bind=self.engine),
-                               lambda session: add_user_helper(session, city, name, address, credit_card_number))
+        return self.run_transaction(lambda session: add_user_helper(session, city, name, address, credit_card_number))
 
     def add_vehicle(self, city, owner_id, current_location, type, vehicle_metadata, status):
         def add_vehicle_helper(session, city, owner_id, current_location, type, vehicle_metadata, status):
@@ -97,38 +283,47 @@ class MovR:
 
             session.add(vehicle)
             return {'city': vehicle.city, 'id': vehicle.id}
-        return run_transaction(sessionmaker(bind=self.engine),
-                               lambda session: add_vehicle_helper(session,
-                                                                  city, owner_id, current_location, type,
-                                                                  vehicle_metadata, status))
+        return self.run_transaction(lambda session: add_vehicle_helper(session,
+                                                                       city, owner_id, current_location, type,
+                                                                       vehicle_metadata, status))
 
     def get_users(self, city, limit=None):
         def get_users_helper(session, city, limit=None):
             users = session.query(User).filter_by(city=city).limit(limit).all()
             return list(map(lambda user: {'city': user.city, 'id': user.id}, users))
-        return run_transaction(sessionmaker(bind=self.engine), lambda session: get_users_helper(session, city, limit))
+        return self.run_transaction(lambda session: get_users_helper(session, city, limit))
 
     def get_vehicles(self, city, limit=None):
         def get_vehicles_helper(session, city, limit=None):
             vehicles = session.query(Vehicle).filter_by(city=city).limit(limit).all()
             return list(map(lambda vehicle: {'city': vehicle.city, 'id': vehicle.id}, vehicles))
 
-        return run_transaction(sessionmaker(bind=self.engine), lambda session: get_vehicles_helper(session, city, limit))
+        return self.run_transaction(lambda session: get_vehicles_helper(session, city, limit))
+
+    # get_vehicles, served from the nearest replica by reading AS OF SYSTEM TIME read_staleness ago. Historical reads
+    # can't run in the explicit transactions of run_transaction, so this is a single autocommit statement instead.
+    def get_stale_vehicles(self, city, limit=None):
+        attempts = get_transaction_attempts()
+        attempts.transactions += 1
+        attempts.attempts += 1
+        with self.engine.connect() as connection:
+            result = connection.execution_options(isolation_level="AUTOCOMMIT").\
+                execute(self.stale_vehicles_statement, {'city': city, 'limit': limit})
+            return [{'city': row.city, 'id': row.id} for row in result]
 
     def get_active_rides(self, city, limit=None):
         def get_active_rides_helper(session, city, limit=None):
             rides = session.query(Ride).filter_by(city=city, end_time=None).limit(limit).all()
             return list(map(lambda ride: {'city': city, 'id': ride.id}, rides))
 
-        return run_transaction(sessionmaker(bind=self.engine),
-                               lambda session: get_active_rides_helper(session, city, limit))
+        return self.run_transaction(lambda session: get_active_rides_helper(session, city, limit))
 
     def get_promo_codes(self, limit=None):
         def get_promo_codes_helper(session, limit=None):
             pcs = session.query(PromoCode).limit(limit).all()
             return list(map(lambda pc: pc.code, pcs))
 
-        return run_transaction(sessionmaker(bind=self.engine), lambda session: get_promo_codes_helper(session, limit))
+        return self.run_transaction(lambda session: get_promo_codes_helper(session, limit))
 
 
     def create_promo_code(self, code, description, expiration_time, rules):
@@ -137,14 +332,16 @@ class MovR:
             session.add(pc)
             return pc.code
 
-        return run_transaction(sessionmaker(bind=self.engine),
-                               lambda session: add_promo_code_helper(session, code, description, expiration_time, rules))
+        try:
+            return self.run_transaction(lambda session: add_promo_code_helper(session, code, description, expiration_time, rules))
+        finally:
+            if self.promo_code_cache:
+                self.promo_code_cache.invalidate(code)
 
 
     def apply_promo_code(self, user_city, user_id, promo_code):
         def apply_promo_code_helper(session, user_city, user_id, code):
-            pc = session.query(PromoCode).filter_by(code=code).one_or_none()
-            if pc:
+            if self.get_promo_code_info(session, code):
                 # see if it has already been applied
                 upc = session.query(UserPromoCode).\
                     filter_by(city = user_city, user_id = user_id, code = code).one_or_none()
@@ -152,8 +349,11 @@ class MovR:
                     upc = UserPromoCode(city = user_city, user_id = user_id, code = code)
                     session.add(upc)
 
-        run_transaction(sessionmaker(bind=self.engine),
-                               lambda session: apply_promo_code_helper(session, user_city, user_id, promo_code))
+        def apply_promo_code_fast_helper(session, user_city, user_id, code):
+            session.execute(get_apply_promo_code_statement(user_city, user_id, code))
+
+        helper = apply_promo_code_fast_helper if self.fast_path else apply_promo_code_helper
+        self.run_transaction(lambda session: helper(session, user_city, user_id, promo_code))
 
 
 
@@ -161,7 +361,10 @@ class MovR:
     # GEO PARTITIONING
     ############
 
-    def get_geo_partitioning_queries(self, partition_map, zone_map):
+    # the statements that geo-partition the database, with the order between them that matters: a table's partitions
+    # are created before its indexes are partitioned (both change the table's schema), and every partition and
+    # index before the zone configs that pin them to a region. Statements on different tables are independent.
+    def get_geo_partitioning_statements(self, partition_map, zone_map):
 
 
         def get_index_partition_name(region, index_name):
@@ -182,12 +385,17 @@ class MovR:
                 partition_string += ")"
             return partition_string
 
-        queries_to_run = {}
+        def get_partition_values(index_name=""):
+            return {get_index_partition_name(region, index_name) if index_name else region: partition_map[region]
+                    for region in partition_map}
+
+        statements = []
 
         partition_string = create_partition_string()
         for table in ["vehicles", "users", "rides", "vehicle_location_histories", "user_promo_codes"]:
             partition_sql = "ALTER TABLE " + table + " PARTITION BY LIST (city) (" + partition_string + ");"
-            queries_to_run.setdefault("table_partitions",[]).append(partition_sql)
+            statements.append(PartitionStatement("table_partitions", table, partition_sql, (),
+                                                 ("partitions", table, None, get_partition_values())))
 
             for partition_name in partition_map:
                 if not partition_name in zone_map:
@@ -196,8 +404,10 @@ class MovR:
 
                 zone_sql = "ALTER PARTITION " + partition_name + " OF TABLE " + table + " CONFIGURE ZONE USING constraints='[+region=" + \
                            zone_map[partition_name] + "]';"
-                queries_to_run.setdefault("table_zones",[]).append(zone_sql)
+                statements.append(PartitionStatement("table_zones", table + "." + partition_name, zone_sql, (table,),
+                                                     ("zone", table, partition_name, None, zone_map[partition_name])))
 
+        last_index_partition = {}
         for index in [{"index_name": "rides_auto_index_fk_city_ref_users", "prefix_name": "city", "table": "rides"},
                       {"index_name": "rides_auto_index_fk_vehicle_city_ref_vehicles", "prefix_name": "vehicle_city",
                        "table": "rides"},
@@ -206,73 +416,58 @@ class MovR:
             partition_string = create_partition_string(index_name=index["index_name"])
             partition_sql = "ALTER INDEX " + index["index_name"] + " PARTITION BY LIST (" + index[
                 "prefix_name"] + ") (" + partition_string + ");"
-            queries_to_run.setdefault("index_partitions",[]).append(partition_sql)
+            # one schema change on a table at a time
+            statements.append(PartitionStatement("index_partitions", index["index_name"], partition_sql,
+                                                 (last_index_partition.get(index["table"], index["table"]),),
+                                                 ("partitions", index["table"], index["index_name"],
+                                                  get_partition_values(index["index_name"]))))
+            last_index_partition[index["table"]] = index["index_name"]
 
             for partition_name in partition_map:
                 if not partition_name in zone_map:
                     logging.info("partition_name %s not found in zone map. Skipping", partition_name)
                     continue
-                zone_sql = "ALTER PARTITION " + get_index_partition_name(partition_name,
-                                                                         index["index_name"]) + " OF TABLE " + \
+                index_partition_name = get_index_partition_name(partition_name, index["index_name"])
+                zone_sql = "ALTER PARTITION " + index_partition_name + " OF TABLE " + \
                            index["table"] + " CONFIGURE ZONE USING constraints='[+region=" + zone_map[
                                partition_name] + "]';"
-                queries_to_run.setdefault("index_zones",[]).append(zone_sql)
+                statements.append(PartitionStatement("index_zones", index["table"] + "." + index_partition_name,
+                                                     zone_sql, (index["index_name"],),
+                                                     ("zone", index["table"], index_partition_name, None,
+                                                      zone_map[partition_name])))
 
 
         # create an index in each region so we can use the zone-config aware CBO
+        last_promo_code_index = None
         for partition_name in partition_map:
             if not partition_name in zone_map:
                 logging.info("partition_name %s not found in zone map. Skipping index creation for promo codes",
                              partition_name)
                 continue
 
-            sql = "CREATE INDEX promo_codes_" + partition_name + "_idx on promo_codes (code) STORING (description, creation_time, expiration_time, rules);"
-            queries_to_run.setdefault("promo_code_indices",[]).append(sql)
+            index_name = "promo_codes_" + partition_name + "_idx"
+            sql = "CREATE INDEX " + index_name + " on promo_codes (code) STORING (description, creation_time, expiration_time, rules);"
+            statements.append(PartitionStatement("promo_code_indices", index_name, sql,
+                                                 (last_promo_code_index,) if last_promo_code_index else (),
+                                                 ("index", "promo_codes", index_name)))
+            last_promo_code_index = index_name
 
-            sql = "ALTER INDEX promo_codes@promo_codes_" + partition_name + "_idx CONFIGURE ZONE USING constraints='[+region=" + \
+            sql = "ALTER INDEX promo_codes@" + index_name + " CONFIGURE ZONE USING constraints='[+region=" + \
                   zone_map[partition_name] + "]';";
-            queries_to_run.setdefault("promo_code_zones",[]).append(sql)
-
-        return queries_to_run
-
-
-    # setup geo-partitioning if this is an enterprise cluster
-    def add_geo_partitioning(self, partition_map, zone_map):
-        queries = self.get_geo_partitioning_queries(partition_map, zone_map)
-
-        def add_geo_partitioning_helper(session, queries):
-            for query in queries:
-                session.execute(query)
-
-        logging.info("partitioned tables...")
-        run_transaction(sessionmaker(bind=self.engine),
-                        lambda session: add_geo_partitioning_helper(session, queries["table_partitions"]))
-
-        logging.info("partitioned indices...")
-        run_transaction(sessionmaker(bind=self.engine),
-                        lambda session: add_geo_partitioning_helper(session, queries["index_partitions"]))
-
-        logging.info("applying table zone configs...")
-        run_transaction(sessionmaker(bind=self.engine),
-                        lambda session: add_geo_partitioning_helper(session, queries["table_zones"]))
-
-        logging.info("applying index zone configs...")
-        run_transaction(sessionmaker(bind=self.engine),
-                        lambda session: add_geo_partitioning_helper(session, queries["index_zones"]))
-
-        logging.info("adding indexes for promo code reference tables...")
-        run_transaction(sessionmaker(bind=self.engine),
-                        lambda session: add_geo_partitioning_helper(session, queries["promo_code_indices"]))
-
-        logging.info("applying zone configs for reference table indices...")
-        run_transaction(sessionmaker(bind=self.engine),
-                        lambda session: add_geo_partitioning_helper(session, queries["promo_code_zones"]))
-
-
-
-
-
+            statements.append(PartitionStatement("promo_code_zones", "promo_codes@" + index_name, sql, (index_name,),
+                                                 ("zone", "promo_codes", None, index_name, zone_map[partition_name])))
 
+        return statements
 
+    def get_geo_partitioning_queries(self, partition_map, zone_map):
+        queries_to_run = {}
+        for statement in self.get_geo_partitioning_statements(partition_map, zone_map):
+            queries_to_run.setdefault(statement.group, []).append(statement.sql)
+        return queries_to_run
 
 
+    # setup geo-partitioning if this is an enterprise cluster. Returns a PartitionStatementResult for every statement.
+    def add_geo_partitioning(self, partition_map, zone_map, max_workers = DEFAULT_PARTITION_WORKERS):
+        statements = self.get_geo_partitioning_statements(partition_map, zone_map)
+        logging.info("running %d partitioning statements with up to %d at a time...", len(statements), max_workers)
+        return execute_partition_statements(self.engine, statements, max_workers)
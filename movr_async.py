@@ -0,0 +1,191 @@
+from sqlalchemy import and_, select
+from sqlalchemy.dialects import registry
+from sqlalchemy.dialects.postgresql.asyncpg import PGDialect_asyncpg
+from sqlalchemy.exc import DBAPIError
+from sqlalchemy.ext.asyncio import create_async_engine
+from urllib.parse import parse_qs, urlsplit, urlunsplit, urlencode
+from models import User, Vehicle, Ride, PromoCode
+from movr import START_RIDE_STATEMENT, get_start_ride_parameters, END_RIDE_STATEMENT, \
+    get_end_ride_parameters, get_apply_promo_code_statement, get_insert_locations_statement, get_transaction_attempts, \
+    get_stale_vehicles_statement, FOLLOWER_READ_STALENESS
+from generators import MovRGenerator
+
+import asyncio, logging, random, time
+
+SERIALIZATION_FAILURE = "40001"
+
+# CockroachDB speaks the postgres wire protocol, but reports a version string postgres dialects can't parse.
+class CockroachDBDialect_asyncpg(PGDialect_asyncpg):
+    supports_statement_cache = True
+
+    def _get_server_version_info(self, connection):
+        return (9, 5, 0)
+
+registry.register("cockroachdb.asyncpg", "movr_async", "CockroachDBDialect_asyncpg")
+
+# turn a cockroachdb:// connection string into an asyncpg url and the connect arguments asyncpg understands
+def get_async_connection_args(conn_string):
+    scheme, netloc, path, query_string, fragment = urlsplit(conn_string)
+    query_params = parse_qs(query_string)
+
+    connect_args = {}
+    if "sslmode" in query_params:
+        connect_args["ssl"] = query_params.pop("sslmode")[0] != "disable"
+    if "application_name" in query_params:
+        connect_args["server_settings"] = {"application_name": query_params.pop("application_name")[0]}
+
+    return urlunsplit(("cockroachdb+asyncpg", netloc, path, urlencode(query_params, doseq=True), fragment)), \
+        connect_args
+
+# asyncio version of the MovR API, for running thousands of simulated users in a single process.
+# Every method is a coroutine with the same signature and results as its counterpart in MovR. Writes always use the
+# single round-trip statements of MovR's fast path, since there is no ORM unit of work here.
+class AsyncMovR:
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        await self.engine.dispose()
+
+    def __init__(self, conn_string, echo = False, pool_size = 5, max_overflow = 5, max_retries = 10,
+                 read_staleness = FOLLOWER_READ_STALENESS):
+        url, connect_args = get_async_connection_args(conn_string)
+        self.engine = create_async_engine(url, echo=echo, pool_size=pool_size, max_overflow=max_overflow,
+                                          connect_args=connect_args)
+        self.max_retries = max_retries
+        self.stale_vehicles_statement = get_stale_vehicles_statement(read_staleness)
+
+    # run callback(connection) in a transaction, retrying it from the start on serialization failures.
+    # Attempts are counted the same way as MovR.run_transaction, for the current asyncio task.
+    async def run_transaction(self, callback):
+        attempts = get_transaction_attempts()
+        attempts.transactions += 1
+        start = attempt_start = time.time()
+        retry_count = 0
+        try:
+            while True:
+                attempts.attempts += 1
+                if retry_count:
+                    attempt_start = time.time()
+                try:
+                    async with self.engine.begin() as connection:
+                        return await callback(connection)
+                except DBAPIError as e:
+                    sqlstate = getattr(e.orig, "sqlstate", None) or getattr(e.orig, "pgcode", None)
+                    if sqlstate != SERIALIZATION_FAILURE or retry_count >= self.max_retries:
+                        raise
+                    retry_count += 1
+                    logging.debug("retrying transaction after serialization failure (attempt %d)", retry_count + 1)
+                    await asyncio.sleep(random.uniform(0, 0.001 * 2 ** retry_count))
+        finally:
+            attempts.retry_time += attempt_start - start
+
+    ##################
+    # MAIN MOVR API
+    #################
+
+    async def start_ride(self, city, rider_id, vehicle_id):
+        async def start_ride_helper(connection):
+            parameters = get_start_ride_parameters(city, rider_id, vehicle_id)
+            await connection.execute(START_RIDE_STATEMENT, parameters)
+            return {'city': city, 'id': parameters['ride_id']}
+
+        return await self.run_transaction(start_ride_helper)
+
+    async def end_ride(self, city, ride_id):
+        async def end_ride_helper(connection):
+            await connection.execute(END_RIDE_STATEMENT, get_end_ride_parameters(city, ride_id))
+
+        await self.run_transaction(end_ride_helper)
+
+    async def update_ride_location(self, city, ride_id, lat, long):
+        await self.update_ride_locations([{'city': city, 'ride_id': ride_id, 'lat': lat, 'long': long}])
+
+    async def update_ride_locations(self, locations):
+        async def update_ride_locations_helper(connection):
+            await connection.execute(get_insert_locations_statement(locations))
+
+        if len(locations):
+            await self.run_transaction(update_ride_locations_helper)
+
+    async def add_user(self, city, name, address, credit_card_number):
+        async def add_user_helper(connection):
+            user_id = MovRGenerator.generate_uuid()
+            await connection.execute(User.__table__.insert().values(city=city, id=user_id, name=name, address=address,
+                                                                    credit_card=credit_card_number))
+            return {'city': city, 'id': user_id}
+
+        return await self.run_transaction(add_user_helper)
+
+    async def add_vehicle(self, city, owner_id, current_location, type, vehicle_metadata, status):
+        async def add_vehicle_helper(connection):
+            vehicle_id = MovRGenerator.generate_uuid()
+            await connection.execute(Vehicle.__table__.insert().values(id=vehicle_id, type=type, city=city,
+                                                                       owner_id=owner_id,
+                                                                       current_location=current_location,
+                                                                       status=status, ext=vehicle_metadata))
+            return {'city': city, 'id': vehicle_id}
+
+        return await self.run_transaction(add_vehicle_helper)
+
+    async def get_users(self, city, limit=None):
+        users = User.__table__
+
+        async def get_users_helper(connection):
+            result = await connection.execute(select([users.c.city, users.c.id]).where(users.c.city == city).limit(limit))
+            return [{'city': row.city, 'id': row.id} for row in result]
+
+        return await self.run_transaction(get_users_helper)
+
+    async def get_vehicles(self, city, limit=None):
+        vehicles = Vehicle.__table__
+
+        async def get_vehicles_helper(connection):
+            result = await connection.execute(select([vehicles.c.city, vehicles.c.id]).
+                                              where(vehicles.c.city == city).limit(limit))
+            return [{'city': row.city, 'id': row.id} for row in result]
+
+        return await self.run_transaction(get_vehicles_helper)
+
+    async def get_stale_vehicles(self, city, limit=None):
+        attempts = get_transaction_attempts()
+        attempts.transactions += 1
+        attempts.attempts += 1
+        async with self.engine.connect() as connection:
+            connection = await connection.execution_options(isolation_level="AUTOCOMMIT")
+            result = await connection.execute(self.stale_vehicles_statement, {'city': city, 'limit': limit})
+            return [{'city': row.city, 'id': row.id} for row in result]
+
+    async def get_active_rides(self, city, limit=None):
+        rides = Ride.__table__
+
+        async def get_active_rides_helper(connection):
+            result = await connection.execute(select([rides.c.id]).
+                                              where(and_(rides.c.city == city, rides.c.end_time == None)).limit(limit))
+            return [{'city': city, 'id': row.id} for row in result]
+
+        return await self.run_transaction(get_active_rides_helper)
+
+    async def get_promo_codes(self, limit=None):
+        promo_codes = PromoCode.__table__
+
+        async def get_promo_codes_helper(connection):
+            result = await connection.execute(select([promo_codes.c.code]).limit(limit))
+            return [row.code for row in result]
+
+        return await self.run_transaction(get_promo_codes_helper)
+
+    async def create_promo_code(self, code, description, expiration_time, rules):
+        async def add_promo_code_helper(connection):
+            await connection.execute(PromoCode.__table__.insert().values(code=code, description=description,
+                                                                         expiration_time=expiration_time, rules=rules))
+            return code
+
+        return await self.run_transaction(add_promo_code_helper)
+
+    async def apply_promo_code(self, user_city, user_id, promo_code):
+        async def apply_promo_code_helper(connection):
+            await connection.execute(get_apply_promo_code_statement(user_city, user_id, promo_code))
+
+        await self.run_transaction(apply_promo_code_helper)
@@ -0,0 +1,65 @@
+import time
+from collections import OrderedDict
+from threading import Lock
+
+# Read-through cache with a time to live and least-recently-used eviction, safe to share between threads.
+# Values (including None, for keys the loader didn't find) are served from memory until they are ttl seconds old,
+# evicted to stay within max_size entries, or invalidated.
+class TTLCache:
+    def __init__(self, max_size, ttl):
+        if max_size <= 0:
+            raise ValueError("cache size must be > 0")
+        self.max_size = max_size
+        self.ttl = ttl
+        self.mutex = Lock()
+        self.entries = OrderedDict() # key -> (expiration time, value), least recently used first
+        # bumped by every invalidation, so a value loaded before one is never cached after it
+        self.generation = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    # return the cached value of key, or load it with loader(key) and cache it
+    def get(self, key, loader):
+        self.mutex.acquire()
+        try:
+            entry = self.entries.get(key)
+            if entry is not None and entry[0] > time.time():
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+            self.misses += 1
+            generation = self.generation
+        finally:
+            self.mutex.release()
+
+        value = loader(key)
+
+        self.mutex.acquire()
+        try:
+            if generation == self.generation:
+                self.entries[key] = (time.time() + self.ttl, value)
+                self.entries.move_to_end(key)
+                while len(self.entries) > self.max_size:
+                    self.entries.popitem(last=False)
+                    self.evictions += 1
+        finally:
+            self.mutex.release()
+        return value
+
+    def invalidate(self, key):
+        self.mutex.acquire()
+        try:
+            self.entries.pop(key, None)
+            self.generation += 1
+        finally:
+            self.mutex.release()
+
+    def get_stats(self):
+        self.mutex.acquire()
+        try:
+            lookups = self.hits + self.misses
+            return {"size": len(self.entries), "hits": self.hits, "misses": self.misses,
+                    "hit rate": self.hits / lookups if lookups else 0.0, "evictions": self.evictions}
+        finally:
+            self.mutex.release()
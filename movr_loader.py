@@ -0,0 +1,406 @@
+import datetime, io, json, logging, queue, threading, time
+from collections import namedtuple
+from sqlalchemy import func
+from models import User, Vehicle, Ride, VehicleLocationHistory, PromoCode, LoadCheckpoint
+from movr_memory import MemorySession
+
+LOADER_BACKEND_ORM = "orm"
+LOADER_BACKEND_CORE = "core"
+LOADER_BACKEND_COPY = "copy"
+LOADER_BACKENDS = [LOADER_BACKEND_ORM, LOADER_BACKEND_CORE, LOADER_BACKEND_COPY]
+
+# load only what is missing from the requested sizes, going by the chunks the checkpoints say were written (resume)
+# or by the rows the tables hold (grow)
+LOAD_MODE_RESUME = "resume"
+LOAD_MODE_GROW = "grow"
+
+# rows written by the bulk loader in a single transaction, per table
+LOADER_CHUNK_SIZES = {"users": 1000, "vehicles": 1000, "rides": 800, "vehicle_location_histories": 5000,
+                      "promo_codes": 800}
+
+# limits of the chunk sizes a ChunkSizer picks, in rows
+DEFAULT_MIN_CHUNK_SIZE = 100
+DEFAULT_MAX_CHUNK_SIZE = 20000
+
+# the tables written by the bulk loader for each city
+LOADER_CITY_MODELS = {"users": User, "vehicles": Vehicle, "rides": Ride,
+                      "vehicle_location_histories": VehicleLocationHistory}
+# the city promo codes, which are shared by every city, are checkpointed with
+PROMO_CODE_CITY = ""
+
+# most ids of a table read back for a city when a resumed load needs rows that reference them
+LOADER_ID_READ_LIMIT = 100000
+
+# Column orders of the plain tuples built by the bulk loader, one per model.
+# Every column with a python-side default is listed, since COPY never applies them.
+USER_COLUMNS = ["id", "city", "name", "address", "credit_card"]
+VEHICLE_COLUMNS = ["id", "city", "type", "owner_id", "creation_time", "status", "current_location", "ext"]
+RIDE_COLUMNS = ["id", "city", "vehicle_city", "rider_id", "vehicle_id", "start_address", "end_address",
+                "start_time", "end_time", "revenue"]
+VEHICLE_LOCATION_HISTORY_COLUMNS = ["city", "ride_id", "timestamp", "lat", "long"]
+PROMO_CODE_COLUMNS = ["code", "description", "creation_time", "expiration_time", "rules"]
+
+# the model and column order of every table written by the bulk loader
+LOADER_TABLES = {
+    "users": (User, USER_COLUMNS),
+    "vehicles": (Vehicle, VEHICLE_COLUMNS),
+    "rides": (Ride, RIDE_COLUMNS),
+    "vehicle_location_histories": (VehicleLocationHistory, VEHICLE_LOCATION_HISTORY_COLUMNS),
+    "promo_codes": (PromoCode, PROMO_CODE_COLUMNS)
+}
+
+
+# write a chunk of rows (tuples in the order of columns) to the table of an ORM model with the requested backend:
+#   orm:  build model instances and save them with bulk_save_objects
+#   core: a SQLAlchemy Core INSERT executed with the rows as executemany parameters, so the statement is compiled
+#         once rather than with every row's values inlined into it
+#   copy: stream the rows with COPY ... FROM STDIN
+def write_rows(session, model, columns, rows, backend):
+    if not len(rows):
+        return
+
+    # the in-memory backend has no statements to build, whatever the backend
+    if isinstance(session, MemorySession):
+        session.movr.insert_rows(model.__tablename__, columns, rows)
+    elif backend == LOADER_BACKEND_ORM:
+        session.bulk_save_objects([model(**dict(zip(columns, row))) for row in rows])
+    elif backend == LOADER_BACKEND_CORE:
+        session.execute(model.__table__.insert(), [dict(zip(columns, row)) for row in rows])
+    elif backend == LOADER_BACKEND_COPY:
+        copy_rows(session, model.__tablename__, columns, rows)
+    else:
+        raise ValueError("unknown loader backend '%s'" % backend)
+
+# record a chunk of rows written to table_name for city, in the transaction of session that wrote them
+def write_checkpoint(session, city, table_name, rows):
+    if isinstance(session, MemorySession):
+        return
+    session.add(LoadCheckpoint(city=city, table_name=table_name, rows=rows))
+
+
+def copy_rows(session, table_name, columns, rows):
+    buffer = io.StringIO()
+    for row in rows:
+        buffer.write("\t".join(format_copy_value(value) for value in row))
+        buffer.write("\n")
+    buffer.seek(0)
+
+    cursor = session.connection().connection.cursor()
+    try:
+        cursor.copy_expert("COPY %s (%s) FROM STDIN" % (table_name, ", ".join(columns)), buffer)
+    finally:
+        cursor.close()
+
+
+# format a value for the text format of COPY
+def format_copy_value(value):
+    if value is None:
+        return "\\N"
+    if isinstance(value, dict) or isinstance(value, list):
+        value = json.dumps(value)
+    elif isinstance(value, datetime.datetime):
+        value = value.isoformat()
+    else:
+        value = str(value)
+    return value.replace("\\", "\\\\").replace("\t", "\\t").replace("\n", "\\n").replace("\r", "\\r")
+
+
+# an estimate of the bytes a row takes on the wire, from (up to) sample_size of the rows of a chunk
+def estimate_row_bytes(rows, sample_size = 20):
+    sample = rows[:sample_size]
+    if not sample:
+        return 0
+    return sum(len(format_copy_value(value)) + 1 for row in sample for value in row) / len(sample)
+
+# Picks the number of rows the loader writes in each transaction, per table. Without adaptive sizing that is
+# LOADER_CHUNK_SIZES; with it, every committed chunk is recorded and the next chunks of its table are sized so that
+#   - a chunk takes about TARGET_CHUNK_SECONDS to commit, going by the recent commit time per row,
+#   - a chunk stays under MAX_CHUNK_BYTES, going by the recent size of a row,
+#   - sizes at most double from one chunk to the next, and halve when a chunk had to be retried,
+# and always stay between min_size and max_size rows. Safe to share between threads.
+class ChunkSizer:
+    TARGET_CHUNK_SECONDS = 0.5
+    MAX_CHUNK_BYTES = 4 * 1024 * 1024
+    # weight of the latest chunk in the moving averages
+    SMOOTHING = 0.3
+    # log a table's size when it moved by more than this fraction since it was last logged
+    LOG_CHANGE = 0.25
+
+    def __init__(self, adaptive = False, min_size = DEFAULT_MIN_CHUNK_SIZE, max_size = DEFAULT_MAX_CHUNK_SIZE):
+        if min_size <= 0 or max_size < min_size:
+            raise ValueError("chunk sizes must be greater than 0, with the minimum at most the maximum")
+        self.adaptive = adaptive
+        self.min_size = min_size
+        self.max_size = max_size
+        self.sizes = {}
+        self.logged_sizes = {}
+        self.seconds_per_row = {}
+        self.bytes_per_row = {}
+        self.retry_rates = {}
+        self.chunks = {}
+        self.mutex = threading.Lock()
+
+    def clamp(self, size):
+        return int(min(max(size, self.min_size), self.max_size))
+
+    def get_chunk_size(self, table):
+        if not self.adaptive:
+            return LOADER_CHUNK_SIZES[table]
+        self.mutex.acquire()
+        try:
+            return self.sizes.setdefault(table, self.clamp(LOADER_CHUNK_SIZES[table]))
+        finally:
+            self.mutex.release()
+
+    # record a chunk of rows of table committed in seconds, after attempts attempts
+    def record(self, table, rows, seconds, attempts = 1):
+        if not self.adaptive or not rows:
+            return
+
+        def smooth(averages, value):
+            averages[table] = value if table not in averages else \
+                self.SMOOTHING * value + (1 - self.SMOOTHING) * averages[table]
+            return averages[table]
+
+        row_bytes = estimate_row_bytes(rows)
+        self.mutex.acquire()
+        try:
+            size = self.sizes.setdefault(table, self.clamp(LOADER_CHUNK_SIZES[table]))
+            seconds_per_row = smooth(self.seconds_per_row, seconds / len(rows))
+            bytes_per_row = smooth(self.bytes_per_row, row_bytes)
+            smooth(self.retry_rates, (attempts - 1) / float(attempts))
+            self.chunks[table] = self.chunks.get(table, 0) + 1
+
+            new_size = self.TARGET_CHUNK_SECONDS / seconds_per_row if seconds_per_row else self.max_size
+            if bytes_per_row:
+                new_size = min(new_size, self.MAX_CHUNK_BYTES / bytes_per_row)
+            new_size = min(new_size, size * 2)
+            if attempts > 1:
+                new_size = min(new_size, size / 2)
+            self.sizes[table] = self.clamp(new_size)
+
+            logged_size = self.logged_sizes.get(table, LOADER_CHUNK_SIZES[table])
+            if abs(self.sizes[table] - logged_size) > self.LOG_CHANGE * logged_size:
+                self.logged_sizes[table] = self.sizes[table]
+                logging.info("writing %s in chunks of %d rows (%.1f ms to commit a row, %d bytes per row, "
+                             "%.1f%% of chunks retried)", table, self.sizes[table], seconds_per_row * 1000,
+                             bytes_per_row, self.retry_rates[table] * 100)
+        finally:
+            self.mutex.release()
+
+    # the chunk size picked for every table written so far, with the averages it was picked from
+    def get_stats(self):
+        self.mutex.acquire()
+        try:
+            return {table: {"chunk size": self.sizes[table], "chunks": self.chunks.get(table, 0),
+                            "ms per row": self.seconds_per_row.get(table, 0.0) * 1000,
+                            "bytes per row": self.bytes_per_row.get(table, 0.0),
+                            "retry rate": self.retry_rates.get(table, 0.0)}
+                    for table in self.sizes}
+        finally:
+            self.mutex.release()
+
+
+
+##############
+# RESUMING LOADS
+# the rows already loaded are keyed by (city, table name), with PROMO_CODE_CITY for promo codes
+##############
+
+# the checkpoint table is new, so add it to databases loaded without it
+def create_checkpoint_table(movr):
+    LoadCheckpoint.__table__.create(bind=movr.engine, checkfirst=True)
+
+def get_checkpointed_rows(movr):
+    def helper(session):
+        return {(city, table_name): int(rows) for city, table_name, rows in
+                session.query(LoadCheckpoint.city, LoadCheckpoint.table_name, func.sum(LoadCheckpoint.rows))
+                .group_by(LoadCheckpoint.city, LoadCheckpoint.table_name)}
+    return movr.run_transaction(helper)
+
+# count the rows of every loader table for every city, whoever wrote them
+def count_loaded_rows(movr):
+    def helper(session):
+        loaded = {}
+        for table_name, model in LOADER_CITY_MODELS.items():
+            for city, rows in session.query(model.city, func.count()).group_by(model.city):
+                loaded[(city, table_name)] = rows
+        loaded[(PROMO_CODE_CITY, "promo_codes")] = session.query(func.count(PromoCode.code)).scalar()
+        return loaded
+    return movr.run_transaction(helper)
+
+# ids of up to limit rows of a loader table in a city
+def read_loaded_ids(movr, table_name, city, limit = LOADER_ID_READ_LIMIT):
+    model = LOADER_CITY_MODELS[table_name]
+    return movr.run_transaction(lambda session: [str(id) for (id,) in
+                                                 session.query(model.id).filter(model.city == city).limit(limit)])
+
+
+##############
+# PIPELINED LOADING
+##############
+
+# A chunk of rows for the writers of a LoaderPipeline. key identifies the rows of a table being loaded (the
+# (city, table name) pairs used for loaded rows), and depends_on the keys whose rows must all have been written first,
+# for the foreign keys this chunk references.
+LoaderBatch = namedtuple("LoaderBatch", ["key", "rows", "depends_on"])
+
+# stats of the threads of one stage of a LoaderPipeline
+class PipelineStageStats:
+    def __init__(self, name, threads):
+        self.name = name
+        self.threads = threads
+        self.rows = 0
+        self.batches = 0
+        self.busy_time = 0.0
+        self.blocked_time = 0.0
+        self.mutex = threading.Lock()
+
+    def add(self, rows, busy_time, blocked_time):
+        self.mutex.acquire()
+        try:
+            self.rows += rows
+            self.batches += 1 if rows else 0
+            self.busy_time += busy_time
+            self.blocked_time += blocked_time
+        finally:
+            self.mutex.release()
+
+
+# Streams generated rows to the database: generator threads turn tasks into LoaderBatches, which writer threads
+# write, each in its own transaction, while the generators carry on. The queue between the stages holds at most
+# queue_size batches, so generators that outrun the writers block until there is room (and the other way around).
+# A writer holds on to a batch until the keys it depends on are completely written; generators queue the batches a
+# batch depends on before it, so one of the other writers is always making progress on them.
+class LoaderPipeline:
+    POLL_INTERVAL = 0.1
+
+    # generate(task) yields the LoaderBatches of a task, write(batch) writes one. expected_rows is the number of rows
+    # that will be generated for every key, and should_stop is polled to give up early.
+    def __init__(self, generate, write, expected_rows, num_generators = 1, num_writers = 4, queue_size = 8,
+                 should_stop = lambda: False):
+        self.generate = generate
+        self.write = write
+        self.expected_rows = expected_rows
+        self.written_rows = {}
+        self.should_stop = should_stop
+        self.batches = queue.Queue(maxsize=queue_size)
+        self.tasks = queue.Queue()
+        self.written = threading.Condition()
+        self.error = None
+        self.generator_stats = PipelineStageStats("generate", num_generators)
+        self.writer_stats = PipelineStageStats("write", num_writers)
+        self.max_queued_batches = 0
+        self.start_time = None
+        self.end_time = None
+
+    def stopping(self):
+        return self.error is not None or self.should_stop()
+
+    def fail(self, error):
+        self.written.acquire()
+        try:
+            if self.error is None:
+                self.error = error
+            self.written.notify_all()
+        finally:
+            self.written.release()
+
+    def run_generator(self):
+        while not self.stopping():
+            try:
+                task = self.tasks.get_nowait()
+            except queue.Empty:
+                return
+            try:
+                batches = self.generate(task)
+                while not self.stopping():
+                    start = time.time()
+                    batch = next(batches, None)
+                    if batch is None:
+                        break
+                    generated = time.time()
+                    while not self.stopping():
+                        try:
+                            self.batches.put(batch, timeout=self.POLL_INTERVAL)
+                            break
+                        except queue.Full:
+                            pass
+                    self.max_queued_batches = max(self.max_queued_batches, self.batches.qsize())
+                    self.generator_stats.add(len(batch.rows), generated - start, time.time() - generated)
+            except Exception as e:
+                logging.error("generating rows for %s failed: %s", task, e)
+                self.fail(e)
+
+    def is_written(self, key):
+        return self.written_rows.get(key, 0) >= self.expected_rows.get(key, 0)
+
+    def run_writer(self, generators):
+        start = time.time()
+        while True:
+            try:
+                batch = self.batches.get(timeout=self.POLL_INTERVAL)
+            except queue.Empty:
+                if self.stopping():
+                    return
+                # nothing is queued once the generators are done
+                if not any(generator.is_alive() for generator in generators) and self.batches.empty():
+                    return
+                continue
+
+            self.written.acquire()
+            try:
+                while not self.stopping() and not all(self.is_written(key) for key in batch.depends_on):
+                    self.written.wait(self.POLL_INTERVAL)
+            finally:
+                self.written.release()
+            if self.stopping():
+                return
+
+            ready = time.time()
+            try:
+                self.write(batch)
+            except Exception as e:
+                logging.error("writing %d rows of %s failed: %s", len(batch.rows), batch.key, e)
+                self.fail(e)
+                return
+
+            self.written.acquire()
+            try:
+                self.written_rows[batch.key] = self.written_rows.get(batch.key, 0) + len(batch.rows)
+                self.written.notify_all()
+            finally:
+                self.written.release()
+            written = time.time()
+            self.writer_stats.add(len(batch.rows), written - ready, ready - start)
+            start = written
+
+    # run every task through the pipeline, and return once all their rows are written (or the pipeline stopped)
+    def run(self, tasks):
+        self.start_time = time.time()
+        for task in tasks:
+            self.tasks.put(task)
+
+        generators = [threading.Thread(target=self.run_generator, name="generator-%d" % i)
+                      for i in range(self.generator_stats.threads)]
+        writers = [threading.Thread(target=self.run_writer, args=(generators,), name="writer-%d" % i)
+                   for i in range(self.writer_stats.threads)]
+        for t in generators + writers:
+            t.start()
+        for t in generators + writers:
+            t.join()
+
+        self.end_time = time.time()
+        if self.error is not None:
+            raise self.error
+
+    # rows, time spent working and time spent waiting on the other stage, for every stage
+    def get_stage_stats(self):
+        elapsed = (self.end_time or time.time()) - self.start_time if self.start_time else 0.0
+        stats = []
+        for stage in [self.generator_stats, self.writer_stats]:
+            stats.append({"stage": stage.name, "threads": stage.threads, "batches": stage.batches, "rows": stage.rows,
+                          "busy time": stage.busy_time, "blocked time": stage.blocked_time,
+                          "rows per second": stage.rows / elapsed if elapsed else 0.0,
+                          "rows per busy second": stage.rows / stage.busy_time if stage.busy_time else 0.0})
+        return stats
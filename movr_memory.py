@@ -0,0 +1,225 @@
+import asyncio, datetime, threading
+from urllib.parse import urlsplit
+from generators import MovRGenerator
+from movr import get_transaction_attempts, FOLLOWER_READ_STALENESS
+
+# --url memory:// runs movr against MemoryMovR instead of a database
+MEMORY_URL_SCHEME = "memory"
+
+def is_memory_url(conn_string):
+    return urlsplit(conn_string).scheme == MEMORY_URL_SCHEME
+
+
+# handed to the callbacks of MemoryMovR.run_transaction, so the loader's write_rows can tell it apart from a
+# SQLAlchemy session
+class MemorySession:
+    def __init__(self, movr):
+        self.movr = movr
+
+
+# In-memory stand-in for MovR, with the same constructor and API, for measuring how fast the client can generate
+# load without a database. Rows are kept in dicts per table (and per city), every call is a single "transaction"
+# under one lock, and arguments that only matter for a database (pool sizes, fast_path, ...) are ignored.
+# Nothing is persisted: every MemoryMovR (and so every loader process) starts out empty.
+class MemoryMovR:
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        pass
+
+    def __init__(self, conn_string, init_tables = False, echo = False, pool_size = 5, max_overflow = 5, stats = None,
+                 fast_path = False, read_staleness = FOLLOWER_READ_STALENESS, promo_code_cache_size = 0,
+                 promo_code_cache_ttl = 60):
+        self.mutex = threading.Lock()
+        self.fast_path = fast_path
+        self.promo_code_cache = None
+        self.users = {}      # city -> id -> row
+        self.vehicles = {}   # city -> id -> row
+        self.rides = {}      # city -> id -> row
+        self.vehicle_location_histories = {} # city -> list of rows
+        self.promo_codes = {} # code -> row
+        self.user_promo_codes = {} # (city, user id) -> code -> row
+
+    # count a single attempt of a single transaction, the way MovR.run_transaction counts them
+    def count_transaction(self):
+        attempts = get_transaction_attempts()
+        attempts.transactions += 1
+        attempts.attempts += 1
+
+    def run_transaction(self, callback):
+        self.count_transaction()
+        return callback(MemorySession(self))
+
+    # insert loader rows (tuples in the order of columns) into the table named table_name
+    def insert_rows(self, table_name, columns, rows):
+        now = datetime.datetime.now()
+        self.mutex.acquire()
+        try:
+            for row in rows:
+                row = dict(zip(columns, row))
+                if table_name == "promo_codes":
+                    row.setdefault("creation_time", now)
+                    self.promo_codes[row["code"]] = row
+                elif table_name == "vehicle_location_histories":
+                    self.vehicle_location_histories.setdefault(row["city"], []).append(row)
+                else:
+                    getattr(self, table_name).setdefault(row["city"], {})[row["id"]] = row
+        finally:
+            self.mutex.release()
+
+    ##################
+    # MAIN MOVR API
+    #################
+
+    def start_ride(self, city, rider_id, vehicle_id):
+        self.count_transaction()
+        self.mutex.acquire()
+        try:
+            vehicle = self.vehicles[city][vehicle_id]
+            now = datetime.datetime.now()
+            for upc in self.user_promo_codes.get((city, rider_id), {}).values():
+                promo_code = self.promo_codes.get(upc["code"])
+                if promo_code and promo_code["expiration_time"] > now:
+                    upc["usage_count"] += 1
+
+            ride_id = MovRGenerator.generate_uuid()
+            self.rides.setdefault(city, {})[ride_id] = {
+                "id": ride_id, "city": city, "vehicle_city": city, "rider_id": rider_id, "vehicle_id": vehicle_id,
+                "start_address": vehicle["current_location"], "end_address": None, "start_time": now,
+                "end_time": None, "revenue": None}
+            vehicle["status"] = "in_use"
+            return {'city': city, 'id': ride_id}
+        finally:
+            self.mutex.release()
+
+    def end_ride(self, city, ride_id):
+        self.count_transaction()
+        self.mutex.acquire()
+        try:
+            ride = self.rides[city][ride_id]
+            vehicle = self.vehicles[ride["vehicle_city"]][ride["vehicle_id"]]
+            ride["end_address"] = vehicle["current_location"]
+            ride["revenue"] = MovRGenerator.generate_revenue()
+            ride["end_time"] = datetime.datetime.now()
+            vehicle["status"] = "available"
+        finally:
+            self.mutex.release()
+
+    def update_ride_location(self, city, ride_id, lat, long):
+        self.update_ride_locations([{'city': city, 'ride_id': ride_id, 'lat': lat, 'long': long}])
+
+    def update_ride_locations(self, locations):
+        if not len(locations):
+            return
+        self.count_transaction()
+        now = datetime.datetime.now()
+        self.mutex.acquire()
+        try:
+            for l in locations:
+                self.vehicle_location_histories.setdefault(l['city'], []).append(
+                    {'city': l['city'], 'ride_id': l['ride_id'], 'timestamp': now, 'lat': l['lat'], 'long': l['long']})
+        finally:
+            self.mutex.release()
+
+    def add_user(self, city, name, address, credit_card_number):
+        self.count_transaction()
+        user_id = MovRGenerator.generate_uuid()
+        self.insert_rows("users", ["id", "city", "name", "address", "credit_card"],
+                         [(user_id, city, name, address, credit_card_number)])
+        return {'city': city, 'id': user_id}
+
+    def add_vehicle(self, city, owner_id, current_location, type, vehicle_metadata, status):
+        self.count_transaction()
+        vehicle_id = MovRGenerator.generate_uuid()
+        self.insert_rows("vehicles", ["id", "city", "type", "owner_id", "creation_time", "status", "current_location",
+                                      "ext"],
+                         [(vehicle_id, city, type, owner_id, datetime.datetime.now(), status, current_location,
+                           vehicle_metadata)])
+        return {'city': city, 'id': vehicle_id}
+
+    def get_city_rows(self, table, city, limit = None, predicate = None):
+        self.count_transaction()
+        self.mutex.acquire()
+        try:
+            results = []
+            for row in table.get(city, {}).values():
+                if limit is not None and len(results) >= limit:
+                    break
+                if predicate is None or predicate(row):
+                    results.append({'city': city, 'id': row["id"]})
+            return results
+        finally:
+            self.mutex.release()
+
+    def get_users(self, city, limit=None):
+        return self.get_city_rows(self.users, city, limit)
+
+    def get_vehicles(self, city, limit=None):
+        return self.get_city_rows(self.vehicles, city, limit)
+
+    # there is only ever one copy of the data, so stale reads are just reads
+    def get_stale_vehicles(self, city, limit=None):
+        return self.get_city_rows(self.vehicles, city, limit)
+
+    def get_active_rides(self, city, limit=None):
+        return self.get_city_rows(self.rides, city, limit, lambda ride: ride["end_time"] is None)
+
+    def get_promo_codes(self, limit=None):
+        self.count_transaction()
+        self.mutex.acquire()
+        try:
+            codes = list(self.promo_codes)
+            return codes if limit is None else codes[:limit]
+        finally:
+            self.mutex.release()
+
+    def create_promo_code(self, code, description, expiration_time, rules):
+        self.count_transaction()
+        self.mutex.acquire()
+        try:
+            if code in self.promo_codes:
+                raise ValueError("duplicate promo code '%s'" % code)
+            self.promo_codes[code] = {"code": code, "description": description,
+                                      "creation_time": datetime.datetime.now(), "expiration_time": expiration_time,
+                                      "rules": rules}
+            return code
+        finally:
+            self.mutex.release()
+
+    def apply_promo_code(self, user_city, user_id, promo_code):
+        self.count_transaction()
+        self.mutex.acquire()
+        try:
+            if promo_code in self.promo_codes:
+                self.user_promo_codes.setdefault((user_city, user_id), {}).setdefault(promo_code, {
+                    "city": user_city, "user_id": user_id, "code": promo_code,
+                    "timestamp": datetime.datetime.now(), "usage_count": 0})
+        finally:
+            self.mutex.release()
+
+
+# asyncio version of MemoryMovR, standing in for AsyncMovR: every method of MemoryMovR as a coroutine
+class AsyncMemoryMovR:
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        pass
+
+    def __init__(self, conn_string, echo = False, pool_size = 5, max_overflow = 5, max_retries = 10,
+                 read_staleness = FOLLOWER_READ_STALENESS):
+        self.movr = MemoryMovR(conn_string, read_staleness=read_staleness)
+
+    def __getattr__(self, name):
+        method = getattr(self.movr, name)
+
+        async def call(*args, **kwargs):
+            result = method(*args, **kwargs)
+            # nothing here waits on I/O, so yield to the event loop the way a database round trip would
+            await asyncio.sleep(0)
+            return result
+
+        return call
@@ -0,0 +1,178 @@
+import csv, json, logging, threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+STATS_OUTPUT_JSONL = "jsonl"
+STATS_OUTPUT_CSV = "csv"
+STATS_OUTPUT_FORMATS = [STATS_OUTPUT_JSONL, STATS_OUTPUT_CSV]
+
+STATS_RECORD_FIELDS = ["time", "window_start", "window_seconds", "action", "city", "region", "ops_total", "ops",
+                       "ops_per_second", "mean_ms", "p50_ms", "p90_ms", "p95_ms", "p99_ms", "max_ms", "attempts",
+                       "retries", "retry_time_ms", "errors", "service_p50_ms", "service_p99_ms"]
+
+# upper bounds, in seconds, of the latency histogram buckets served on the metrics endpoint
+LATENCY_BUCKETS = [0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10]
+
+OPENMETRICS_CONTENT_TYPE = "application/openmetrics-text; version=1.0.0; charset=utf-8"
+
+
+# the output format of a --stats-output path: csv for .csv files, JSON lines for anything else
+def get_stats_output_format(path):
+    return STATS_OUTPUT_CSV if path.lower().endswith(".csv") else STATS_OUTPUT_JSONL
+
+
+# Appends the records of MovRStats.get_window_records to a file, one line per action per reporting window (and per
+# action and city or region, if the stats are grouped).
+class StatsOutputWriter:
+    def __init__(self, path, output_format = None):
+        self.output_format = output_format or get_stats_output_format(path)
+        if self.output_format not in STATS_OUTPUT_FORMATS:
+            raise ValueError("stats output format must be one of %s" % STATS_OUTPUT_FORMATS)
+        self.file = open(path, "w", newline="")
+        self.mutex = threading.Lock()
+        self.csv_writer = None
+        if self.output_format == STATS_OUTPUT_CSV:
+            self.csv_writer = csv.DictWriter(self.file, STATS_RECORD_FIELDS)
+            self.csv_writer.writeheader()
+
+    def write(self, records):
+        self.mutex.acquire()
+        try:
+            for record in records:
+                if self.csv_writer:
+                    self.csv_writer.writerow(record)
+                else:
+                    self.file.write(json.dumps(record, separators=(",", ":")))
+                    self.file.write("\n")
+            # flushed every window, so the file can be followed while the run is going on
+            self.file.flush()
+        finally:
+            self.mutex.release()
+
+    def close(self):
+        self.mutex.acquire()
+        try:
+            self.file.close()
+        finally:
+            self.mutex.release()
+
+
+def format_label_value(value):
+    return value.replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+def format_metric_value(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+# render the cumulative stats of a run (action -> ActionStats) and the counters of its caches
+# (name -> TTLCache.get_stats()) in the OpenMetrics text format. Stats grouped by city or region
+# ((action, group) -> ActionStats, see MovRStats.get_group_stats) get their own movr_<group_by>_* metrics, so that
+# summing them doesn't count operations twice.
+def get_openmetrics_text(action_stats, cache_stats = {}, group_stats = {}, group_by = None):
+    lines = []
+
+    def add_metric(name, metric_type, help_text, samples):
+        lines.append("# TYPE %s %s" % (name, metric_type))
+        lines.append("# HELP %s %s" % (name, help_text))
+        for suffix, labels, value in samples:
+            label_text = ",".join('%s="%s"' % (label, format_label_value(str(label_value)))
+                                  for label, label_value in labels)
+            lines.append("%s%s{%s} %s" % (name, suffix, label_text, format_metric_value(value)))
+
+    # histograms are (labels, histogram) pairs
+    def get_histogram_samples(histograms):
+        samples = []
+        for labels, histogram in histograms:
+            counts = histogram.get_cumulative_counts(LATENCY_BUCKETS)
+            for bound, count in zip(LATENCY_BUCKETS, counts):
+                samples.append(("_bucket", labels + [("le", repr(float(bound)))], count))
+            samples.append(("_bucket", labels + [("le", "+Inf")], histogram.total_count))
+            samples.append(("_count", labels, histogram.total_count))
+            samples.append(("_sum", labels, histogram.total_value / 1000000.0))
+        return samples
+
+    actions = sorted(action_stats)
+    add_metric("movr_operations", "counter", "Operations that completed without an error.",
+               [("_total", [("action", action)], action_stats[action].latency.total_count) for action in actions])
+    add_metric("movr_operation_errors", "counter", "Operations that raised an error.",
+               [("_total", [("action", action)], action_stats[action].errors) for action in actions])
+    add_metric("movr_transaction_attempts", "counter", "Transaction attempts, including retries.",
+               [("_total", [("action", action)], action_stats[action].attempts) for action in actions])
+    add_metric("movr_transaction_retries", "counter", "Transaction attempts that were retries.",
+               [("_total", [("action", action)], action_stats[action].get_retries()) for action in actions])
+    add_metric("movr_transaction_retry_seconds", "counter", "Time spent on transaction attempts that were retried.",
+               [("_total", [("action", action)], action_stats[action].retry_time) for action in actions])
+    add_metric("movr_operation_latency_seconds", "histogram", "Operation latency.",
+               get_histogram_samples([([("action", action)], action_stats[action].latency) for action in actions]))
+
+    service_time_actions = [action for action in actions if action_stats[action].service_time is not None]
+    if service_time_actions:
+        add_metric("movr_operation_service_time_seconds", "histogram",
+                   "Operation latency from the moment it was issued, when operations are issued on a schedule.",
+                   get_histogram_samples([([("action", action)], action_stats[action].service_time)
+                                          for action in service_time_actions]))
+
+    if group_stats:
+        groups = sorted(group_stats)
+        group_labels = {(action, group): [("action", action), (group_by, group)] for action, group in groups}
+        add_metric("movr_%s_operations" % group_by, "counter",
+                   "Operations that completed without an error, per %s." % group_by,
+                   [("_total", group_labels[key], group_stats[key].latency.total_count) for key in groups])
+        add_metric("movr_%s_operation_errors" % group_by, "counter",
+                   "Operations that raised an error, per %s." % group_by,
+                   [("_total", group_labels[key], group_stats[key].errors) for key in groups])
+        add_metric("movr_%s_operation_latency_seconds" % group_by, "histogram",
+                   "Operation latency, per %s." % group_by,
+                   get_histogram_samples([(group_labels[key], group_stats[key].latency) for key in groups]))
+
+    if cache_stats:
+        caches = sorted(cache_stats)
+        add_metric("movr_cache_hits", "counter", "Cache lookups served from memory.",
+                   [("_total", [("cache", cache)], cache_stats[cache]["hits"]) for cache in caches])
+        add_metric("movr_cache_misses", "counter", "Cache lookups that went to the database.",
+                   [("_total", [("cache", cache)], cache_stats[cache]["misses"]) for cache in caches])
+        add_metric("movr_cache_evictions", "counter", "Entries evicted to keep caches within their size.",
+                   [("_total", [("cache", cache)], cache_stats[cache]["evictions"]) for cache in caches])
+        add_metric("movr_cache_entries", "gauge", "Entries currently cached.",
+                   [("", [("cache", cache)], cache_stats[cache]["size"]) for cache in caches])
+
+    lines.append("# EOF")
+    return "\n".join(lines) + "\n"
+
+
+# Serves the cumulative stats of a run (grouped the way the stats are), and the counters of any caches added to it,
+# on http://<host>:<port>/metrics from a daemon thread.
+class MetricsServer:
+    def __init__(self, stats, host, port):
+        self.caches = {}
+        caches = self.caches
+
+        class MetricsRequestHandler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split("?")[0] != "/metrics":
+                    self.send_error(404)
+                    return
+                cache_stats = {name: cache.get_stats() for name, cache in list(caches.items())}
+                body = get_openmetrics_text(stats.get_cumulative_snapshot(), cache_stats,
+                                            stats.get_cumulative_group_snapshot(), stats.group_by).encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", OPENMETRICS_CONTENT_TYPE)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                logging.debug("metrics: " + format, *args)
+
+        self.server = ThreadingHTTPServer((host, port), MetricsRequestHandler)
+        self.server.daemon_threads = True
+        self.thread = threading.Thread(target=self.server.serve_forever, name="metrics", daemon=True)
+
+    def add_cache(self, name, cache):
+        self.caches[name] = cache
+
+    def start(self):
+        self.thread.start()
+        logging.info("serving metrics on http://%s:%d/metrics", *self.server.server_address[:2])
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
@@ -0,0 +1,147 @@
+import logging, re, threading, time
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from sqlalchemy import text
+
+# One geo-partitioning statement.
+#   group:      which of the get_geo_partitioning_queries lists it belongs to
+#   key:        unique name other statements can depend on
+#   depends_on: keys of the statements that must have been applied first
+#   target:     what the statement changes, as inspected by is_partition_statement_applied:
+#               ("partitions", table, index name or None, {partition name: [values]})
+#               ("zone", table, partition name or None, index name or None, zone)
+#               ("index", table, index name)
+PartitionStatement = namedtuple("PartitionStatement", ["group", "key", "sql", "depends_on", "target"])
+
+STATUS_APPLIED = "applied"
+STATUS_ALREADY_APPLIED = "already applied"
+STATUS_FAILED = "failed"
+STATUS_DEPENDENCY_FAILED = "skipped, dependency failed"
+
+PartitionStatementResult = namedtuple("PartitionStatementResult", ["statement", "status", "seconds", "error"])
+
+DEFAULT_PARTITION_WORKERS = 4
+
+
+def get_quoted_values(value_list):
+    return sorted(value.replace("''", "'") for value in re.findall(r"'((?:[^']|'')*)'", value_list or ""))
+
+def execute_inspection(connection, sql):
+    return [dict(row._mapping) for row in connection.execute(text(sql))]
+
+# {index name: {partition name: sorted values}} of every partition of a table
+def get_table_partitions(connection, table):
+    partitions = {}
+    for row in execute_inspection(connection, "SHOW PARTITIONS FROM TABLE %s" % table):
+        if row.get("parent_partition") not in (None, "NULL"):
+            continue
+        # reported as <table>@<index>
+        index_name = row["index_name"].split("@")[-1]
+        partitions.setdefault(index_name, {})[row["partition_name"]] = get_quoted_values(row["partition_value"])
+    return partitions
+
+# whether the database already has the partitions, zone constraint or index a statement would create
+def is_partition_statement_applied(connection, statement):
+    kind = statement.target[0]
+    if kind == "partitions":
+        _, table, index_name, expected = statement.target
+        partitions = get_table_partitions(connection, table)
+        if index_name is None:
+            # the primary index of a table is called primary, or <table>_pkey since 22.1
+            existing = partitions.get("primary", partitions.get("%s_pkey" % table))
+        else:
+            existing = partitions.get(index_name)
+        return existing == {name: sorted(values) for name, values in expected.items()}
+
+    if kind == "zone":
+        _, table, partition_name, index_name, zone = statement.target
+        if partition_name is not None:
+            sql = "SHOW ZONE CONFIGURATION FOR PARTITION %s OF TABLE %s" % (partition_name, table)
+            target_name = partition_name
+        else:
+            sql = "SHOW ZONE CONFIGURATION FOR INDEX %s@%s" % (table, index_name)
+            target_name = index_name
+        for row in execute_inspection(connection, sql):
+            # zone configs are inherited, so only one set on the target itself counts
+            zone_target = str(row.get("target", row.get("zone_name", "")))
+            config = str(row.get("raw_config_sql", row.get("config_sql", "")))
+            if target_name in zone_target and ("+region=%s" % zone) in config:
+                return True
+        return False
+
+    if kind == "index":
+        _, table, index_name = statement.target
+        return any(row["index_name"] == index_name
+                   for row in execute_inspection(connection, "SHOW INDEXES FROM %s" % table))
+
+    raise ValueError("unknown partition statement target '%s'" % kind)
+
+
+# Run geo-partitioning statements on a pool of max_workers threads, each statement in its own implicit transaction
+# as soon as the statements it depends on have been applied. Statements whose changes are already in place are
+# skipped, so an interrupted partitioning can simply be run again. Returns a PartitionStatementResult per statement,
+# in the order the statements were given. Each running statement holds a connection of engine until it finishes, so
+# its pool needs room for max_workers connections.
+def execute_partition_statements(engine, statements, max_workers = DEFAULT_PARTITION_WORKERS):
+    keys = set(statement.key for statement in statements)
+    results = {}
+    mutex = threading.Lock()
+
+    def execute(statement):
+        start = time.time()
+        try:
+            with engine.connect() as connection:
+                connection = connection.execution_options(isolation_level="AUTOCOMMIT")
+                try:
+                    applied = is_partition_statement_applied(connection, statement)
+                except Exception as e:
+                    # not every version (or database) can be inspected; the statement itself decides then
+                    logging.debug("couldn't inspect the state of '%s': %s", statement.sql, e)
+                    applied = False
+                if applied:
+                    finish(statement, STATUS_ALREADY_APPLIED, time.time() - start)
+                    return
+                logging.info("running %s", statement.sql)
+                connection.execute(text(statement.sql))
+            finish(statement, STATUS_APPLIED, time.time() - start)
+        except Exception as e:
+            logging.error("'%s' failed: %s", statement.sql, e)
+            finish(statement, STATUS_FAILED, time.time() - start, str(e))
+
+    def finish(statement, status, seconds, error = None):
+        mutex.acquire()
+        try:
+            results[statement.key] = PartitionStatementResult(statement, status, seconds, error)
+        finally:
+            mutex.release()
+
+    remaining = list(statements)
+    pending = {}
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        while remaining or pending:
+            # statements skipped for a failed dependency are finished right away, and may unblock others
+            scheduled = True
+            while scheduled:
+                scheduled = False
+                for statement in list(remaining):
+                    dependencies = [key for key in statement.depends_on if key in keys]
+                    if not all(key in results for key in dependencies):
+                        continue
+                    remaining.remove(statement)
+                    scheduled = True
+                    if any(results[key].status in (STATUS_FAILED, STATUS_DEPENDENCY_FAILED) for key in dependencies):
+                        finish(statement, STATUS_DEPENDENCY_FAILED, 0.0)
+                    else:
+                        pending[executor.submit(execute, statement)] = statement
+
+            if not pending:
+                if remaining:
+                    raise ValueError("partition statements have circular dependencies: %s" %
+                                     [statement.key for statement in remaining])
+                break
+
+            done, _ = wait(list(pending), return_when=FIRST_COMPLETED)
+            for future in done:
+                pending.pop(future)
+
+    return [results[statement.key] for statement in statements]
@@ -0,0 +1,182 @@
+import random, uuid
+from threading import Lock
+import numpy
+from generators import MovRGenerator
+
+# Compact, append-only pool of UUIDs, stored as 16 raw bytes each instead of one python string per id.
+# Used by the bulk loader to hand the ids generated for one table to the stages that reference them.
+class IdPool:
+    ID_SIZE = 16
+
+    def __init__(self, ids = None):
+        self.data = bytearray()
+        if ids:
+            self.extend(ids)
+
+    def add(self, id):
+        self.data += uuid.UUID(id).bytes
+
+    def extend(self, ids):
+        for id in ids:
+            self.add(id)
+
+    # append every id of another pool
+    def merge(self, other):
+        self.data += other.data
+
+    def __len__(self):
+        return len(self.data) // self.ID_SIZE
+
+    def __getitem__(self, index):
+        if index < 0:
+            index += len(self)
+        if index < 0 or index >= len(self):
+            raise IndexError("id pool index out of range")
+        offset = index * self.ID_SIZE
+        return str(uuid.UUID(bytes=bytes(self.data[offset:offset + self.ID_SIZE])))
+
+    def __iter__(self):
+        for index in range(len(self)):
+            yield self[index]
+
+    # pick a random id from the pool
+    def sample(self):
+        if not len(self):
+            raise IndexError("cannot sample from an empty id pool")
+        return self[random.randrange(len(self))]
+
+    # pick n random ids from the pool at once
+    def sample_batch(self, n):
+        if not len(self):
+            raise IndexError("cannot sample from an empty id pool")
+        ids = numpy.frombuffer(self.data, dtype=numpy.uint8).reshape(len(self), self.ID_SIZE)
+        sampled = ids[numpy.random.randint(0, len(self), n)].tobytes()
+        del ids # release the view so the pool can grow again
+        return MovRGenerator.format_uuid_bytes(sampled)
+
+
+# Fixed-capacity ring buffer that is safe to share between threads. Once full, every push overwrites the oldest
+# entry, so memory stays flat however long a run lasts. Subclasses decide how entries are stored in the slots.
+class RingBuffer:
+    def __init__(self, capacity):
+        if capacity <= 0:
+            raise ValueError("ring buffer capacity must be > 0")
+        self.capacity = capacity
+        self.start = 0 # slot of the oldest entry
+        self.count = 0
+        self.mutex = Lock()
+        self.slots = [None] * capacity
+
+    def get_slot(self, slot):
+        return self.slots[slot]
+
+    def set_slot(self, slot, value):
+        self.slots[slot] = value
+
+    def __len__(self):
+        return self.count
+
+    # add an entry, overwriting the oldest one if the buffer is full
+    def push(self, value):
+        self.mutex.acquire()
+        try:
+            self.set_slot((self.start + self.count) % self.capacity, value)
+            if self.count < self.capacity:
+                self.count += 1
+            else:
+                self.start = (self.start + 1) % self.capacity
+        finally:
+            self.mutex.release()
+
+    def extend(self, values):
+        for value in values:
+            self.push(value)
+
+    # remove and return the newest entry, or None if the buffer is empty
+    def pop(self):
+        self.mutex.acquire()
+        try:
+            if not self.count:
+                return None
+            self.count -= 1
+            return self.get_slot((self.start + self.count) % self.capacity)
+        finally:
+            self.mutex.release()
+
+    # return a random entry in O(1), or None if the buffer is empty. rng is a random.Random or the random module.
+    def sample(self, rng = random):
+        self.mutex.acquire()
+        try:
+            if not self.count:
+                return None
+            return self.get_slot((self.start + rng.randrange(self.count)) % self.capacity)
+        finally:
+            self.mutex.release()
+
+    # return (without removing) up to n of the oldest entries
+    def head(self, n):
+        self.mutex.acquire()
+        try:
+            return [self.get_slot((self.start + i) % self.capacity) for i in range(min(n, self.count))]
+        finally:
+            self.mutex.release()
+
+
+# Ring buffer of UUIDs, stored as 16 raw bytes each in a single preallocated bytearray.
+class IdRing(RingBuffer):
+    ID_SIZE = 16
+
+    def __init__(self, capacity):
+        RingBuffer.__init__(self, capacity)
+        self.slots = bytearray(capacity * self.ID_SIZE)
+
+    def get_slot(self, slot):
+        offset = slot * self.ID_SIZE
+        return str(uuid.UUID(bytes=bytes(self.slots[offset:offset + self.ID_SIZE])))
+
+    def set_slot(self, slot, value):
+        offset = slot * self.ID_SIZE
+        self.slots[offset:offset + self.ID_SIZE] = (value if isinstance(value, uuid.UUID) else uuid.UUID(value)).bytes
+
+
+# The objects the load generator picks from while simulating users: per-city users, vehicles and active rides,
+# plus the promo codes shared by every city. Every collection is a bounded ring, so objects created during a run
+# replace the oldest ones instead of accumulating.
+class EntityPool:
+    DEFAULT_CAPACITY = 10000
+
+    def __init__(self, cities, capacity = DEFAULT_CAPACITY):
+        self.capacity = capacity
+        self.users = {city: IdRing(capacity) for city in cities}
+        self.vehicles = {city: IdRing(capacity) for city in cities}
+        self.rides = {city: IdRing(capacity) for city in cities}
+        self.promo_codes = RingBuffer(capacity)
+
+    def add_user(self, city, id):
+        self.users[city].push(id)
+
+    def add_vehicle(self, city, id):
+        self.vehicles[city].push(id)
+
+    def add_ride(self, city, id):
+        self.rides[city].push(id)
+
+    def add_promo_code(self, code):
+        self.promo_codes.push(code)
+
+    def sample_user(self, city, rng = random):
+        return self.users[city].sample(rng)
+
+    def sample_vehicle(self, city, rng = random):
+        return self.vehicles[city].sample(rng)
+
+    def sample_promo_code(self, rng = random):
+        return self.promo_codes.sample(rng)
+
+    # remove and return the id of the most recently started ride in a city, or None if there isn't one
+    def pop_ride(self, city):
+        return self.rides[city].pop()
+
+    # ids of up to n of the longest running active rides in a city
+    def get_rides(self, city, n):
+        return self.rides[city].head(n)
@@ -1,61 +1,500 @@
-import numpy
 from tabulate import tabulate
+from collections import defaultdict
 import time
+import threading
 from threading import Lock
 
-class MovRStats:
+# besides per action, stats can be kept per action and city, and reported per city or per region of a partition map
+STATS_GROUP_CITY = "city"
+STATS_GROUP_REGION = "region"
+STATS_GROUPS = [STATS_GROUP_CITY, STATS_GROUP_REGION]
+# the region of cities that aren't in the partition map
+OTHER_REGION = "other"
+
+# Fixed-memory, log-linear latency histogram in the style of HdrHistogram.
+# Values are recorded in microseconds. Each power of two above the linear range is split into
+# SUB_BUCKET_COUNT / 2 equal buckets, so every recorded value is reported within ~1% of its real value
+# and memory stays constant no matter how many samples are recorded. Only the buckets up to the one of the highest
+# recorded value are ever scanned, merged or cleared.
+# A sparse histogram keeps only its non-empty buckets, in a dict: slower to record into, but small when there are
+# many histograms that each see few distinct latencies (like the per-city stats of every thread).
+class LatencyHistogram:
+    SUB_BUCKET_BITS = 7
+    SUB_BUCKET_COUNT = 1 << SUB_BUCKET_BITS
+    SUB_BUCKET_HALF_COUNT = SUB_BUCKET_COUNT >> 1
+    HIGHEST_TRACKABLE_VALUE = 3600 * 1000 * 1000 # one hour in microseconds
+
+    def __init__(self, sparse = False):
+        self.bucket_count = self._get_index(self.HIGHEST_TRACKABLE_VALUE) + 1
+        self.sparse = sparse
+        self.counts = defaultdict(int) if sparse else [0] * self.bucket_count
+        self.total_count = 0
+        self.reset()
+
+    def reset(self):
+        if self.sparse:
+            self.counts.clear()
+        else:
+            used_buckets = self._get_used_bucket_count()
+            self.counts[:used_buckets] = [0] * used_buckets
+        self.total_count = 0
+        self.total_value = 0
+        self.min_value = None
+        self.max_value = 0
+
+    @classmethod
+    def _get_index(cls, value):
+        magnitude = max(value.bit_length() - cls.SUB_BUCKET_BITS, 0)
+        return magnitude * cls.SUB_BUCKET_HALF_COUNT + (value >> magnitude)
+
+    @classmethod
+    def _get_highest_equivalent_value(cls, index):
+        magnitude = max(index // cls.SUB_BUCKET_HALF_COUNT - 1, 0)
+        sub_bucket = index - magnitude * cls.SUB_BUCKET_HALF_COUNT
+        return ((sub_bucket + 1) << magnitude) - 1
+
+    # the number of buckets up to and including the one of the highest recorded value; all later ones are empty
+    def _get_used_bucket_count(self):
+        return self._get_index(self.max_value) + 1 if self.total_count else 0
+
+    # (index, count) of every non-empty bucket, in ascending order of index
+    def _get_bucket_counts(self):
+        if self.sparse:
+            return sorted(self.counts.items())
+        return ((index, count) for index, count in enumerate(self.counts[:self._get_used_bucket_count()]) if count)
+
+    # record one measurement in seconds
+    def record(self, measurement):
+        value = min(max(int(measurement * 1000000), 0), self.HIGHEST_TRACKABLE_VALUE)
+        self.counts[self._get_index(value)] += 1
+        self.total_count += 1
+        self.total_value += value
+        if self.min_value is None or value < self.min_value:
+            self.min_value = value
+        if value > self.max_value:
+            self.max_value = value
+
+    # add all of the measurements of another histogram to this one
+    def merge(self, other):
+        if not other.total_count:
+            return
+        counts = self.counts
+        for index, count in other._get_bucket_counts():
+            counts[index] += count
+        self.total_count += other.total_count
+        self.total_value += other.total_value
+        if self.min_value is None or other.min_value < self.min_value:
+            self.min_value = other.min_value
+        self.max_value = max(self.max_value, other.max_value)
+
+    def copy(self):
+        histogram = LatencyHistogram(self.sparse)
+        histogram.merge(self)
+        return histogram
+
+    # returns a list of latencies in seconds, one for each of the requested percentiles (0-100), in a single pass.
+    def get_percentiles(self, percentiles):
+        if not self.total_count:
+            return [0.0 for _ in percentiles]
+
+        targets = sorted((max(int(-(-p * self.total_count // 100)), 1), position)
+                         for position, p in enumerate(percentiles))
+        results = [0.0] * len(percentiles)
+
+        seen = 0
+        target_index = 0
+        for index, count in self._get_bucket_counts():
+            seen += count
+            while target_index < len(targets) and seen >= targets[target_index][0]:
+                value = min(self._get_highest_equivalent_value(index), self.max_value)
+                results[targets[target_index][1]] = value / 1000000.0
+                target_index += 1
+            if target_index == len(targets):
+                break
+
+        return results
+
+    # returns, for each of the (ascending) upper bounds in seconds, how many measurements were at most that long
+    def get_cumulative_counts(self, bounds):
+        results = [0] * len(bounds)
+        seen = 0
+        bound_index = 0
+        for index, count in self._get_bucket_counts():
+            value = self._get_highest_equivalent_value(index) / 1000000.0
+            while bound_index < len(bounds) and value > bounds[bound_index]:
+                results[bound_index] = seen
+                bound_index += 1
+            if bound_index == len(bounds):
+                break
+            seen += count
+        for i in range(bound_index, len(bounds)):
+            results[i] = seen
+        return results
+
+    def get_percentile(self, percentile):
+        return self.get_percentiles([percentile])[0]
+
+    def get_mean(self):
+        return self.total_value / self.total_count / 1000000.0 if self.total_count else 0.0
+
+
+# Everything recorded for one action. When operations are issued on a fixed schedule (open loop), latency is
+# measured from the intended start time of an operation and service_time from the moment it was actually issued.
+# Failed operations only count towards errors and the transaction counters, never towards latency.
+# sparse selects sparse histograms (see LatencyHistogram).
+class ActionStats:
+    def __init__(self, sparse = False):
+        self.sparse = sparse
+        self.latency = LatencyHistogram(sparse)
+        self.service_time = None
+        self.transactions = 0
+        self.attempts = 0
+        self.retry_time = 0.0
+        self.errors = 0
+
+    def get_retries(self):
+        return self.attempts - self.transactions
+
+    def is_empty(self):
+        return not (self.latency.total_count or self.transactions or self.errors)
+
+    # clear everything recorded, keeping the histograms for the next measurements
+    def reset(self):
+        self.latency.reset()
+        if self.service_time is not None:
+            self.service_time.reset()
+        self.transactions = 0
+        self.attempts = 0
+        self.retry_time = 0.0
+        self.errors = 0
+
+    def record_attempts(self, transactions, attempts, retry_time, failed):
+        self.transactions += transactions
+        self.attempts += attempts
+        self.retry_time += retry_time
+        if failed:
+            self.errors += 1
+
+    def record(self, latency, service_time = None):
+        self.latency.record(latency)
+        if service_time is not None:
+            if self.service_time is None:
+                self.service_time = LatencyHistogram(self.sparse)
+            self.service_time.record(service_time)
 
+    def merge(self, other):
+        self.latency.merge(other.latency)
+        self.transactions += other.transactions
+        self.attempts += other.attempts
+        self.retry_time += other.retry_time
+        self.errors += other.errors
+        if other.service_time is not None:
+            if self.service_time is None:
+                self.service_time = LatencyHistogram(self.sparse)
+            self.service_time.merge(other.service_time)
 
 
+# Measurements recorded by a single thread. Only the owning thread records into a shard, and the reporter only
+# touches it to swap in an empty window, so the shard mutex is never held for longer than a single record or swap.
+# Measurements with a city are recorded both per action and per (action, city), the latter in sparse histograms so a
+# shard's memory doesn't grow with the number of cities it sees.
+# Each shard alternates between two windows: once the reporter has merged a window it hands it back, cleared, to be
+# swapped in next, so the histograms of a shard are allocated once rather than on every swap.
+class MovRStatsShard:
     def __init__(self):
-        self.cumulative_counts = {}
+        self.mutex = Lock()
+        self.window_stats = {}
+        self.window_city_stats = {}
+        self.spare_window = None
+
+    def get_action_stats(self, action, city):
+        action_stats = self.window_stats.get(action)
+        if action_stats is None:
+            action_stats = self.window_stats[action] = ActionStats()
+        if city is None:
+            return [action_stats]
+        city_stats = self.window_city_stats.get((action, city))
+        if city_stats is None:
+            city_stats = self.window_city_stats[(action, city)] = ActionStats(sparse=True)
+        return [action_stats, city_stats]
+
+    def add_latency_measurement(self, action, measurement, service_time = None, city = None):
+        self.mutex.acquire()
+        try:
+            for action_stats in self.get_action_stats(action, city):
+                action_stats.record(measurement, service_time)
+        finally:
+            self.mutex.release()
+
+    def add_transaction_attempts(self, action, transactions, attempts, retry_time, failed, city = None):
+        self.mutex.acquire()
+        try:
+            for action_stats in self.get_action_stats(action, city):
+                action_stats.record_attempts(transactions, attempts, retry_time, failed)
+        finally:
+            self.mutex.release()
+
+    # hand the measurements recorded so far (per action, and per action and city) to the caller and start over with
+    # an empty window. The caller returns the window with release_window once it is done reading it.
+    def swap_window(self):
+        self.mutex.acquire()
+        try:
+            window = (self.window_stats, self.window_city_stats)
+            self.window_stats, self.window_city_stats = self.spare_window or ({}, {})
+            self.spare_window = None
+        finally:
+            self.mutex.release()
+        return window
+
+    # clear a window handed out by swap_window and keep it to swap in next time
+    def release_window(self, window):
+        for window_stats in window:
+            for action_stats in window_stats.values():
+                action_stats.reset()
+        self.mutex.acquire()
+        try:
+            self.spare_window = window
+        finally:
+            self.mutex.release()
+
+
+class MovRStats:
+
+
+    # With group_by (one of STATS_GROUPS), the tables and records of every action are followed by the same stats per
+    # action and city, or per action and region of region_map ({region: [cities]}).
+    def __init__(self, group_by = None, region_map = {}):
+        if group_by is not None and group_by not in STATS_GROUPS:
+            raise ValueError("stats can only be grouped by one of %s" % STATS_GROUPS)
+        self.group_by = group_by
+        self.city_regions = {city: region for region in region_map for city in region_map[region]}
+        self.cumulative_stats = {}
+        self.cumulative_city_stats = {}
         self.instantiation_time = time.time()
         self.mutex = Lock()
+        self.shards = []
+        self.local = threading.local()
+        self.window_stats = {}
+        self.window_city_stats = {}
         self.new_window()
 
+    # every thread records into its own shard, which is registered with the reporter the first time it is used
+    def get_shard(self):
+        shard = getattr(self.local, "shard", None)
+        if shard is None:
+            shard = self.local.shard = MovRStatsShard()
+            self.mutex.acquire()
+            try:
+                self.shards.append(shard)
+            finally:
+                self.mutex.release()
+        return shard
+
+    # pull the measurements recorded by every shard since the last collection into the reporter's window.
+    # Must be called with self.mutex held; the (slow) merge happens outside of the shard locks.
+    def collect_window(self):
+        for shard in list(self.shards):
+            window = shard.swap_window()
+            window_stats, window_city_stats = window
+            # reused windows keep (cleared) stats for every action the shard ever recorded
+            for action, action_stats in window_stats.items():
+                if not action_stats.is_empty():
+                    self.window_stats.setdefault(action, ActionStats()).merge(action_stats)
+            for key, action_stats in window_city_stats.items():
+                if not action_stats.is_empty():
+                    self.window_city_stats.setdefault(key, ActionStats()).merge(action_stats)
+            shard.release_window(window)
+
     # reset stats while keeping cumulative counts
     def new_window(self):
         self.mutex.acquire()
         try:
+            for action in self.window_stats:
+                self.cumulative_stats.setdefault(action, ActionStats()).merge(self.window_stats[action])
+            for key in self.window_city_stats:
+                self.cumulative_city_stats.setdefault(key, ActionStats()).merge(self.window_city_stats[key])
             self.window_start_time = time.time()
             self.window_stats = {}
+            self.window_city_stats = {}
         finally:
             self.mutex.release()
 
-    # add one latency measurement in seconds
-    def add_latency_measurement(self, action, measurement):
+    def get_region(self, city):
+        return self.city_regions.get(city, OTHER_REGION)
+
+    # the stats of the current window, or (if cumulative) the whole run, per (action, city or region) for the
+    # group_by of this instance. Must be called with self.mutex held.
+    def get_group_stats(self, cumulative = False):
+        city_stats = [self.window_city_stats]
+        if cumulative:
+            city_stats.append(self.cumulative_city_stats)
+        group_stats = {}
+        for stats_by_city in city_stats:
+            for (action, city), action_stats in stats_by_city.items():
+                group = city if self.group_by == STATS_GROUP_CITY else self.get_region(city)
+                group_stats.setdefault((action, group), ActionStats()).merge(action_stats)
+        return group_stats
+
+    # add one latency measurement in seconds. For operations issued on a fixed schedule, pass the latency from the
+    # intended start time as the measurement and the time the operation itself took as the service time.
+    # city is the city the operation ran against, if it ran against a single one.
+    def add_latency_measurement(self, action, measurement, service_time = None, city = None):
+        self.get_shard().add_latency_measurement(action, measurement, service_time,
+                                                 city if self.group_by is not None else None)
+
+    # count the transactions an operation ran, how often they were attempted and the seconds spent on attempts
+    # that had to be retried. failed is set if the operation raised an error.
+    def add_transaction_attempts(self, action, transactions, attempts, retry_time, failed = False, city = None):
+        self.get_shard().add_transaction_attempts(action, transactions, attempts, retry_time, failed,
+                                                  city if self.group_by is not None else None)
+
+    # stats of every measurement taken for an action since this instance was created
+    def get_cumulative_action_stats(self, action):
+        action_stats = ActionStats()
+        if action in self.cumulative_stats:
+            action_stats.merge(self.cumulative_stats[action])
+        if action in self.window_stats:
+            action_stats.merge(self.window_stats[action])
+        return action_stats
+
+    def get_cumulative_histogram(self, action):
+        return self.get_cumulative_action_stats(action).latency
+
+    # copies of the stats of every action measured since this instance was created, safe to read from any thread
+    def get_cumulative_snapshot(self):
         self.mutex.acquire()
         try:
-            self.window_stats.setdefault(action,[]).append(measurement)
-            self.cumulative_counts.setdefault(action,0)
-            self.cumulative_counts[action]+=1
+            self.collect_window()
+            return {action: self.get_cumulative_action_stats(action)
+                    for action in set(self.cumulative_stats) | set(self.window_stats)}
         finally:
             self.mutex.release()
 
+    # the same per (action, city or region), or an empty dict if the stats aren't grouped
+    def get_cumulative_group_snapshot(self):
+        if self.group_by is None:
+            return {}
+        self.mutex.acquire()
+        try:
+            self.collect_window()
+            return self.get_group_stats(cumulative=True)
+        finally:
+            self.mutex.release()
+
+    # one record of the current window per action, as plain values for the --stats-output files, followed by one
+    # per action and city or region if the stats are grouped. Unlike print_stats, rates are per second of the window
+    # rather than of the whole run.
+    def get_window_records(self, action_list = []):
+        self.mutex.acquire()
+        try:
+            self.collect_window()
+            now = time.time()
+            window_seconds = now - self.window_start_time
+
+            def get_record(action, action_stats, ops_total, city = None, region = None):
+                histogram = action_stats.latency
+                p50, p90, p95, p99, p100 = histogram.get_percentiles([50, 90, 95, 99, 100])
+                service_p50, service_p99 = action_stats.service_time.get_percentiles([50, 99]) \
+                    if action_stats.service_time is not None else (None, None)
+                return {
+                    "time": round(now, 3),
+                    "window_start": round(self.window_start_time, 3),
+                    "window_seconds": round(window_seconds, 3),
+                    "action": action,
+                    "city": city,
+                    "region": region,
+                    "ops_total": ops_total,
+                    "ops": histogram.total_count,
+                    "ops_per_second": round(histogram.total_count / window_seconds, 3) if window_seconds > 0 else 0.0,
+                    "mean_ms": round(histogram.get_mean() * 1000, 3),
+                    "p50_ms": round(p50 * 1000, 3),
+                    "p90_ms": round(p90 * 1000, 3),
+                    "p95_ms": round(p95 * 1000, 3),
+                    "p99_ms": round(p99 * 1000, 3),
+                    "max_ms": round(p100 * 1000, 3),
+                    "attempts": action_stats.attempts,
+                    "retries": action_stats.get_retries(),
+                    "retry_time_ms": round(action_stats.retry_time * 1000, 3),
+                    "errors": action_stats.errors,
+                    "service_p50_ms": round(service_p50 * 1000, 3) if service_p50 is not None else None,
+                    "service_p99_ms": round(service_p99 * 1000, 3) if service_p99 is not None else None}
+
+            actions = action_list if len(action_list) else list(self.window_stats)
+            records = []
+            for action in sorted(actions):
+                records.append(get_record(action, self.window_stats.get(action, ActionStats()),
+                                          self.get_cumulative_histogram(action).total_count))
+
+            if self.group_by is not None:
+                group_stats = self.get_group_stats()
+                cumulative_group_stats = self.get_group_stats(cumulative=True)
+                for action, group in sorted(group_stats):
+                    city = group if self.group_by == STATS_GROUP_CITY else None
+                    region = self.get_region(group) if self.group_by == STATS_GROUP_CITY else group
+                    records.append(get_record(action, group_stats[(action, group)],
+                                              cumulative_group_stats[(action, group)].latency.total_count,
+                                              city, region))
+            return records
+        finally:
+            self.mutex.release()
+
+    # operations of every action per second, over the current window or (if cumulative) the whole run
+    def get_ops_per_second(self, cumulative = False):
+        self.mutex.acquire()
+        try:
+            self.collect_window()
+            ops = sum(action_stats.latency.total_count for action_stats in self.window_stats.values())
+            if cumulative:
+                ops += sum(action_stats.latency.total_count for action_stats in self.cumulative_stats.values())
+                elapsed = time.time() - self.instantiation_time
+            else:
+                elapsed = time.time() - self.window_start_time
+            return ops / elapsed if elapsed > 0 else 0.0
+        finally:
+            self.mutex.release()
+
+    def has_service_times(self):
+        return any(action_stats.service_time is not None
+                   for action_stats in list(self.cumulative_stats.values()) + list(self.window_stats.values()))
+
     # print the current stats this instance has collected.
     # If action_list is empty, it will only prevent rows it has captured this period, otherwise it will print a row for each action.
     def print_stats(self, action_list = []):
-        def get_percentile_measurement(action, percentile):
-            return numpy.percentile(self.window_stats.setdefault(action, [0]), percentile)
-
         def get_stats_row(action):
             elapsed = time.time() - self.instantiation_time
 
             if action in self.window_stats:
-                return [action, round(elapsed, 0),  self.cumulative_counts[action], len(self.window_stats[action]),
-                        len(self.window_stats[action]) / elapsed,
-                        round(float(get_percentile_measurement(action, 50)) * 1000, 2),
-                        round(float(get_percentile_measurement(action, 90)) * 1000, 2),
-                        round(float(get_percentile_measurement(action, 95)) * 1000, 2),
-                        round(float(get_percentile_measurement(action, 100)) * 1000, 2)]
+                action_stats = self.window_stats[action]
+                histogram = action_stats.latency
+                p50, p90, p95, p100 = histogram.get_percentiles([50, 90, 95, 100])
+                row = [action, round(elapsed, 0),  self.get_cumulative_histogram(action).total_count, histogram.total_count,
+                       histogram.total_count / elapsed,
+                       round(p50 * 1000, 2),
+                       round(p90 * 1000, 2),
+                       round(p95 * 1000, 2),
+                       round(p100 * 1000, 2),
+                       action_stats.attempts,
+                       action_stats.get_retries(),
+                       round(action_stats.retry_time * 1000, 2),
+                       action_stats.errors]
             else:
-                return [action, round(elapsed, 0), 0,0,0,0,0,0,0 ]
+                row = [action, round(elapsed, 0), 0,0,0,0,0,0,0,0,0,0,0 ]
+
+            if show_service_times:
+                row += get_service_time_columns(self.window_stats.get(action), [50, 99])
+            return row
 
-        header = ["transaction name", "time(total)",  "ops(total)", "ops", "ops/second", "p50(ms)", "p90(ms)", "p95(ms)", "max(ms)"]
+        header = ["transaction name", "time(total)",  "ops(total)", "ops", "ops/second", "p50(ms)", "p90(ms)", "p95(ms)", "max(ms)",
+                  "attempts", "retries", "retry time(ms)", "errors"]
         rows = []
 
         self.mutex.acquire()
         try:
+            self.collect_window()
+            show_service_times = self.has_service_times()
+            if show_service_times:
+                header += ["service p50(ms)", "service p99(ms)"]
+
             if len(action_list):
                 for action in sorted(action_list):
                     rows.append(get_stats_row(action))
@@ -63,7 +502,75 @@ class MovRStats:
                 for action in sorted(list(self.window_stats)):
                     rows.append(get_stats_row(action))
             print(tabulate(rows, header), "\n")
+
+            if self.group_by is not None:
+                # ops/second over the whole run, like the table above
+                self.print_group_stats(self.get_group_stats(), time.time() - self.instantiation_time, [50, 99, 100])
+        finally:
+            self.mutex.release()
+
+    # print whole-run percentiles for every action this instance has collected.
+    def print_cumulative_stats(self, action_list = []):
+        def get_cumulative_row(action):
+            elapsed = time.time() - self.instantiation_time
+            action_stats = self.get_cumulative_action_stats(action)
+            histogram = action_stats.latency
+            p50, p99, p999, p100 = histogram.get_percentiles([50, 99, 99.9, 100])
+            row = [action, round(elapsed, 0), histogram.total_count, histogram.total_count / elapsed,
+                   round(histogram.get_mean() * 1000, 2),
+                   round(p50 * 1000, 2),
+                   round(p99 * 1000, 2),
+                   round(p999 * 1000, 2),
+                   round(p100 * 1000, 2),
+                   action_stats.attempts,
+                   action_stats.get_retries(),
+                   round(action_stats.retry_time * 1000, 2),
+                   action_stats.errors]
+            if show_service_times:
+                row += get_service_time_columns(action_stats, [50, 99, 99.9])
+            return row
+
+        header = ["transaction name", "time(total)", "ops(total)", "ops/second", "avg(ms)", "p50(ms)", "p99(ms)",
+                  "p99.9(ms)", "max(ms)", "attempts", "retries", "retry time(ms)", "errors"]
+        rows = []
+
+        self.mutex.acquire()
+        try:
+            self.collect_window()
+            show_service_times = self.has_service_times()
+            if show_service_times:
+                header += ["service p50(ms)", "service p99(ms)", "service p99.9(ms)"]
+
+            actions = action_list if len(action_list) else set(self.cumulative_stats) | set(self.window_stats)
+            for action in sorted(actions):
+                rows.append(get_cumulative_row(action))
+            if len(rows):
+                print(tabulate(rows, header), "\n")
+
+            if self.group_by is not None:
+                self.print_group_stats(self.get_group_stats(cumulative=True), time.time() - self.instantiation_time,
+                                       [50, 99, 99.9, 100])
         finally:
             self.mutex.release()
 
+    # print a row per (action, city or region) of group_stats (see get_group_stats) measured over elapsed seconds,
+    # sorted by city or region so the actions of each are listed together
+    def print_group_stats(self, group_stats, elapsed, percentiles):
+        header = [self.group_by, "transaction name", "ops", "ops/second"] + \
+                 ["max(ms)" if p == 100 else "p%s(ms)" % p for p in percentiles] + ["retries", "errors"]
+        rows = []
+        for action, group in sorted(group_stats, key=lambda key: (key[1], key[0])):
+            action_stats = group_stats[(action, group)]
+            histogram = action_stats.latency
+            rows.append([group, action, histogram.total_count,
+                         round(histogram.total_count / elapsed, 2) if elapsed > 0 else 0.0] +
+                        [round(p * 1000, 2) for p in histogram.get_percentiles(percentiles)] +
+                        [action_stats.get_retries(), action_stats.errors])
+        if len(rows):
+            print(tabulate(rows, header), "\n")
+
 
+def get_service_time_columns(action_stats, percentiles):
+    if action_stats is None or action_stats.service_time is None:
+        return [0 for _ in percentiles]
+    return [round(p * 1000, 2) for p in action_stats.service_time.get_percentiles(percentiles)]
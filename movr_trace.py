@@ -0,0 +1,141 @@
+import datetime, gzip, json, threading, time, uuid
+
+TRACE_VERSION = 1
+TRACE_TIMING_FAST = "fast"
+TRACE_TIMING_ORIGINAL = "original"
+TRACE_TIMINGS = [TRACE_TIMING_ORIGINAL, TRACE_TIMING_FAST]
+
+# arguments that reference a user, vehicle, ride or promo code, which may have been created earlier in the trace
+ID_ARGUMENTS = ["rider_id", "vehicle_id", "owner_id", "user_id", "ride_id", "promo_code"]
+
+# promo codes are keyed by the code the caller picks rather than a generated id, so replaying their creation
+# as recorded would collide with the code the recorded run (or an earlier replay) created
+CREATE_PROMO_CODE_METHOD = "create_promo_code"
+
+
+# json can't encode datetimes (promo code expiration times), so they're written as {"$datetime": <isoformat>}
+def encode_trace_value(value):
+    if isinstance(value, datetime.datetime):
+        return {"$datetime": value.isoformat()}
+    raise TypeError("can't write %r to a trace" % (value,))
+
+def decode_trace_object(obj):
+    if len(obj) == 1 and "$datetime" in obj:
+        return datetime.datetime.fromisoformat(obj["$datetime"])
+    return obj
+
+
+# the id of the object an operation created: the id of a created user, vehicle or ride, or a created promo code
+def get_created_id(method, result):
+    if isinstance(result, dict):
+        return result.get('id')
+    if method == CREATE_PROMO_CODE_METHOD:
+        return result
+    return None
+
+
+# Streams the operations issued by a run to a gzipped file of JSON lines: a header object, then one
+# [worker, start offset in seconds, action, method, arguments, created id] list per operation, in completion order.
+# The created id is the id of the user, vehicle or ride, or the promo code, an operation created, so a replay can point later operations
+# at the objects it creates instead.
+class TraceWriter:
+    def __init__(self, path, header):
+        self.file = gzip.open(path, "wt")
+        self.mutex = threading.Lock()
+        self.start_time = time.time()
+        self.write_line(dict(header, version=TRACE_VERSION))
+
+    def write_line(self, value):
+        line = json.dumps(value, separators=(",", ":"), default=encode_trace_value)
+        self.mutex.acquire()
+        try:
+            self.file.write(line)
+            self.file.write("\n")
+        finally:
+            self.mutex.release()
+
+    # record an operation that was issued at start (time.time()) and returned result
+    def record(self, worker, start, action, method, arguments, result):
+        self.write_line([worker, round(start - self.start_time, 6), action, method, arguments,
+                         get_created_id(method, result)])
+
+    def close(self):
+        self.mutex.acquire()
+        try:
+            self.file.close()
+        finally:
+            self.mutex.release()
+
+
+# returns the header of a trace and an iterator over its operations, as
+# (worker, offset, action, method, arguments, created id) tuples
+def read_trace(path):
+    trace_file = gzip.open(path, "rt")
+    header = json.loads(trace_file.readline(), object_hook=decode_trace_object)
+    if header.get("version") != TRACE_VERSION:
+        trace_file.close()
+        raise ValueError("unsupported trace version %s in %s" % (header.get("version"), path))
+
+    def operations():
+        try:
+            for line in trace_file:
+                yield tuple(json.loads(line, object_hook=decode_trace_object))
+        finally:
+            trace_file.close()
+
+    return header, operations()
+
+
+# Maps the ids of objects created while a trace was recorded to the ids of the objects created by its replay.
+# Operations that reference an object whose creation is still being replayed (by another thread) wait for it.
+# Promo codes created by the replay get the recorded code plus a suffix unique to the replay.
+class TraceIdMap:
+    def __init__(self):
+        self.code_suffix = "_" + uuid.uuid4().hex[:8]
+        self.ids = {}
+        self.pending = set()
+        self.condition = threading.Condition()
+
+    # called for every created id before its operation is handed to a replay thread
+    def expect(self, recorded_id):
+        self.condition.acquire()
+        try:
+            self.pending.add(recorded_id)
+        finally:
+            self.condition.release()
+
+    # called once the creating operation has been replayed, with new_id None if it failed
+    def add(self, recorded_id, new_id):
+        self.condition.acquire()
+        try:
+            if new_id is not None:
+                self.ids[recorded_id] = new_id
+            self.pending.discard(recorded_id)
+            self.condition.notify_all()
+        finally:
+            self.condition.release()
+
+    def get(self, recorded_id, timeout = 30):
+        self.condition.acquire()
+        try:
+            self.condition.wait_for(lambda: recorded_id not in self.pending, timeout)
+            return self.ids.get(recorded_id, recorded_id)
+        finally:
+            self.condition.release()
+
+    # the arguments to replay a recorded operation with: every referenced id is replaced by its replayed
+    # counterpart, and a created promo code gets a code of its own
+    def map_operation_arguments(self, method, arguments):
+        arguments = self.map_arguments(arguments)
+        if method == CREATE_PROMO_CODE_METHOD:
+            arguments["code"] = arguments["code"] + self.code_suffix
+        return arguments
+
+    # copy of recorded operation arguments with every referenced id replaced by its replayed counterpart
+    def map_arguments(self, arguments):
+        if isinstance(arguments, list):
+            return [self.map_arguments(value) for value in arguments]
+        if isinstance(arguments, dict):
+            return {name: self.get(value) if name in ID_ARGUMENTS else self.map_arguments(value)
+                    for name, value in arguments.items()}
+        return arguments
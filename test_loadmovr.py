@@ -0,0 +1,24 @@
+import datetime
+import loadmovr
+from movr_loader import ChunkSizer
+from movr_memory import MemoryMovR
+from movr_pools import IdPool
+from generators import MovRGenerator
+
+
+# the process loader runs the tasks of one city's location histories at the same time, over the same rides, so
+# the (city, ride_id, timestamp) keys they build must not collide
+def test_split_history_tasks_have_unique_keys():
+    loadmovr.chunk_sizer = ChunkSizer()
+    loadmovr.LOADER_PROCESS_MOVR = movr = MemoryMovR("memory://")
+    ride_ids = IdPool(MovRGenerator.generate_uuid_batch(200))
+
+    tasks = loadmovr.split_loader_tasks(200000, 50000, datetime.datetime.now())
+    assert [count for count, _ in tasks] == [50000] * 4
+    for count, start_time in tasks:
+        loadmovr.load_table_task("vehicle_location_histories", "new york", count, loadmovr.LOADER_BACKEND_ORM,
+                                 {"rides": ride_ids}, start_time)
+
+    rows = movr.vehicle_location_histories["new york"]
+    assert len(rows) == 200000
+    assert len({(row["city"], row["ride_id"], row["timestamp"]) for row in rows}) == 200000
@@ -0,0 +1,48 @@
+import datetime, queue
+import loadmovr
+from movr_memory import MemoryMovR
+from movr_stats import MovRStats
+from movr_trace import TraceWriter, TraceIdMap, read_trace
+
+
+# replay every operation of the trace at path against movr, in order, with a fresh id map
+def replay(movr, path):
+    header, operations = read_trace(path)
+    id_map = TraceIdMap()
+    operations_queue = queue.Queue()
+    for operation in operations:
+        if operation[5] is not None:
+            id_map.expect(operation[5])
+        operations_queue.put(operation)
+    operations_queue.put(None)
+    loadmovr.replay_trace_operations(movr, operations_queue, id_map)
+    return id_map
+
+
+# a created promo code and the application of it are replayed with a new code each time, so replaying a trace
+# against the backend it was recorded on doesn't fail on duplicate codes
+def test_replay_promo_codes_twice(tmp_path):
+    loadmovr.stats = MovRStats()
+    movr = MemoryMovR("memory://")
+    user = movr.add_user("new york", "Ann", "1 Main St", "4111111111111111")
+    path = str(tmp_path / "trace.gz")
+
+    trace = TraceWriter(path, {"cities": ["new york"]})
+    create_arguments = {"code": "spring_sale", "description": "spring sale",
+                        "expiration_time": datetime.datetime(2030, 1, 1), "rules": {"type": "percent_discount"}}
+    start = trace.start_time
+    trace.record(0, start, loadmovr.ACTION_NEW_CODE, "create_promo_code", create_arguments,
+                 movr.create_promo_code(**create_arguments))
+    apply_arguments = {"user_city": "new york", "user_id": user["id"], "promo_code": "spring_sale"}
+    trace.record(0, start, loadmovr.ACTION_APPLY_CODE, "apply_promo_code", apply_arguments,
+                 movr.apply_promo_code(**apply_arguments))
+    trace.close()
+
+    replayed_codes = []
+    for _ in range(2):
+        id_map = replay(movr, path)
+        replayed_codes.append(id_map.get("spring_sale"))
+
+    assert replayed_codes[0] != replayed_codes[1]
+    assert set(movr.promo_codes) == {"spring_sale"} | set(replayed_codes)
+    assert set(movr.user_promo_codes[("new york", user["id"])]) == {"spring_sale"} | set(replayed_codes)